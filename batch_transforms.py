@@ -0,0 +1,175 @@
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+
+from config import SEED
+
+
+def rgb_to_grayscale(x):
+    ''' ITU-R 601-2 luma of a (B, 3, H, W) batch, as PIL and torchvision; (B, 1, H, W). '''
+    return (0.299 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).unsqueeze(1)
+
+def rgb_to_hsv(x):
+    r, g, b = x[:, 0], x[:, 1], x[:, 2]
+    maxc, _ = x.max(dim=1)
+    minc, _ = x.min(dim=1)
+    delta = maxc - minc
+
+    s = delta / torch.where(maxc == 0, torch.ones_like(maxc), maxc)
+    safe = torch.where(delta == 0, torch.ones_like(delta), delta)
+    rc, gc, bc = (maxc - r) / safe, (maxc - g) / safe, (maxc - b) / safe
+
+    h = torch.where(maxc == r, bc - gc, torch.where(maxc == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = torch.where(delta == 0, torch.zeros_like(h), h)
+    h = torch.fmod(h / 6.0 + 1.0, 1.0)
+
+    return torch.stack([h, s, maxc], dim=1)
+
+def hsv_to_rgb(x):
+    h, s, v = x[:, 0], x[:, 1], x[:, 2]
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.to(torch.int64) % 6
+
+    p = (v * (1.0 - s)).clamp(0, 1)
+    q = (v * (1.0 - s * f)).clamp(0, 1)
+    t = (v * (1.0 - s * (1.0 - f))).clamp(0, 1)
+
+    mask = i.unsqueeze(1) == torch.arange(6, device=x.device).view(1, -1, 1, 1)
+    r = torch.stack([v, q, p, p, t, v], dim=1)
+    g = torch.stack([t, v, v, q, p, p], dim=1)
+    b = torch.stack([p, p, t, v, v, q], dim=1)
+
+    return torch.stack([(r * mask).sum(1), (g * mask).sum(1), (b * mask).sum(1)], dim=1)
+
+
+class BatchTransform():
+    ''' Tensor-op version of the get_transform pipelines applied to whole uint8 batches (B, C, H, W).
+    Every sample draws its own random parameters from a seeded generator, as the per-sample PIL transforms do.
+    Order: crop, horizontal flip, color distortion, vertical flip, resize, scaling to [0, 1], normalization.
+    Unlike ColorJitter the four jitter operations are applied in a fixed order. '''
+    def __init__(self, crop=None, hflip=False, vflip=False, color_dis=False, s=0.125, p_jitter=0.8, p_gray=0.2,
+                 resize=None, mean=None, std=None, seed=SEED):
+        self.crop = crop
+        self.hflip = hflip
+        self.vflip = vflip
+        self.color_dis = color_dis
+        self.jitter = (0.8*s, 0.8*s, 0.8*s, 0.2*s) # brightness, contrast, saturation, hue as in get_color_distortion
+        self.p_jitter = p_jitter
+        self.p_gray = p_gray
+        self.resize = resize
+        self.mean = mean
+        self.std = std
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def _rand(self, n):
+        return torch.rand(n, generator=self.generator)
+
+    def _uniform(self, n, low, high):
+        return low + (high - low) * self._rand(n)
+
+    def sample_transform(self):
+        ''' Per-sample part of the pipeline: only what is needed to collate images into uint8 batches. '''
+        per_sample = [transforms.CenterCrop(self.crop)] if self.crop is not None else []
+
+        return transforms.Compose(per_sample + [transforms.PILToTensor()])
+
+    @torch.no_grad()
+    def __call__(self, batch):
+        n, c = batch.shape[:2]
+        x = batch.float() / 255.
+        view = lambda v: v.to(x.device).view(-1, 1, 1, 1)
+
+        if self.hflip:
+            flip = (self._rand(n) < 0.5).to(x.device)
+            x = torch.where(view(flip), x.flip(-1), x)
+
+        if self.color_dis and c == 3:
+            apply = view(self._rand(n) < self.p_jitter)
+            b, con, sat, hue = self.jitter
+
+            factor = view(self._uniform(n, max(0., 1-b), 1+b))
+            y = (x * factor).clamp(0, 1)
+
+            factor = view(self._uniform(n, max(0., 1-con), 1+con))
+            mean = rgb_to_grayscale(y).mean(dim=(1, 2, 3), keepdim=True)
+            y = (factor * y + (1 - factor) * mean).clamp(0, 1)
+
+            factor = view(self._uniform(n, max(0., 1-sat), 1+sat))
+            y = (factor * y + (1 - factor) * rgb_to_grayscale(y)).clamp(0, 1)
+
+            shift = self._uniform(n, -hue, hue).to(x.device).view(-1, 1, 1)
+            hsv = rgb_to_hsv(y)
+            hsv = torch.stack([torch.remainder(hsv[:, 0] + shift, 1.0), hsv[:, 1], hsv[:, 2]], dim=1)
+            y = hsv_to_rgb(hsv)
+
+            x = torch.where(apply, y, x)
+
+            gray = view(self._rand(n) < self.p_gray)
+            x = torch.where(gray, rgb_to_grayscale(x).expand(-1, 3, -1, -1), x)
+
+        if self.vflip:
+            flip = (self._rand(n) < 0.5).to(x.device)
+            x = torch.where(view(flip), x.flip(-2), x)
+
+        if self.resize is not None:
+            x = F.interpolate(x, size=(self.resize, self.resize), mode='bicubic', align_corners=False, antialias=True).clamp(0, 1)
+
+        if self.mean is not None:
+            mean = torch.tensor(self.mean, dtype=x.dtype, device=x.device).view(1, -1, 1, 1)
+            std = torch.tensor(self.std, dtype=x.dtype, device=x.device).view(1, -1, 1, 1)
+            x = (x - mean[:, :c]) / std[:, :c]
+
+        return x
+
+    @classmethod
+    def from_compose(cls, transform, seed=SEED):
+        ''' Build the batch equivalent of a torchvision Compose produced by get_transform (plus Normalize). '''
+        kwargs = {}
+        for t in transform.transforms:
+            if isinstance(t, transforms.CenterCrop):
+                kwargs['crop'] = t.size
+            elif isinstance(t, transforms.RandomHorizontalFlip):
+                kwargs['hflip'] = True
+            elif isinstance(t, transforms.RandomVerticalFlip):
+                kwargs['vflip'] = True
+            elif isinstance(t, transforms.Resize):
+                kwargs['resize'] = t.size[0] if isinstance(t.size, (tuple, list)) else t.size
+            elif isinstance(t, transforms.Normalize):
+                kwargs['mean'], kwargs['std'] = list(t.mean), list(t.std)
+            elif isinstance(t, transforms.Compose):
+                # get_color_distortion: RandomApply([ColorJitter], p) followed by RandomGrayscale(p)
+                kwargs['color_dis'] = True
+                for sub in t.transforms:
+                    if isinstance(sub, transforms.RandomApply):
+                        kwargs['p_jitter'] = sub.p
+                        kwargs['s'] = sub.transforms[0].brightness[1] - 1. if sub.transforms[0].brightness is not None else 0.
+                    elif isinstance(sub, transforms.RandomGrayscale):
+                        kwargs['p_gray'] = sub.p
+            elif not isinstance(t, (transforms.ToTensor, transforms.PILToTensor)):
+                raise ValueError(f'No batch equivalent for transform {t}')
+
+        if 's' in kwargs:
+            kwargs['s'] = kwargs['s'] / 0.8
+
+        return cls(seed=seed, **kwargs)
+
+
+class BatchTransformLoader():
+    ''' Wraps a DataLoader of uint8 batches and applies a BatchTransform in the main process, optionally
+    after moving the batch to device. Torch runs the batch ops on its intra-op thread pool, so throughput
+    scales with the cores given to torch rather than with DataLoader workers. '''
+    def __init__(self, loader, batch_transform, device=None):
+        self.loader = loader
+        self.batch_transform = batch_transform
+        self.device = device
+        self.dataset = loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for inputs, targets in self.loader:
+            if self.device is not None:
+                inputs = inputs.to(self.device, non_blocking=True)
+            yield self.batch_transform(inputs), targets
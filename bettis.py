@@ -1,25 +1,94 @@
 import numpy as np
 
 
+def _flatten_diagrams(dgms, homology_dimensions=None):
+    ''' Stack a batch of giotto-ph/gtda diagrams into flat arrays.
+    dgms: list of (n_i, 3) arrays or a padded (n_dgms, n, 3) array of [birth, death, dim] triples;
+    return: diagram index, birth, death and dimension index of every point, plus the homology dimensions. '''
+    dgms = [np.asarray(dgm, dtype=np.float64).reshape(-1, 3) for dgm in dgms]
+    sizes = np.array([len(dgm) for dgm in dgms], dtype=np.int64)
+    points = np.concatenate(dgms, axis=0) if len(dgms) > 0 else np.zeros((0, 3))
+
+    if homology_dimensions is None:
+        max_dim = int(np.max(points[:, 2])) if len(points) > 0 else 0
+        homology_dimensions = range(max_dim + 1)
+    homology_dimensions = np.asarray(list(homology_dimensions), dtype=np.int64)
+
+    # map every point to its position in homology_dimensions; drop dimensions not requested
+    dims = points[:, 2].astype(np.int64)
+    dim_lookup = np.full(max(int(homology_dimensions.max()), int(dims.max()) if len(dims) > 0 else 0) + 1, -1, dtype=np.int64)
+    dim_lookup[homology_dimensions] = np.arange(len(homology_dimensions))
+    dim_idx = dim_lookup[dims]
+
+    dgm_idx = np.repeat(np.arange(len(dgms)), sizes)
+    keep = dim_idx >= 0
+
+    return dgm_idx[keep], points[keep, 0], points[keep, 1], dim_idx[keep], len(dgms), homology_dimensions
+
+def betti_curves(dgms, samplings, homology_dimensions=None):
+    ''' Evaluate the Betti curves of a batch of diagrams on a shared threshold grid.
+    A pair (b, d) is alive at t when b <= t < d, so beta(t) = #{b <= t} - #{d <= t}. Each endpoint
+    is located on the sorted grid with searchsorted and the counts are swept with a cumulative sum.
+    dgms: list of (n_i, 3) arrays or a padded (n_dgms, n, 3) array in giotto-ph format;
+    samplings: sorted 1D array of thresholds;
+    return: (n_dgms, n_dims, n_thresh) array of betti numbers. '''
+    dgm_idx, birth, death, dim_idx, n_dgms, homology_dimensions = _flatten_diagrams(dgms, homology_dimensions)
+
+    return _sweep(dgm_idx, birth, death, dim_idx, n_dgms, len(homology_dimensions), np.asarray(samplings, dtype=np.float64))
+
+def _sweep(dgm_idx, birth, death, dim_idx, n_dgms, n_dims, samplings):
+    ''' Cumulative searchsorted sweep shared by betti_curves and betti_summaries '''
+    n_thresh = len(samplings)
+    group = (dgm_idx * n_dims + dim_idx) * (n_thresh + 1)
+
+    # first grid index at which the endpoint has been passed; n_thresh means never
+    b_pos = np.searchsorted(samplings, birth, side='left')
+    d_pos = np.searchsorted(samplings, death, side='left')
+
+    size = n_dgms * n_dims * (n_thresh + 1)
+    counts = np.bincount(group + b_pos, minlength=size) - np.bincount(group + d_pos, minlength=size)
+    counts = np.cumsum(counts.reshape(n_dgms, n_dims, n_thresh + 1), axis=-1)
+
+    return counts[..., :-1].astype(np.float64)
+
+def betti_summaries(dgms, samplings, homology_dimensions=None):
+    ''' Betti curves together with the life, midlife and integral summaries of every diagram and dimension.
+    Life and midlife are averaged over the finite, non-degenerate pairs;
+    the integral is the trapezoidal area under the Betti curve over samplings.
+    return: dict of (n_dgms, n_dims, n_thresh) curves and (n_dgms, n_dims) summaries. '''
+    dgm_idx, birth, death, dim_idx, n_dgms, homology_dimensions = _flatten_diagrams(dgms, homology_dimensions)
+    n_dims = len(homology_dimensions)
+    samplings = np.asarray(samplings, dtype=np.float64)
+
+    curves = _sweep(dgm_idx, birth, death, dim_idx, n_dgms, n_dims, samplings)
+
+    finite = np.isfinite(death) & (death > birth)
+    group = (dgm_idx * n_dims + dim_idx)[finite]
+    size = n_dgms * n_dims
+    n_pairs = np.bincount(group, minlength=size)
+    life = np.bincount(group, weights=(death - birth)[finite], minlength=size)
+    midlife = np.bincount(group, weights=((death + birth) / 2)[finite], minlength=size)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        life = np.where(n_pairs > 0, life / n_pairs, 0.)
+        midlife = np.where(n_pairs > 0, midlife / n_pairs, 0.)
+
+    integral = np.sum((curves[..., 1:] + curves[..., :-1]) / 2 * np.diff(samplings), axis=-1)
+
+    return {'curves': curves,
+            'life': life.reshape(n_dgms, n_dims),
+            'midlife': midlife.reshape(n_dgms, n_dims),
+            'integral': integral,
+            'n_pairs': n_pairs.reshape(n_dgms, n_dims),
+            'homology_dimensions': homology_dimensions}
+
 def betti_nums(pd, thresh=0.):
     ''' This function assumes that the persistence diagram is in giotto-ph format;
     thresh: threshold for computing betti nums.'''
 
     max_dim = int(np.max(pd[:, 2]))
-    betti_nums = np.zeros((max_dim+1,))
-
-    dct = {}
-    for dim in range(max_dim+1):
-        dct[dim] = []
-    for x in pd:
-        dct[int(x[-1])].append(tuple(x[:-1]))
-
-    for dim in range(max_dim+1):
-        for (b, d) in dct[dim]:
-            if (d - b > thresh - b) and (thresh - b >= 0.):
-                betti_nums[dim] += 1
-    
-    return betti_nums
+
+    return betti_curves([pd], [thresh], homology_dimensions=range(max_dim+1))[0, :, 0]
 
 def pd2life(birth, death):
     return np.mean(np.asarray(death) - np.asarray(birth))
@@ -1,23 +1,27 @@
 from __future__ import print_function
 
 import argparse
-import time
+import os
+import pickle
+import random
 
-from gph import ripser_parallel
-from gtda.homology._utils import _postprocess_diagrams
-from gtda.utils import check_diagrams
-from scipy.sparse import coo_matrix
+import numpy as np
+import torch
+import torch.nn as nn
 
-from bettis import betti_nums
+from cache import ArtifactCache, file_hash, stage_keys
+from capture import capture_dir, load_capture
+from concurrency import Concurrency, add_concurrency_args
+from execution import ExecutionMode, add_execution_args
 from config import UPPER_DIM, SEED
-from graph import *
-from loaders import *
+from graph import adjacency
+from loaders import loader, manifest_file
+from memory import MemoryPlan, add_memory_args, layer_sizes
 from models.utils import get_model
 from passers import Passer
-from utils import *
-
-import numpy as np
-import random
+from savers import load_checkpoint
+from telemetry import Telemetry, stage
+from topology import correlation_diagram, record_samples, save_diagram, save_time
 
 
 parser = argparse.ArgumentParser(description='Build Graph and Compute Betti Numbers')
@@ -34,130 +38,214 @@ parser.add_argument('--resume', default=0, type=int, help='resume from checkpoin
 parser.add_argument('--resume_epoch', default=20, type=int, help='resume from epoch')
 parser.add_argument('--exp', default=1, type=float, help='Exponent for correlation distance.')
 parser.add_argument('--iter', default=0, type=int)
+parser.add_argument('--seed', default=None, type=int, help='Seed of a replica trained by multi_train.py --seeds; reads its _seed<seed> folders.')
 parser.add_argument('--verbose', default=0, type=int)
-
-args = parser.parse_args()
-
-device_list = []
-if torch.cuda.device_count() > 1:
-    device_list = [torch.device('cuda:{}'.format(i)) for i in range(torch.cuda.device_count())]
-    print("Using", torch.cuda.device_count(), "GPUs")
-    for i, device in enumerate(device_list):
-        print(f"Device {i}: {device}")
-else:
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    device_list.append(device)
-    print(f'Using {device}')
-
-''' Set seed and other deterministic settings '''
-torch.manual_seed(SEED)
-np.random.seed(SEED)
-random.seed(SEED)
-torch.backends.cudnn.benchmark = False
-# torch.use_deterministic_algorithms(True, warn_only=True)
-
-''' Directory to retrieve transformers '''
-TRANS_DIR = f'./train_processing/{args.net}/{args.net}_{args.dataset}_ss{args.iter}' if args.dataset == 'imagenet' else f'./train_processing/{args.net}/{args.net}_{args.dataset}'
-if not os.path.exists(TRANS_DIR):
-    os.makedirs(TRANS_DIR)
-
-''' Directory to save persistence diagrams '''
-pkl_folder = f'./losses/{args.net}/{args.net}_{args.dataset}_ss{args.iter}' if args.dataset == 'imagenet' else f'./losses/{args.net}/{args.net}_{args.dataset}'
-pkl_folder += f'/{args.reduction}' if args.reduction is not None else ''
-pkl_folder += f'/{args.metric}' if args.metric is not None else ''
-
-# Build models
-print('\n ==> Building model..')
-net = get_model(args.net, args.dataset)
-net = net.to(device_list[0])
-
-''' Prepare criterion '''
-criterion = nn.CrossEntropyLoss()
-
-''' Prepare val data loader '''
-trans_pkl_file = os.path.join(TRANS_DIR, f'test_transform.pkl')
-with open(trans_pkl_file, 'rb') as f:
-    test_transform = pickle.load(f)
-functloader, _ = loader(f'{args.dataset}_test', batch_size=100, iter=args.iter, subset=args.subset, verbose=False, transform=test_transform) # subset size
-
-''' Load checkpoint and get activations '''
-assert os.path.isdir('./checkpoint'), 'Error: no checkpoint directory found!'
-with torch.no_grad():
-    total_time = 0.
-
-    epoch_iter = iter(vars(args)['chkpt_epochs'])
-    for epoch in epoch_iter:
-        if args.resume and (epoch <= args.resume_epoch):
-            continue
-        print(f'\n==> Loading checkpoint for epoch {epoch}...\n')
-        
-        if args.dataset == 'imagenet':
-            checkpoint = torch.load(f'./checkpoint/{args.net}/{args.net}_{args.dataset}_ss{args.iter}/ckpt_epoch_{epoch}.pt', map_location=device_list[0])
-        else:
-            checkpoint = torch.load(f'./checkpoint/{args.net}/{args.net}_{args.dataset}/ckpt_epoch_{epoch}.pt', map_location=device_list[0])
-        
-        net.load_state_dict(checkpoint['net'])
-        net.requires_grad_(False)
-        net.eval()
-
-        ''' Define passer and get activations '''
-        # get activations and reduce dimensionality; compute distance adjacency matrix
-        passer = Passer(net, functloader, criterion, device_list[0])
-        activs = passer.get_function(reduction=args.reduction, device_list=device_list, corr=args.metric if not None else 'pearson', exp=args.exp)
-        adj = adjacency(activs, metric=args.metric, device=device_list[0])
-
-        if args.verbose:
-            print(f'\n The dimension of the corrcoef matrix is {adj.size()[0], adj.size()[-1]} \n')
-            print(f'Adj mean {adj.mean():.4f}, min {adj.min():.4f}, max {adj.max():.4f} \n')
-
-        # convert to distance matrix for V-R filtration; metrics: (.5*(1 - adj))^.5 or (1 - |adj|)^.5
-        adj = -adj
-        adj += 1
-        adj = torch.sqrt(.5 * adj.clamp(0., 1.))
-
-        # convert to COO format for faster computation of persistence diagram
-        indices = (adj<=1.).nonzero().numpy(force=True)
-        i = list(zip(*indices))
-        vals = adj[i].flatten().numpy(force=True)
-
-        adj = coo_matrix((vals, i), shape=adj.shape) if len(i) > 0 else coo_matrix(([], ([], [])), shape=adj.shape)
-
-        del indices, i, vals
-
-        if args.verbose:
-            print(f'\n The dimension of the COO distance matrix is {(len(adj.nonzero()[0]),)}\n')
-            if adj.data.shape[0] != 0:
-                print(f'adj mean {np.nanmean(adj.data):.4f}, min {np.nanmin(adj.data):.4f}, max {np.nanmax(adj.data):.4f}')
+parser.add_argument('--shared_cache', default=0, type=int, help='Decode ImageNet images once per node and share the decoded files between concurrent jobs.')
+parser.add_argument('--stratified', default=0, type=int, help='Draw the subset with an equal share of every class.')
+parser.add_argument('--artifact_cache', default='./cache/artifacts', type=str, help='Directory caching activations, adjacency and diagrams by input hash; "none" disables caching.')
+parser.add_argument('--artifact_cache_gb', default=10., type=float, help='Size of the artifact cache; the least recently used artifacts are evicted beyond it.')
+add_execution_args(parser)
+add_concurrency_args(parser)
+add_memory_args(parser)
+
+
+def parse_args(argv=None):
+    return parser.parse_args(argv)
+
+def run(args, net=None, test_transform=None, execution=None):
+    ''' Build the functional graph of every checkpoint epoch and compute its persistence diagram.
+    net, test_transform and execution, e.g. from train.run, are used instead of building the model and loading the transform pickle.
+    return: dict with the diagrams by epoch. '''
+
+    concurrency = Concurrency.from_args('build_graph', args).apply()
+
+    device_list = []
+    if torch.cuda.device_count() > 1:
+        device_list = [torch.device('cuda:{}'.format(i)) for i in range(torch.cuda.device_count())]
+        print("Using", torch.cuda.device_count(), "GPUs")
+        for i, device in enumerate(device_list):
+            print(f"Device {i}: {device}")
+    else:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        device_list.append(device)
+        print(f'Using {device}')
+
+    ''' Set seed and other deterministic settings '''
+    torch.manual_seed(SEED)
+    np.random.seed(SEED)
+    random.seed(SEED)
+    torch.backends.cudnn.benchmark = False
+    # torch.use_deterministic_algorithms(True, warn_only=True)
+
+    ONAME = f'{args.net}_{args.dataset}_ss{args.iter}' if args.dataset == 'imagenet' else f'{args.net}_{args.dataset}'
+    ONAME += f'_seed{args.seed}' if args.seed is not None else ''
+
+    ''' Directory to retrieve transformers '''
+    TRANS_DIR = f'./train_processing/{args.net}/{ONAME}'
+    if not os.path.exists(TRANS_DIR):
+        os.makedirs(TRANS_DIR)
+
+    ''' Directory to save persistence diagrams '''
+    pkl_folder = f'./losses/{args.net}/{ONAME}'
+    pkl_folder += f'/{args.reduction}' if args.reduction is not None else ''
+    pkl_folder += f'/{args.metric}' if args.metric is not None else ''
+
+    # Build models
+    if net is None:
+        print('\n ==> Building model..')
+        net = get_model(args.net, args.dataset)
+        net = net.to(device_list[0])
+        execution = ExecutionMode.from_args(args, device=device_list[0])
+        net = execution.apply(net)
+    elif execution is None:
+        execution = ExecutionMode(device=device_list[0])
+    net = net.to(device_list[0])
+
+    ''' Prepare criterion '''
+    criterion = nn.CrossEntropyLoss()
+
+    ''' Prepare val data loader '''
+    if test_transform is None:
+        trans_pkl_file = os.path.join(TRANS_DIR, f'test_transform.pkl')
+        with open(trans_pkl_file, 'rb') as f:
+            test_transform = pickle.load(f)
+    # subset samples are fixed by a manifest next to the transforms and reused by every epoch and later run
+    sample_manifest_file = manifest_file(TRANS_DIR, args.subset, args.stratified)
+    functloader, _ = loader(f'{args.dataset}_test', batch_size=100, iter=args.iter, subset=args.subset, verbose=False, transform=test_transform,
+                            shared_cache=args.shared_cache, manifest=sample_manifest_file, stratified=args.stratified) # subset size
+    sample_manifest = functloader.dataset.sample_manifest
+    print(f'Using sample manifest {sample_manifest_file} ({sample_manifest["hash"][:12]})')
+
+    # record which samples the diagrams in pkl_folder were built from
+    record_samples(pkl_folder, sample_manifest_file, sample_manifest, metric=args.metric, reduction=args.reduction)
+
+    ''' Directory of activations captured during training '''
+    CAPTURE_DIR = capture_dir(args.net, args.dataset, args.iter, seed=args.seed)
+
+    ''' Cache of activations, adjacency and diagrams; parameter sweeps only recompute the stages whose inputs changed '''
+    artifacts = None if args.artifact_cache.lower() == 'none' else ArtifactCache(args.artifact_cache, max_bytes=int(args.artifact_cache_gb * 1024**3))
+
+    ''' Per-stage wall/CPU time, peak memory and graph sizes in pkl_folder/telemetry.jsonl '''
+    telemetry = Telemetry(pkl_folder, net=args.net, dataset=args.dataset, iter=args.iter, seed=args.seed, subset=args.subset, metric=args.metric, reduction=args.reduction)
+
+    ''' Predict the peak memory of every stage from a dry forward pass and choose how to run them; stops here if nothing fits '''
+    sizes = layer_sizes(net, functloader.dataset[0][0].unsqueeze(0).to(device_list[0]), execution=execution)
+    plan = MemoryPlan.from_args(args, nodes=sum(sizes), samples=len(functloader.dataset), batch_size=functloader.batch_size).report()
+    telemetry.write('plan', **plan.summary())
+    # outside the dense mode the activations and adjacency are the arrays that barely fit, so only diagrams are cached
+    cache_arrays = plan.mode == 'dense'
+
+    ''' Load checkpoint and get activations '''
+    diagrams = {}
+    with torch.no_grad():
+        total_time = 0.
+        passer = Passer(net, functloader, criterion, device_list[0], execution=execution)
+
+        epoch_iter = iter(vars(args)['chkpt_epochs'])
+        for epoch in epoch_iter:
+            if args.resume and (epoch <= args.resume_epoch):
+                continue
+
+            # artifacts of an epoch are keyed by the checkpoint bytes and every setting that changes them
+            ckpt_file = f'./checkpoint/{args.net}/{ONAME}/ckpt_epoch_{epoch}.pt'
+            ckpt_hash = file_hash(ckpt_file) if os.path.exists(ckpt_file) else None
+            keys = stage_keys(ckpt_hash, sample_manifest['hash'], test_transform, repr(net), execution,
+                              args.reduction, args.exp, args.metric, UPPER_DIM, max_edges=plan.max_edges) if artifacts is not None and ckpt_hash is not None else None
+
+            cached = artifacts.load(keys['diagram']) if keys is not None else None
+            if cached is not None:
+                print(f'\n==> Using cached diagram for epoch {epoch}...\n')
+                save_diagram(cached['dgm'], pkl_folder, epoch)
+                diagrams[epoch] = cached['dgm']
+                continue
+
+            adj, activs = None, None
+            cached = artifacts.load(keys['adjacency']) if keys is not None else None
+            if cached is not None:
+                print(f'\n==> Using cached adjacency for epoch {epoch}...\n')
+                adj = torch.tensor(cached['adj'], device=device_list[0])
             else:
-                print(f'adj empty! \n')
-
-        # Compute persistence diagram
-        comp_time = time.time()
-        dgm = ripser_parallel(adj, metric="precomputed", maxdim=UPPER_DIM, n_threads=-1, collapse_edges=True)
-        comp_time = time.time() - comp_time
-        total_time += comp_time
-        print(f'\n PH computation time: {comp_time/60:.2f} minutes \n')
-
-        # free GPU memory
-        del activs, adj, comp_time
-        torch.cuda.empty_cache()
-
-        dgm_gtda = _postprocess_diagrams([dgm["dgms"]], format="ripser", homology_dimensions=range(UPPER_DIM + 1), infinity_values=np.inf, reduced=True)[0]
-
-        dgm_pkl_file = os.path.join(pkl_folder, f'dgm_epoch_{epoch}.pkl')
-        if not os.path.exists(os.path.dirname(dgm_pkl_file)):
-            os.makedirs(os.path.dirname(dgm_pkl_file))
-        with open(dgm_pkl_file, 'wb') as f:
-            pickle.dump(dgm_gtda, f, protocol=pickle.HIGHEST_PROTOCOL)
-
-        del dgm, dgm_gtda
-
-    print(f'\n Total computation time: {total_time/60:.2f} minutes \n')
-
-    time_pkl_file = os.path.join(pkl_folder, f'time.pkl')
-    if not os.path.exists(os.path.dirname(time_pkl_file)):
-        os.makedirs(os.path.dirname(time_pkl_file))
-    with open(time_pkl_file, 'ab') as f:
-        pickle.dump(total_time, f, protocol=pickle.HIGHEST_PROTOCOL)
-
-    del passer, net, criterion, functloader, total_time, checkpoint
+                cached = artifacts.load(keys['activations']) if keys is not None else None
+                if cached is not None:
+                    print(f'\n==> Using cached activations for epoch {epoch}...\n')
+                    activs = cached['activs']
+            del cached
+
+            if adj is None and activs is None:
+                # activations captured by train.py from this checkpoint on the same samples replace the checkpoint load and forward pass
+                capture_mode, captured = load_capture(CAPTURE_DIR, epoch, sample_manifest['hash'], ckpt_hash, execution, metric=args.metric, reduction=args.reduction)
+                if capture_mode == 'pearson':
+                    print(f'\n==> Using captured correlations for epoch {epoch}...\n')
+                    adj = torch.tensor(captured, device=device_list[0])
+                elif capture_mode == 'features':
+                    print(f'\n==> Using captured activations for epoch {epoch}...\n')
+                    with stage(telemetry, 'extraction', epoch, source='capture'):
+                        activs = passer.reduce(np.asarray(captured, dtype=np.float32), reduction=args.reduction, device_list=device_list, corr=args.metric if args.metric is not None else 'pearson', exp=args.exp)
+                else:
+                    print(f'\n==> Loading checkpoint for epoch {epoch}...\n')
+                    assert os.path.isdir('./checkpoint'), 'Error: no checkpoint directory found!'
+
+                    checkpoint = load_checkpoint(ckpt_file, map_location=device_list[0])
+
+                    net.load_state_dict(checkpoint['net'])
+                    net.requires_grad_(False)
+                    net.eval()
+                    del checkpoint
+
+                    ''' Get activations '''
+                    # get activations and reduce dimensionality
+                    with stage(telemetry, 'extraction', epoch, source='checkpoint'):
+                        if plan.mode == 'streaming':
+                            # correlation accumulated batch by batch; the activations are never held at once
+                            adj = passer.get_correlation().to(device_list[0])
+                        else:
+                            activs = passer.get_function(reduction=args.reduction, device_list=device_list, corr=args.metric if args.metric is not None else 'pearson', exp=args.exp)
+                del captured
+
+                if activs is not None and keys is not None and cache_arrays:
+                    artifacts.save(keys['activations'], activs=activs.numpy(force=True) if torch.is_tensor(activs) else np.asarray(activs))
+
+            if adj is None:
+                # compute distance adjacency matrix
+                with stage(telemetry, 'adjacency', epoch) as record:
+                    adj = adjacency(activs, metric=args.metric, device=device_list[0], tile=plan.tile)
+                    record['nodes'] = adj.shape[0]
+            del activs
+
+            # correlation_diagram modifies adj in place, so it is stored before
+            if keys is not None and cache_arrays and keys['adjacency'] not in artifacts:
+                artifacts.save(keys['adjacency'], adj=adj.numpy(force=True))
+
+            if args.verbose:
+                print(f'\n The dimension of the corrcoef matrix is {adj.size()[0], adj.size()[-1]} \n')
+                print(f'Adj mean {adj.mean():.4f}, min {adj.min():.4f}, max {adj.max():.4f} \n')
+
+            # Compute persistence diagram
+            dgm, comp_time = correlation_diagram(adj, maxdim=UPPER_DIM, n_threads=concurrency.ripser, verbose=args.verbose, telemetry=telemetry, epoch=epoch,
+                                                 tile=plan.tile, max_edges=plan.max_edges)
+            total_time += comp_time
+            print(f'\n PH computation time: {comp_time/60:.2f} minutes \n')
+
+            # free GPU memory
+            del adj, comp_time
+            torch.cuda.empty_cache()
+
+            save_diagram(dgm, pkl_folder, epoch)
+            if keys is not None:
+                artifacts.save(keys['diagram'], dgm=np.asarray(dgm))
+            diagrams[epoch] = dgm
+
+            del dgm
+
+        print(f'\n Total computation time: {total_time/60:.2f} minutes \n')
+
+        save_time(total_time, pkl_folder)
+        concurrency.report()
+
+        del passer, net, criterion, functloader, total_time
+
+    return {'diagrams': diagrams}
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,105 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+def hash_parts(*parts):
+    ''' Content hash of arrays, strings and numbers; used as cache keys. '''
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            h.update(f'{part.dtype}{part.shape}'.encode())
+            h.update(part.tobytes())
+        elif isinstance(part, bytes):
+            h.update(part)
+        else:
+            h.update(repr(part).encode())
+        h.update(b'|')
+
+    return h.hexdigest()
+
+def file_hash(path, chunk_size=1 << 20):
+    ''' Content hash of a file, e.g. a checkpoint, read in chunks. '''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+def stage_keys(checkpoint_hash, manifest_hash, transform, layers, execution=None, reduction=None, exp=1, metric=None, maxdim=1, max_edges=None):
+    ''' Cache keys of the activations, adjacency and diagram built from one checkpoint. Each key extends the key
+    of the stage before it, so changing the metric reuses the activations and changing PH parameters the adjacency.
+    max_edges: edge cap of an approximate diagram (memory.MemoryPlan). '''
+    activations = hash_parts('activations', checkpoint_hash, manifest_hash, repr(transform), layers, repr(execution), reduction, exp)
+    adj = hash_parts('adjacency', activations, metric)
+    dgm = hash_parts('diagram', adj, maxdim) if max_edges is None else hash_parts('diagram', adj, maxdim, max_edges)
+
+    return {'activations': activations, 'adjacency': adj, 'diagram': dgm}
+
+
+class ArtifactCache():
+    ''' Directory of .npz artifacts addressed by content hash. With max_bytes, the least recently used artifacts are
+    evicted once the directory grows beyond it, and artifacts larger than max_bytes are not stored at all. '''
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f'{key}.npz')
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def load(self, key):
+        ''' Return the dict of arrays stored under key, or None on a miss. '''
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            arrays = {k: data[k] for k in data.files}
+        if self.max_bytes is not None:
+            # the modification time orders eviction
+            os.utime(path)
+
+        return arrays
+
+    def save(self, key, **arrays):
+        ''' Store arrays under key; written to a temporary file and renamed so readers never see partial files. '''
+        if self.max_bytes is not None and sum(np.asarray(a).nbytes for a in arrays.values()) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def evict(self, max_bytes):
+        ''' Remove the least recently used artifacts until the directory holds at most max_bytes. '''
+        files = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith('.npz'):
+                    try:
+                        st = os.stat(os.path.join(dirpath, name))
+                    except FileNotFoundError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, os.path.join(dirpath, name)))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,159 @@
+''' Activation capture on the live model during training.
+
+At checkpoint epochs train.py runs the functional subset through the network right after the test pass and
+streams either
+    features: the (samples, features) float32 activations of forward_features, or
+    pearson:  the (features, features) correlation matrix from running co-moments,
+to CAPTURE_DIR. build_graph_functional.py uses a capture made with the same sample manifest, from the same
+checkpoint bytes and under the same execution mode instead of loading the checkpoint and repeating the forward pass.
+The metadata of a capture records the hash of its checkpoint, so it is written once the checkpoint is on disk:
+right away, or at finalize() after the pending writes of an asynchronous checkpoint writer.
+'''
+import json
+import os
+
+import numpy as np
+import torch
+
+from cache import file_hash
+from execution import ExecutionMode
+from utils import progress_bar
+
+CAPTURE_MODES = ('features', 'pearson')
+
+
+def capture_dir(net, dataset, iter=0, seed=None):
+    folder = f'./activations/{net}/{net}_{dataset}_ss{iter}' if dataset == 'imagenet' else f'./activations/{net}/{net}_{dataset}'
+    return folder + (f'_seed{seed}' if seed is not None else '')
+
+def _flat_features(net, inputs):
+    ''' forward_features of a batch as one (batch, features) tensor, layers in the order of graph.signal_concat '''
+    return torch.cat([f.float().reshape(f.shape[0], -1) for f in net.forward_features(inputs)], dim=1)
+
+
+class RunningPearson():
+    ''' Correlation matrix of streamed (batch, features) blocks from running mean and co-moments
+    (pairwise update of Chan et al.), in float64 on the device of the batches. '''
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.comoment = None
+
+    def update(self, x):
+        x = x.to(torch.float64)
+        nb = x.shape[0]
+        mb = x.mean(dim=0)
+        xc = x - mb
+        cb = xc.T @ xc
+
+        if self.n == 0:
+            self.mean, self.comoment = mb, cb
+        else:
+            n = self.n + nb
+            delta = mb - self.mean
+            self.comoment += cb + torch.outer(delta, delta) * (self.n * nb / n)
+            self.mean += delta * (nb / n)
+        self.n += nb
+
+    def corrcoef(self):
+        ''' As torch.nan_to_num(torch.corrcoef(features x samples)) '''
+        std = torch.sqrt(torch.diagonal(self.comoment))
+        corr = self.comoment / torch.outer(std, std)
+
+        return torch.nan_to_num(corr.clamp(-1., 1.))
+
+
+class ActivationCapture():
+    def __init__(self, loader, out_dir, mode='features', manifest_hash=None, device=torch.device('cpu'), execution=None):
+        if mode not in CAPTURE_MODES:
+            raise ValueError(f'Capture mode {mode} not supported! Use one of {CAPTURE_MODES}')
+
+        self.loader = loader
+        self.out_dir = out_dir
+        self.mode = mode
+        self.manifest_hash = manifest_hash
+        self.device = device
+        self.execution = execution if execution is not None else ExecutionMode(device=device)
+        self.pending = []
+        os.makedirs(out_dir, exist_ok=True)
+
+    @torch.no_grad()
+    def capture(self, net, epoch, checkpoint=None, deferred=False):
+        ''' Run the subset through net in eval mode and write the capture for epoch; the train/eval mode of net is restored.
+        checkpoint: file of the weights of net; deferred: its write is still pending, so the metadata waits for finalize().
+        return: path of the capture. '''
+        training = net.training
+        net.eval()
+
+        fl = os.path.join(self.out_dir, f'{self.mode}_epoch_{epoch}.npy')
+        tmp = f'{fl}.{os.getpid()}.tmp'
+        # the metadata of an earlier capture must not describe this one
+        meta_fl = os.path.join(self.out_dir, f'{self.mode}_epoch_{epoch}.json')
+        if os.path.exists(meta_fl):
+            os.remove(meta_fl)
+        n_samples = len(self.loader.dataset)
+
+        out, stats, row = None, RunningPearson(), 0
+        for batch_idx, (inputs, _) in enumerate(self.loader):
+            with self.execution.autocast():
+                feats = _flat_features(net, self.execution.inputs(inputs.to(self.device)))
+            assert not torch.isnan(feats).any(), 'NaN in forward_features at capture.py:capture()'
+
+            if self.mode == 'features':
+                if out is None:
+                    out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(n_samples, feats.shape[1]))
+                out[row:row+feats.shape[0]] = feats.cpu().numpy().astype(np.float32)
+            else:
+                stats.update(feats)
+            row += feats.shape[0]
+
+            progress_bar(batch_idx, len(self.loader))
+
+        if self.mode == 'features':
+            out.flush()
+            del out
+            if row != n_samples:
+                # the loader dropped a last incomplete batch; keep only the rows that were written
+                written = np.load(tmp, mmap_mode='r')[:row]
+                np.save(f'{tmp}.rows', written)
+                del written
+                os.replace(f'{tmp}.rows.npy', tmp)
+        else:
+            with open(tmp, 'wb') as f:
+                np.save(f, stats.corrcoef().cpu().numpy().astype(np.float32))
+        os.replace(tmp, fl)
+
+        self.pending.append((meta_fl, checkpoint, {'epoch': int(epoch), 'mode': self.mode, 'samples': row, 'manifest': self.manifest_hash,
+                                                   'execution': repr(self.execution)}))
+        if not deferred:
+            self.finalize()
+
+        net.train(training)
+
+        return fl
+
+    def finalize(self):
+        ''' Write the metadata of the pending captures with the hash of their checkpoints, which must be on disk '''
+        for meta_fl, checkpoint, meta in self.pending:
+            meta['checkpoint'] = file_hash(checkpoint) if checkpoint is not None and os.path.exists(checkpoint) else None
+            with open(meta_fl, 'w') as f:
+                json.dump(meta, f)
+        self.pending = []
+
+def load_capture(out_dir, epoch, manifest_hash, checkpoint_hash, execution, metric=None, reduction=None):
+    ''' Return (mode, array) of the capture usable for this epoch and graph settings, or (None, None).
+    Only captures of the same samples, checkpoint bytes and execution mode qualify; correlation captures only stand
+    in for the default Pearson adjacency without reduction, feature captures replace the forward pass for any
+    metric or reduction. '''
+    modes = ['pearson', 'features'] if metric is None and reduction is None else ['features']
+    for mode in modes:
+        meta_fl = os.path.join(out_dir, f'{mode}_epoch_{epoch}.json')
+        if not os.path.exists(meta_fl):
+            continue
+        with open(meta_fl, 'r') as f:
+            meta = json.load(f)
+        if (meta['manifest'] == manifest_hash and checkpoint_hash is not None and meta.get('checkpoint') == checkpoint_hash
+                and meta.get('execution') == repr(execution)):
+            return mode, np.load(os.path.join(out_dir, f'{mode}_epoch_{epoch}.npy'), mmap_mode='r' if mode == 'features' else None)
+
+    return None, None
@@ -1,13 +1,14 @@
 import argparse
 import os
-import pickle
 import itertools
 
 import numpy as np
-import torch
-import plotly.express as px
-from gtda.diagrams import Filtering, BettiCurve, PairwiseDistance
+
+from concurrency import Concurrency, add_concurrency_args
 from config import UPPER_DIM
+from distances import DIAGRAM_METRICS, cross_diagram_distances, pairwise_diagram_distances
+from render import FigureRenderer, add_render_args
+from topology import load_diagrams, process_diagrams
 
 
 parser = argparse.ArgumentParser(description='Post-process diagrams')
@@ -20,6 +21,12 @@ parser.add_argument('--stop_iter', default=None, type=int, help='Subset index to
 parser.add_argument('--chkpt_epochs', nargs='+', action='extend', default=[], type=int)
 parser.add_argument('--reduction', default=None, type=str, help='Reductions: "pca" or "umap"')
 parser.add_argument('--metric', default=None, type=str, help='Distance metric: "spearman", "dcorr".')
+parser.add_argument('--distance', default='betti', type=str, help=f'Distance between runs: "betti" (sup-norm between Betti curves) or one of {DIAGRAM_METRICS}.')
+parser.add_argument('--order', default=1., type=float, help='Order p of the Wasserstein distance.')
+parser.add_argument('--n_jobs', default=None, type=int, help='Processes used for diagram distances; default: the core budget.')
+add_render_args(parser)
+add_concurrency_args(parser)
+parser.add_argument('--cache_dir', default='./cache/curves', type=str, help='Directory caching curves keyed by diagram hash; "none" disables caching.')
 
 args = parser.parse_args()
 
@@ -31,12 +38,21 @@ STOP = args.stop_iter
 EPOCHS = args.chkpt_epochs
 RED = args.reduction
 METRIC = args.metric
+CACHE_DIR = None if args.cache_dir.lower() == 'none' else args.cache_dir
+DISTANCE = args.distance
+DIST_CACHE_DIR = os.path.join(os.path.dirname(CACHE_DIR), 'distances') if CACHE_DIR is not None else None
+
+concurrency = Concurrency.from_args('post_process', args).apply()
 
 SAVE_DIR = args.save_dir
 if len(NET) == 1:
     SAVE_DIR = os.path.join(SAVE_DIR, f'{NET[0]}_{DATASET}_comp')
 else:
     SAVE_DIR = os.path.join(SAVE_DIR, f'{NET[0]}_{NET[-1]}_{DATASET}_comp')
+if DISTANCE != 'betti':
+    if DISTANCE not in DIAGRAM_METRICS:
+        raise ValueError(f'Distance {DISTANCE} not supported!')
+    SAVE_DIR = os.path.join(SAVE_DIR, DISTANCE)
 print(f'\n ==> Save directory: {SAVE_DIR}')
 
 if not os.path.exists(SAVE_DIR):
@@ -50,36 +66,31 @@ SS_EPOCH_COMP_DIR = os.path.join(SAVE_DIR, 'subset_epoch_comp')
 if not os.path.exists(SS_EPOCH_COMP_DIR):
     os.makedirs(SS_EPOCH_COMP_DIR)
 
-# Initialize device and GTDA transformers
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 n_bins = 100
-dgm_filter = Filtering(epsilon=0.02125)
-curve = BettiCurve(n_bins=n_bins, n_jobs=-1)
+epsilon = 0.02125
+samplings = np.linspace(0, 1, n_bins)
 
 def get_epoch_curves(net, dataset, start, stop):
-    curve_dict = {}
-    for i in range(start, stop+1):
-        print(f'\nProcessing subset {i}:')
+    print(f'\nLoading diagrams of subsets {start}-{stop}')
+    runs = [(i, epoch) for i in range(start, stop+1) for epoch in EPOCHS]
 
+    pkl_files = []
+    for i, epoch in runs:
         pkl_folder = f'./losses/{net}/{net}_{dataset}_ss{i}' if dataset == 'imagenet' else f'./losses/{net}/{net}_{dataset}'
         pkl_folder += f'/{RED}' if RED is not None else ''
         pkl_folder += f'/{METRIC}' if METRIC is not None else ''
+        pkl_files.append(os.path.join(pkl_folder, f'dgm_epoch_{epoch}.pkl'))
 
-        epoch_dict = {}
-        for epoch in EPOCHS:
-            print(f'==> Processing epoch {epoch}')
-
-            pkl_fl = os.path.join(pkl_folder, f'dgm_epoch_{epoch}.pkl')
-            try:
-                with open(pkl_fl, 'rb') as f:
-                    dgm_gtda = pickle.load(f)
-                dgm_gtda = dgm_filter.fit_transform([dgm_gtda])
-                epoch_dict[epoch] = curve.fit_transform(dgm_gtda).squeeze()
-            except:
-                raise FileNotFoundError(f'Error loading {pkl_fl}')
-        curve_dict[i] = epoch_dict
-    
-    return curve_dict
+    # filter and compute the curves of every subset and epoch in one batched call
+    topo = process_diagrams(load_diagrams(pkl_files), samplings, homology_dimensions=range(UPPER_DIM+1), epsilon=epsilon, cache_dir=CACHE_DIR)
+
+    curve_dict = {i: {} for i in range(start, stop+1)}
+    dgm_dict = {i: {} for i in range(start, stop+1)}
+    for k, (i, epoch) in enumerate(runs):
+        curve_dict[i][epoch] = topo['curves'][k]
+        dgm_dict[i][epoch] = topo['filtered'][k]
+
+    return curve_dict, dgm_dict
 
 def compute_net_epoch_distances(epoch_dict_1, epoch_dict_2, start, stop, epochs, permute=True):
     ''' Compute pairwise distances across epochs for networks using the same subsets;
@@ -90,6 +101,9 @@ def compute_net_epoch_distances(epoch_dict_1, epoch_dict_2, start, stop, epochs,
     epochs: list of epochs to compute distances for
     return: list of normalized pairwise distances across networks for each subset
     '''
+    import torch
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
     dist_list = []
     for i in range(start, stop+1):
         dgm_1 = np.array([epoch_dict_1[i][epoch] for epoch in epochs], dtype=np.float32)
@@ -116,6 +130,9 @@ def compute_net_subset_distances(epoch_dict_1, epoch_dict_2, start, stop, epochs
     epochs: list of epochs to compute distances for
     return: list of normalized pairwise distances across networks for each epoch
     '''
+    import torch
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
     dist_list_ss = []
     for epoch in epochs:
         dgm_1 = np.array([epoch_dict_1[i][epoch] for i in range(start, stop+1)], dtype=np.float32)
@@ -133,8 +150,40 @@ def compute_net_subset_distances(epoch_dict_1, epoch_dict_2, start, stop, epochs
     
     return dist_list_ss
 
+def compute_diagram_distances(dgm_dict_1, dgm_dict_2, start, stop, epochs):
+    ''' Compute diagram distances between all runs (net x subset x epoch) of both networks in one blocked, cached call;
+    dgm_dict_1: dictionary of filtered diagrams for each subset and epoch
+    dgm_dict_2: dictionary of filtered diagrams for each subset and epoch
+    return: lists of pairwise distances across epochs for each subset and across subsets for each epoch,
+    shaped like the outputs of compute_net_epoch_distances and compute_net_subset_distances
+    '''
+    subsets = list(range(start, stop+1))
+    runs_1 = [(i, epoch) for i in subsets for epoch in epochs]
+    dgms_1 = [dgm_dict_1[i][epoch] for i, epoch in runs_1]
+    settings = {'metric': DISTANCE, 'order': args.order, 'n_jobs': args.n_jobs if args.n_jobs is not None else concurrency.joblib, 'cache_dir': DIST_CACHE_DIR}
+
+    # two nets only read the block between them
+    if dgm_dict_2 is not dgm_dict_1:
+        dgms_2 = [dgm_dict_2[i][epoch] for i, epoch in runs_1]
+        dist = cross_diagram_distances(dgms_1, dgms_2, range(UPPER_DIM+1), **settings)
+    else:
+        dist = pairwise_diagram_distances(dgms_1, range(UPPER_DIM+1), **settings)
+
+    idx = {run: k for k, run in enumerate(runs_1)}
+    dist_list, dist_list_ss = [], []
+    for i in subsets:
+        rows = np.array([idx[(i, epoch)] for epoch in epochs])
+        dist_list.append(dist[:, rows[:, None], rows[None, :]])
+    for epoch in epochs:
+        rows = np.array([idx[(i, epoch)] for i in subsets])
+        dist_list_ss.append(dist[:, rows[:, None], rows[None, :]])
+
+    return dist_list, dist_list_ss
+
 def vis_across_epochs(dist_list, two_nets=False):
     ''' Visualize the distances across epochs for every subset for each net's distances in dist_lists '''
+    import plotly.express as px
+
     mean_dist_mat = np.mean(np.array(dist_list), axis=0)
     for dim in range(UPPER_DIM+1):
         mean_fig = px.imshow(mean_dist_mat[dim],
@@ -146,7 +195,7 @@ def vis_across_epochs(dist_list, two_nets=False):
                         height=800)
         filename = f'net_' if two_nets else ''
         filename += f'avg_dist_dim{dim}.png'
-        mean_fig.write_image(os.path.join(EPOCH_COMP_DIR, filename), format='png')
+        renderer.submit(mean_fig, os.path.join(EPOCH_COMP_DIR, filename))
         
         for i,dist_mat in enumerate(dist_list):
             fig = px.imshow(dist_mat[dim],
@@ -158,9 +207,11 @@ def vis_across_epochs(dist_list, two_nets=False):
                             height=800)
             filename = f'net_' if two_nets else ''
             filename += f'dist_ss{i}_dim{dim}.png'
-            fig.write_image(os.path.join(EPOCH_COMP_DIR, filename), format='png')
+            renderer.submit(fig, os.path.join(EPOCH_COMP_DIR, filename))
 
 def vis_across_subsets(dist_list_ss, two_nets=False):
+    import plotly.express as px
+
     mean_dist_mat = np.mean(np.array(dist_list_ss), axis=0)
     for dim in range(UPPER_DIM+1):
         mean_fig = px.imshow(mean_dist_mat[dim],
@@ -170,7 +221,7 @@ def vis_across_subsets(dist_list_ss, two_nets=False):
                         height=900)
         filename = f'net_' if two_nets else ''
         filename += f'avg_dist_dim{dim}.png'
-        mean_fig.write_image(os.path.join(SS_EPOCH_COMP_DIR, filename), format='png')
+        renderer.submit(mean_fig, os.path.join(SS_EPOCH_COMP_DIR, filename))
         
         for i,dist_mat in enumerate(dist_list_ss):
             fig = px.imshow(dist_mat[dim],
@@ -180,23 +231,36 @@ def vis_across_subsets(dist_list_ss, two_nets=False):
                             height=900)
             filename = f'net_' if two_nets else ''
             filename += f'dist_epoch{EPOCHS[i]}_dim{dim}.png'
-            fig.write_image(os.path.join(SS_EPOCH_COMP_DIR, filename), format='png')
+            renderer.submit(fig, os.path.join(SS_EPOCH_COMP_DIR, filename))
 
 
 # Load the betti curves
 net_dict_list = []
+net_dgm_list = []
 for net in NET:
-    # each dictionary contains betti curves for each epoch in a specific subset
+    # each dictionary contains betti curves (diagrams) for each epoch in a specific subset
     print(f'\nProcessing network {net}')
-    net_dict_list.append(get_epoch_curves(net, DATASET, START, STOP))
+    curve_dict, dgm_dict = get_epoch_curves(net, DATASET, START, STOP)
+    net_dict_list.append(curve_dict)
+    net_dgm_list.append(dgm_dict)
 
-# Compute pairwise distances across epochs for different networks using the same subsets
-print(f'\nProcessing networks {NET[0]} and {NET[-1]} across epochs')
-dist_list = compute_net_epoch_distances(net_dict_list[0], net_dict_list[-1], START, STOP, EPOCHS)
-    
-print(f'\nProcessing networks {NET[0]} and {NET[-1]} across subsets')
-dist_list_ss = compute_net_subset_distances(net_dict_list[0], net_dict_list[-1], START, STOP, EPOCHS)
+if DISTANCE == 'betti':
+    # Compute pairwise distances across epochs for different networks using the same subsets
+    print(f'\nProcessing networks {NET[0]} and {NET[-1]} across epochs')
+    dist_list = compute_net_epoch_distances(net_dict_list[0], net_dict_list[-1], START, STOP, EPOCHS)
+
+    print(f'\nProcessing networks {NET[0]} and {NET[-1]} across subsets')
+    dist_list_ss = compute_net_subset_distances(net_dict_list[0], net_dict_list[-1], START, STOP, EPOCHS)
+else:
+    print(f'\nProcessing {DISTANCE} distances between networks {NET[0]} and {NET[-1]}')
+    dist_list, dist_list_ss = compute_diagram_distances(net_dgm_list[0], net_dgm_list[-1], START, STOP, EPOCHS)
+
+# Save the distances; figures below only depend on these
+np.savez(os.path.join(SAVE_DIR, 'distances.npz'), epochs=np.array(EPOCHS), dist_epochs=np.array(dist_list), dist_subsets=np.array(dist_list_ss))
 
 # Make visualizations
+renderer = FigureRenderer(args.render, n_workers=args.render_workers if args.render_workers is not None else concurrency.render, manifest=args.render_manifest, save_dir=SAVE_DIR)
 vis_across_epochs(dist_list, two_nets=(len(NET) > 1))
 vis_across_subsets(dist_list_ss, two_nets=(len(NET) > 1))
+renderer.close()
+concurrency.report()
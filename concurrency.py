@@ -0,0 +1,91 @@
+''' One core budget per run, divided among the libraries that start threads or worker processes.
+
+The budget is --cores, else the DNN_TOPOLOGY_CORES environment variable, else the cores this process may
+run on (its affinity mask, as set by SLURM, taskset or scripts/scheduler.py). Within a stage:
+    train:        data loader workers get a quarter of the budget (at most 4), torch the rest
+    build_graph:  torch, BLAS/OpenMP and ripser each get the whole budget; they run one after the other
+    post_process: joblib workers get the whole budget, figure rendering up to half of it
+BLAS and OpenMP pools already loaded are limited through threadpoolctl; joblib/loky through LOKY_MAX_CPU_COUNT.
+report() prints the CPU time used against the budget, so oversubscribed or idle runs show up in the logs.
+'''
+import os
+import resource
+import time
+
+BUDGET_ENV = 'DNN_TOPOLOGY_CORES'
+STAGES = ('train', 'build_graph', 'post_process')
+
+
+def add_concurrency_args(parser):
+    parser.add_argument('--cores', default=None, type=int, help=f'Core budget of this run; default: {BUDGET_ENV} or the cores this process may run on.')
+
+def available_cores():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+
+def core_budget(cores=None):
+    ''' Cores of this run; never more than the process may run on '''
+    n_available = len(available_cores())
+    cores = cores if cores is not None else int(os.environ.get(BUDGET_ENV, n_available))
+    if cores < 1:
+        raise ValueError(f'Core budget must be at least 1, got {cores}')
+
+    return min(cores, n_available)
+
+
+class Concurrency():
+    def __init__(self, stage, cores=None):
+        if stage not in STAGES:
+            raise ValueError(f'Stage {stage} not supported! Use one of {STAGES}')
+
+        self.stage = stage
+        self.cores = core_budget(cores)
+        self.loader = min(4, self.cores // 4) if stage == 'train' else 0
+        self.torch = max(1, self.cores - self.loader)
+        self.ripser = self.cores
+        self.joblib = self.cores
+        self.render = max(1, min(4, self.cores // 2))
+
+        self.wall = None
+        self.cpu = None
+
+    @classmethod
+    def from_args(cls, stage, args):
+        return cls(stage, cores=args.cores)
+
+    def __repr__(self):
+        return f'Concurrency({self.stage}: {self.cores} cores; torch {self.torch}, loader {self.loader}, ripser {self.ripser}, joblib {self.joblib}, render {self.render})'
+
+    def apply(self):
+        ''' Limit the thread pools of this process and of the processes it starts; starts the utilisation clock. '''
+        threads = str(self.torch)
+        for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+            os.environ[var] = threads
+        os.environ['LOKY_MAX_CPU_COUNT'] = str(self.joblib)
+
+        import torch
+        from threadpoolctl import threadpool_limits
+        torch.set_num_threads(self.torch)
+        threadpool_limits(self.torch)
+
+        self.wall = time.time()
+        self.cpu = self._cpu_time()
+        print(self)
+
+        return self
+
+    @staticmethod
+    def _cpu_time():
+        ''' User and system time of this process and its waited-for children '''
+        usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        return sum(u.ru_utime + u.ru_stime for u in usage)
+
+    def utilisation(self):
+        ''' (cores used on average, fraction of the budget) since apply() '''
+        wall = max(time.time() - self.wall, 1e-9)
+        used = (self._cpu_time() - self.cpu) / wall
+
+        return used, used / self.cores
+
+    def report(self):
+        used, fraction = self.utilisation()
+        print(f'\n {self.stage}: used {used:.1f} of {self.cores} cores on average ({100*fraction:.0f}% utilisation) \n')
@@ -0,0 +1,152 @@
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from cache import ArtifactCache, hash_parts
+
+DIAGRAM_METRICS = ('bottleneck', 'wasserstein', 'sliced_wasserstein')
+
+
+def split_dimensions(dgm, homology_dimensions):
+    ''' Split a giotto-ph diagram into (n, 2) arrays of finite, non-degenerate pairs per dimension. '''
+    dgm = np.asarray(dgm, dtype=np.float64).reshape(-1, 3)
+    keep = np.isfinite(dgm[:, 1]) & (dgm[:, 1] > dgm[:, 0])
+
+    return [dgm[keep & (dgm[:, 2] == dim), :2] for dim in homology_dimensions]
+
+def sliced_wasserstein(dgm_1, dgm_2, n_directions=50):
+    ''' Sliced Wasserstein distance (Carriere et al., 2017) between two (n, 2) diagrams.
+    Each diagram is completed with the diagonal projections of the other so both have the same
+    number of points; the 1D Wasserstein distances of the projections are averaged over directions. '''
+    proj_1 = np.repeat(dgm_1.mean(axis=1, keepdims=True), 2, axis=1)
+    proj_2 = np.repeat(dgm_2.mean(axis=1, keepdims=True), 2, axis=1)
+    a = np.concatenate([dgm_1, proj_2], axis=0)
+    b = np.concatenate([dgm_2, proj_1], axis=0)
+
+    thetas = np.linspace(-np.pi/2, np.pi/2, n_directions, endpoint=False)
+    directions = np.stack([np.cos(thetas), np.sin(thetas)])
+    a = np.sort(a @ directions, axis=0)
+    b = np.sort(b @ directions, axis=0)
+
+    return np.mean(np.sum(np.abs(a - b), axis=0))
+
+def diagram_distance(dgm_1, dgm_2, metric='sliced_wasserstein', order=1., delta=0.01, n_directions=50):
+    ''' Distance between two (n, 2) diagrams of the same homology dimension. '''
+    if metric == 'sliced_wasserstein':
+        return sliced_wasserstein(dgm_1, dgm_2, n_directions=n_directions)
+
+    from gtda.externals import bottleneck_distance, wasserstein_distance
+
+    # hera takes empty diagrams but rejects points on the diagonal, so none are added
+    if metric == 'bottleneck':
+        return bottleneck_distance(dgm_1, dgm_2, delta=delta)
+    elif metric == 'wasserstein':
+        return wasserstein_distance(dgm_1, dgm_2, q=order, delta=delta)
+    else:
+        raise ValueError(f'Diagram metric {metric} not supported! Use one of {DIAGRAM_METRICS}')
+
+def _pairs(pairs, params):
+    ''' Distances of a list of (dgm_a, dgm_b) pairs of split diagrams; (len(pairs), n_dims). '''
+    out = np.zeros((len(pairs), len(pairs[0][0]) if len(pairs) > 0 else 0))
+    for p, (dgm_a, dgm_b) in enumerate(pairs):
+        for dim in range(out.shape[1]):
+            out[p, dim] = diagram_distance(dgm_a[dim], dgm_b[dim], **params)
+
+    return out
+
+def _row_key(params_key, key):
+    return hash_parts('diagram_distances', params_key, key)
+
+def _load_row(cache, params_key, key):
+    ''' Cached distances of one diagram as a dict: hash of the other diagram -> (n_dims,) array '''
+    row = cache.load(_row_key(params_key, key))
+    return {} if row is None else dict(zip(row['keys'].tolist(), row['dist']))
+
+def _evaluate(dgms, pairs, homology_dimensions, params, block_size=16, n_jobs=None, cache_dir=None):
+    ''' Distances of the index pairs into dgms for every homology dimension; dict (i, j) -> (n_dims,) array.
+    Pairs are evaluated on a process pool, block_size**2 per task. With cache_dir, every diagram has one ArtifactCache
+    entry, keyed by its hash and the parameters, with its distances to every diagram it was compared to; later calls
+    only evaluate the pairs not seen before, so adding runs is incremental. Entries are merged with a fresh read
+    before they are replaced, so concurrent runs at worst drop each other's latest pairs and compute them again. '''
+    homology_dimensions = list(homology_dimensions)
+    keys = [hash_parts(np.asarray(dgm)) for dgm in dgms]
+    params_key = hash_parts(sorted(params.items()), homology_dimensions)
+
+    # fill in what previous runs have already computed; identical diagrams are at distance 0
+    cache = ArtifactCache(cache_dir) if cache_dir is not None else None
+    rows = {key: _load_row(cache, params_key, key) for key in dict.fromkeys(keys[i] for i, _ in pairs)} if cache is not None else {}
+    out, missing = {}, []
+    for i, j in pairs:
+        if keys[i] == keys[j]:
+            out[(i, j)] = np.zeros(len(homology_dimensions))
+        elif keys[j] in rows.get(keys[i], {}):
+            out[(i, j)] = rows[keys[i]][keys[j]]
+        else:
+            missing.append((i, j))
+
+    chunk = block_size * block_size
+    tasks = [missing[k:k+chunk] for k in range(0, len(missing), chunk)]
+    print(f'Computing {params["metric"]} distances for {len(missing)} pairs of diagrams in {len(tasks)} tasks')
+    if len(tasks) == 0:
+        return out
+
+    split = {k: split_dimensions(dgms[k], homology_dimensions) for k in set(k for pair in missing for k in pair)}
+    n_jobs = n_jobs if n_jobs is not None else (os.cpu_count() or 1)
+    # fork: the calling scripts run at import time, so spawned workers would re-run them
+    method = 'fork' if 'fork' in mp.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(tasks)), mp_context=mp.get_context(method)) as pool:
+        futures = [(task, pool.submit(_pairs, [(split[i], split[j]) for i, j in task], params)) for task in tasks]
+        for task, future in futures:
+            out.update(zip(task, future.result()))
+
+    if cache is not None:
+        new = {}
+        for i, j in missing:
+            new.setdefault(keys[i], {})[keys[j]] = out[(i, j)]
+            new.setdefault(keys[j], {})[keys[i]] = out[(i, j)]
+        for key, entries in new.items():
+            row = _load_row(cache, params_key, key)
+            row.update(entries)
+            cache.save(_row_key(params_key, key), keys=np.array(list(row.keys())), dist=np.array(list(row.values())))
+
+    return out
+
+def pairwise_diagram_distances(dgms, homology_dimensions, metric='sliced_wasserstein', order=1., delta=0.01, n_directions=50,
+                               block_size=16, n_jobs=None, cache_dir=None):
+    ''' All-pairs diagram distances for every homology dimension; the upper triangle is evaluated and cached
+    as described in _evaluate.
+    return: (n_dims, n_dgms, n_dgms) array. '''
+    if metric not in DIAGRAM_METRICS:
+        raise ValueError(f'Diagram metric {metric} not supported! Use one of {DIAGRAM_METRICS}')
+
+    params = {'metric': metric, 'order': order, 'delta': delta, 'n_directions': n_directions}
+    n = len(dgms)
+    pairs = [(i, j) for i in range(n) for j in range(i + 1, n)]
+    out = _evaluate(dgms, pairs, homology_dimensions, params, block_size=block_size, n_jobs=n_jobs, cache_dir=cache_dir)
+
+    dist = np.zeros((len(list(homology_dimensions)), n, n))
+    for (i, j), d in out.items():
+        dist[:, i, j] = dist[:, j, i] = d
+
+    return dist
+
+def cross_diagram_distances(dgms_1, dgms_2, homology_dimensions, metric='sliced_wasserstein', order=1., delta=0.01, n_directions=50,
+                            block_size=16, n_jobs=None, cache_dir=None):
+    ''' Distances between every diagram of dgms_1 and every diagram of dgms_2 for every homology dimension, without
+    the pairs within either list; evaluated and cached as described in _evaluate.
+    return: (n_dims, len(dgms_1), len(dgms_2)) array. '''
+    if metric not in DIAGRAM_METRICS:
+        raise ValueError(f'Diagram metric {metric} not supported! Use one of {DIAGRAM_METRICS}')
+
+    params = {'metric': metric, 'order': order, 'delta': delta, 'n_directions': n_directions}
+    n_1, n_2 = len(dgms_1), len(dgms_2)
+    pairs = [(i, n_1 + j) for i in range(n_1) for j in range(n_2)]
+    out = _evaluate(list(dgms_1) + list(dgms_2), pairs, homology_dimensions, params, block_size=block_size, n_jobs=n_jobs, cache_dir=cache_dir)
+
+    dist = np.zeros((len(list(homology_dimensions)), n_1, n_2))
+    for (i, j), d in out.items():
+        dist[:, i, j - n_1] = d
+
+    return dist
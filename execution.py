@@ -0,0 +1,145 @@
+''' Execution modes for training and feature extraction of the model zoo on CPU-only nodes.
+
+    compile:       torch.compile of forward and forward_features
+    channels_last: NHWC memory format for the weights and inputs of convolutional nets
+    bf16:          bfloat16 autocast for forward passes; features are returned as float32
+
+Reduced precision perturbs the activations and hence the correlation graph, so a mode should be checked
+against eager fp32 on the Betti curves before it is used for topology results:
+    python execution.py --net lenet --dataset mnist --epoch 0 --bf16 1 --compile 1
+'''
+import argparse
+import contextlib
+import os
+import pickle
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from bettis import betti_curves
+from config import UPPER_DIM
+from graph import adjacency
+from topology import correlation_diagram, filter_diagrams
+
+
+def add_execution_args(parser):
+    parser.add_argument('--compile', default=0, type=int, help='torch.compile forward and forward_features.')
+    parser.add_argument('--channels_last', default=0, type=int, help='Channels-last memory format for conv nets.')
+    parser.add_argument('--bf16', default=0, type=int, help='bfloat16 autocast for forward passes.')
+
+
+class ExecutionMode():
+    def __init__(self, compile=False, channels_last=False, bf16=False, device=torch.device('cpu')):
+        self.compile = bool(compile)
+        self.channels_last = bool(channels_last)
+        self.bf16 = bool(bf16)
+        self.device_type = torch.device(device).type
+
+    @classmethod
+    def from_args(cls, args, device=torch.device('cpu')):
+        return cls(compile=args.compile, channels_last=args.channels_last, bf16=args.bf16, device=device)
+
+    def __repr__(self):
+        return f'ExecutionMode(compile={self.compile}, channels_last={self.channels_last}, bf16={self.bf16})'
+
+    def is_eager(self):
+        return not (self.compile or self.channels_last or self.bf16)
+
+    def apply(self, net):
+        ''' Prepare net in place. Compiled functions are set on the instance, so state dict keys are unchanged. '''
+        if self.channels_last and any(isinstance(m, nn.Conv2d) for m in net.modules()):
+            net.to(memory_format=torch.channels_last)
+        else:
+            self.channels_last = False
+        if self.compile:
+            net.forward = torch.compile(net.forward)
+            net.forward_features = torch.compile(net.forward_features)
+
+        return net
+
+    def inputs(self, x):
+        return x.contiguous(memory_format=torch.channels_last) if self.channels_last and x.dim() == 4 else x
+
+    def autocast(self):
+        if not self.bf16:
+            return contextlib.nullcontext()
+
+        return torch.autocast(device_type=self.device_type, dtype=torch.bfloat16)
+
+
+@torch.no_grad()
+def subset_features(net, loader, execution=None, device=torch.device('cpu')):
+    ''' (samples, features) float32 activations of forward_features over loader '''
+    execution = execution if execution is not None else ExecutionMode(device=device)
+    net.eval()
+
+    features = []
+    for inputs, _ in loader:
+        with execution.autocast():
+            feats = net.forward_features(execution.inputs(inputs.to(device)))
+        features.append(torch.cat([f.float().reshape(f.shape[0], -1) for f in feats], dim=1).cpu().numpy())
+
+    return np.concatenate(features)
+
+def betti_equivalence(net, loader, execution, device=torch.device('cpu'), n_bins=100, epsilon=0.02125, maxdim=UPPER_DIM):
+    ''' Compare the node-normalised Betti curves of the correlation graph of net under execution with eager fp32.
+    net must be an eager model; it is used for the reference before being prepared with execution.
+    return: dict with the max absolute difference of the curves per dimension, of the activations and of the adjacency. '''
+    samplings = np.linspace(0, 1, n_bins)
+
+    results = []
+    for mode in (ExecutionMode(device=device), execution):
+        feats = subset_features(mode.apply(net), loader, execution=mode, device=device)
+        adj = adjacency(feats.T, metric=None, device=device)
+        corr = adj.numpy(force=True).copy()
+
+        dgm, _ = correlation_diagram(adj, maxdim=maxdim)
+        dgm = filter_diagrams([dgm], epsilon)[0]
+        nodes = max(int(np.sum(dgm[:, 2] == 0)), 1)
+        curves = betti_curves([dgm], samplings, homology_dimensions=range(maxdim + 1))[0] / nodes
+        results.append((feats, corr, curves))
+
+    (feats_ref, corr_ref, curves_ref), (feats, corr, curves) = results
+
+    return {'curves': np.abs(curves - curves_ref).max(axis=1),
+            'features': float(np.abs(feats - feats_ref).max()),
+            'adjacency': float(np.abs(corr - corr_ref).max())}
+
+
+if __name__ == '__main__':
+    from loaders import loader, manifest_file
+    from models.utils import get_model
+    from savers import load_checkpoint
+
+    parser = argparse.ArgumentParser(description='Check an execution mode against eager fp32 on the Betti curves')
+    parser.add_argument('--net')
+    parser.add_argument('--dataset')
+    parser.add_argument('--iter', default=0, type=int)
+    parser.add_argument('--epoch', default=0, type=int, help='Checkpoint epoch to compare on.')
+    parser.add_argument('--subset', default=500, type=int)
+    parser.add_argument('--stratified', default=0, type=int)
+    parser.add_argument('--tol', default=0.05, type=float, help='Largest accepted difference of the normalised Betti curves.')
+    add_execution_args(parser)
+    args = parser.parse_args()
+
+    ONAME = f'{args.net}_{args.dataset}_ss{args.iter}' if args.dataset == 'imagenet' else f'{args.net}_{args.dataset}'
+    TRANS_DIR = f'./train_processing/{args.net}/{ONAME}'
+    device = torch.device('cpu')
+
+    net = get_model(args.net, args.dataset)
+    net.load_state_dict(load_checkpoint(f'./checkpoint/{args.net}/{ONAME}/ckpt_epoch_{args.epoch}.pt', map_location=device)['net'])
+
+    with open(os.path.join(TRANS_DIR, 'test_transform.pkl'), 'rb') as f:
+        test_transform = pickle.load(f)
+    functloader, _ = loader(f'{args.dataset}_test', batch_size=100, iter=args.iter, subset=args.subset, verbose=False, transform=test_transform,
+                            manifest=manifest_file(TRANS_DIR, args.subset, args.stratified), stratified=args.stratified)
+
+    execution = ExecutionMode.from_args(args, device=device)
+    diffs = betti_equivalence(net, functloader, execution, device=device)
+
+    print(f'{execution} vs eager fp32 on {ONAME}, epoch {args.epoch}')
+    print(f'max |features| diff: {diffs["features"]:.2e}, max |adjacency| diff: {diffs["adjacency"]:.2e}')
+    for dim, diff in enumerate(diffs['curves']):
+        print(f'H{dim}: max |betti curve| diff {diff:.4f}')
+    print('SAFE' if diffs['curves'].max() <= args.tol else f'NOT SAFE: curves differ by more than {args.tol}')
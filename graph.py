@@ -67,6 +67,21 @@ def dist_corr(signals, device):
 
     return adj
 
+@torch.no_grad()
+def tiled_corrcoef(signals, tile):
+    ''' torch.nan_to_num(torch.corrcoef(signals)) computed tile rows at a time, so that only the standardized signals
+    and the result are held in full. '''
+    n, _ = signals.size()
+
+    signals = signals - signals.mean(dim=1, keepdim=True)
+    signals /= torch.linalg.vector_norm(signals, dim=1, keepdim=True)
+
+    adj = torch.empty((n, n), dtype=signals.dtype, device=signals.device)
+    for i in range(0, n, tile):
+        torch.mm(signals[i:i + tile], signals.T, out=adj[i:i + tile])
+
+    return torch.nan_to_num_(adj.clamp_(-1., 1.))
+
 @torch.no_grad()
 def partial_binarize(M, binarize_t, device):
     ''' Binarize matrix. Real subunitary values. '''
@@ -76,11 +91,12 @@ def partial_binarize(M, binarize_t, device):
     return M.to(device)
 
 @torch.no_grad()
-def adjacency(signals, device, metric=None):
+def adjacency(signals, device, metric=None, tile=None):
     '''
     Build matrix A of dimensions nxn where a_{ij} = metric(a_i, a_j).
     signals: nxm matrix where each row (signal[k], k=range(n)) is a signal. 
     metric: a function f(.,.) that takes two 2D ndarrays and outputs a single real number (e.g correlation, KL divergence etc).
+    tile: rows per tile of the Pearson and Spearman correlations (tiled_corrcoef); None computes them at once.
     '''
     
     signals = np.reshape(signals, (signals.shape[0], -1))
@@ -88,7 +104,7 @@ def adjacency(signals, device, metric=None):
         
     if metric == 'spearman':
         signals = spearman_ranks(signals, device=device)
-        adj = torch.nan_to_num(torch.corrcoef(signals)).detach()
+        adj = tiled_corrcoef(signals.float(), tile) if tile is not None else torch.nan_to_num(torch.corrcoef(signals)).detach()
     elif metric == 'dcorr':
         adj = dist_corr(signals, device=device).detach()
     elif callable(metric):
@@ -99,6 +115,8 @@ def adjacency(signals, device, metric=None):
         ''' Normalize '''
         adj = robust_scaler(adj)
         adj = torch.nan_to_num(adj).detach()
+    elif tile is not None:
+        adj = tiled_corrcoef(signals, tile)
     else:
         adj = torch.nan_to_num(torch.corrcoef(signals)).detach()
 
@@ -1,6 +1,10 @@
 import glob
+import json
 import os
+import platform
 import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
@@ -11,7 +15,11 @@ from PIL import PngImagePlugin
 from torch.utils.data import (DataLoader, Dataset, RandomSampler,
                               SequentialSampler, Subset, random_split)
 
+from batch_transforms import BatchTransform, BatchTransformLoader
+from cache import hash_parts
+from concurrency import core_budget
 from config import IMG_SIZE, SUBSETS_LIST, SEED
+from shared_cache import SharedImageCache
 
 # uncomment these lines to allow large images and truncated images to be loaded
 LARGE_ENOUGH_NUMBER = 1000
@@ -20,6 +28,19 @@ PngImagePlugin.MAX_TEXT_CHUNK = LARGE_ENOUGH_NUMBER * (1024**2)
 # file where mappings from class codes to class names are stored
 CODES_TO_NAMES_FILE = './results/codes_to_names.txt'
 
+# directory where file indices of the ImageNet subsets are cached
+INDEX_DIR = './data/index'
+
+# directory of the uint8 shards written by packing.py
+PACKED_DIR = './data/packed'
+
+# torchvision download of MNIST
+MNIST_DIR = './data/mnist'
+
+# data loader settings chosen by autotune_loader, per host and dataset
+LOADER_SETTINGS_FILE = './train_processing/loader_settings.json'
+DEFAULT_LOADER_SETTINGS = {'num_workers': 1, 'prefetch_factor': 2, 'pin_memory': False}
+
 def get_color_distortion(s=0.125): # s is the strength of color distortion.
     torch.manual_seed(SEED)
     np.random.seed(SEED)
@@ -84,10 +105,29 @@ def calc_mean_std(dataloader):
     
     return pop_mean, pop_std
 
-def get_dataset(data, path, transform, verbose, train=False, iter=0):
-    ''' Return loader for torchvision data. If data in [mnist, cifar] torchvision.datasets has built-in loaders else load from ImageFolder '''
-    if data == 'imagenet':
-        dataset = CustomImageNet(path, 'data/map_clsloc.txt', subset=SUBSETS_LIST[iter], transform=transform, verbose=verbose, iter=iter)
+def get_dataset(data, path, transform, verbose, train=False, iter=0, shared_cache=False):
+    ''' Return loader for torchvision data. If data in [mnist, cifar] torchvision.datasets has built-in loaders else load from ImageFolder.
+    Subsets packed with packing.py are read from their memory-mapped shard instead, unless the source changed since
+    packing. With shared_cache, ImageNet images are decoded once per node into the SharedImageCache and read from there
+    by every job. '''
+    packed = packed_path(data, train=train, iter=iter)
+    use_pack = packed is not None and os.path.exists(os.path.join(packed, 'manifest.json'))
+    if use_pack:
+        with open(os.path.join(packed, 'manifest.json'), 'r') as f:
+            packed_hash = json.load(f).get('source_hash')
+        current_hash = source_hash(data, path, train=train, iter=iter)
+        # a source that is not on this node cannot have changed
+        use_pack = current_hash is None or packed_hash == current_hash
+        if not use_pack:
+            print(f'Ignoring packed dataset {packed}: the source changed since packing; rerun packing.py')
+
+    if use_pack:
+        if verbose:
+            print(f'Using packed dataset {packed}')
+        dataset = PackedDataset(packed, transform=transform)
+    elif data == 'imagenet':
+        dataset = CustomImageNet(path, 'data/map_clsloc.txt', subset=SUBSETS_LIST[iter], transform=transform, verbose=verbose, iter=iter,
+                                 cache=SharedImageCache() if shared_cache else None)
     elif data == 'mnist':
         dataset = CustomMNIST(train=train, transform=transform)
     else:
@@ -95,8 +135,22 @@ def get_dataset(data, path, transform, verbose, train=False, iter=0):
 
     return dataset
 
+def eval_transform(train_transform, dataset):
+    ''' Test transform matching a training pipeline: center crop, then only its ToTensor and Normalize steps '''
+    test_transform = []
+    size = (IMG_SIZE, IMG_SIZE) if dataset == 'imagenet' else (28, 28)
+    test_transform.append(transforms.CenterCrop(size))
+    for item in train_transform.transforms:
+        if isinstance(item, torchvision.transforms.transforms.ToTensor):
+            test_transform.append(item)
+        elif isinstance(item, torchvision.transforms.transforms.Normalize):
+            test_transform.append(item)
+
+    return transforms.Compose(test_transform)
+
 def dataloader(data, path=None, train=False, transform=None, batch_size=1, iter=0, verbose=False, sampling=-1, \
-               normalize=True, subset=None):
+               normalize=True, subset=None, batch_transform=False, loader_settings=None, autotune=False, shared_cache=False,
+               manifest=None, stratified=False):
     
     # if data == 'imagenet':
     #     temp_trans = transforms.Compose([transforms.CenterCrop((500, 500)), transforms.ToTensor()])
@@ -105,29 +159,24 @@ def dataloader(data, path=None, train=False, transform=None, batch_size=1, iter=
     # else:
     #     temp_trans = transforms.Compose([transforms.ToTensor()])
     # dataset = get_dataset(data, path, transform=temp_trans, train=train, iter=iter, verbose=verbose)
-    dataset = get_dataset(data, path, transform, train=train, verbose=verbose, iter=iter)
-
-    if subset is not None:
+    dataset = get_dataset(data, path, transform, train=train, verbose=verbose, iter=iter, shared_cache=shared_cache)
+
+    if subset is not None and manifest is not None:
+        # the same samples at every epoch and in every later run, independent of the global RNG state
+        sample_manifest = subset_manifest(dataset, subset, manifest, stratified=stratified)
+        dataset = CustomSubset(dataset, sample_manifest['indices'])
+        dataset.sample_manifest = sample_manifest
+    elif subset is not None:
         subset_iter = list(np.random.choice(dataset.__len__(), size=subset, replace=False))
         dataset = CustomSubset(dataset, subset_iter)
 
-    if train or not train:
+    if train:
         print(f'Using RandomSampler, train is {train}')
         sampler = RandomSampler(dataset)
     else:
         print(f'Using SequentialSampler, train is {train}')
         sampler = SequentialSampler(dataset)
 
-    def seed_worker(worker_id):
-        worker_seed = torch.initial_seed() % 2**32
-        np.random.seed(worker_seed)
-        random.seed(worker_seed)
-
-    g = torch.Generator()
-    g.manual_seed(SEED)
-
-    data_loader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=1, worker_init_fn=seed_worker, generator=g, drop_last=True)
-
     if normalize and not isinstance(transform.transforms[-1], torchvision.transforms.transforms.Normalize):
         # mean, std = calc_mean_std(data_loader)
         mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
@@ -137,12 +186,185 @@ def dataloader(data, path=None, train=False, transform=None, batch_size=1, iter=
         len_transform = len(dataset.__gettransform__().transforms)
         dataset.__gettransform__().transforms.insert(len_transform, transforms.Normalize(mean, std))
 
-    return data_loader, dataset.__gettransform__()
-
-def loader(data, batch_size, verbose, iter=0, sampling=-1, subset=None, transform=None):
-    ''' Interface to the dataloader function '''
+    full_transform = dataset.__gettransform__()
+    if batch_transform:
+        # collate uint8 images and apply the rest of the pipeline to whole batches
+        batch_trans = BatchTransform.from_compose(full_transform, seed=SEED)
+        dataset.__settransform__(batch_trans.sample_transform())
+
+    # worker settings: explicit, tuned for this host and dataset, or the previous single worker
+    settings_key = f'{platform.node()}_{core_budget()}_{data}_{"train" if train else "test"}_ss{iter}_bs{batch_size}{"_bt" if batch_transform else ""}'
+    if loader_settings is None and autotune:
+        loader_settings = autotune_loader(dataset, batch_size, settings_key)
+    elif loader_settings is None:
+        loader_settings = load_loader_settings(settings_key)
+
+    data_loader = make_dataloader(dataset, batch_size, sampler, loader_settings)
+
+    if batch_transform:
+        return BatchTransformLoader(data_loader, batch_trans), full_transform
+
+    return data_loader, full_transform
+
+def dataset_labels(dataset):
+    ''' Labels of all samples, read from the index rather than by loading images. '''
+    if isinstance(dataset, CustomImageNet):
+        return np.array([label for _, label in dataset.data], dtype=np.int64)
+    elif isinstance(dataset, CustomMNIST):
+        return dataset.data.targets.numpy().astype(np.int64)
+    elif isinstance(dataset, PackedDataset):
+        return np.asarray(dataset.targets, dtype=np.int64)
+    elif hasattr(dataset, 'targets'):
+        return np.asarray(dataset.targets, dtype=np.int64)
+    else:
+        raise ValueError(f'Cannot read labels of {type(dataset).__name__}')
+
+def select_subset(labels, size, stratified=False, seed=SEED):
+    ''' Sorted sample indices drawn with a private generator. Stratified selection takes an equal share of
+    every class (the remainder going to the first classes) for more stable correlation estimates. '''
+    rng = np.random.default_rng(seed)
+    n = len(labels)
+    if size > n:
+        raise ValueError(f'Subset size {size} larger than dataset ({n})')
+    if not stratified:
+        return np.sort(rng.choice(n, size=size, replace=False))
+
+    classes = np.unique(labels)
+    shares = np.full(len(classes), size // len(classes))
+    shares[:size % len(classes)] += 1
+
+    indices = []
+    for cls, share in zip(classes, shares):
+        members = np.flatnonzero(labels == cls)
+        if share > len(members):
+            raise ValueError(f'Class {cls} has {len(members)} samples, {share} requested')
+        indices.append(rng.choice(members, size=share, replace=False))
+
+    return np.sort(np.concatenate(indices))
+
+def manifest_file(trans_dir, size, stratified=False):
+    ''' Location of the sample manifest of a subset, next to the transforms in train_processing/ '''
+    return os.path.join(trans_dir, f'subset_{size}{"_strat" if stratified else ""}.json')
+
+def subset_manifest(dataset, size, path, stratified=False, seed=SEED):
+    ''' Read the sample manifest at path, or select a subset and write it there.
+    The manifest holds the sample indices and a hash of indices, their labels and the dataset size; later
+    stages key their caches on that hash. A manifest that no longer matches the dataset raises ValueError. '''
+    labels = dataset_labels(dataset)
+
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        indices = np.asarray(manifest['indices'], dtype=np.int64)
+        if manifest['n_total'] != len(labels) or manifest['hash'] != hash_parts(indices, labels[indices], len(labels)):
+            raise ValueError(f'Sample manifest {path} does not match the dataset; remove it to draw a new subset')
+        return manifest
+
+    indices = select_subset(labels, size, stratified=stratified, seed=seed)
+    manifest = {'hash': hash_parts(indices, labels[indices], len(labels)), 'size': int(size), 'stratified': bool(stratified),
+                'seed': int(seed), 'n_total': len(labels), 'indices': indices.tolist()}
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+
+    return manifest
+
+def seed_worker(worker_id):
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+def make_dataloader(dataset, batch_size, sampler, settings):
+    ''' DataLoader with seeded workers; settings: num_workers, prefetch_factor, pin_memory. Workers persist across epochs. '''
+    g = torch.Generator()
+    g.manual_seed(SEED)
 
-    # set data paths for different image sizes (32, 64, 256)
+    num_workers = settings.get('num_workers', 1)
+    extra = {'persistent_workers': True, 'prefetch_factor': settings.get('prefetch_factor', 2)} if num_workers > 0 else {}
+
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers, pin_memory=settings.get('pin_memory', False),
+                      worker_init_fn=seed_worker, generator=g, drop_last=True, **extra)
+
+def _read_loader_settings():
+    ''' All remembered loader settings; an unreadable file counts as empty '''
+    try:
+        with open(LOADER_SETTINGS_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def _save_loader_settings(key, settings):
+    ''' Add settings under key; concurrent jobs serialise on a lock file, re-read the file under the lock and replace
+    it in one step, so neither entries nor readers get lost. '''
+    os.makedirs(os.path.dirname(LOADER_SETTINGS_FILE), exist_ok=True)
+    with open(f'{LOADER_SETTINGS_FILE}.lock', 'w') as lock:
+        if os.name == 'posix':
+            import fcntl
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        saved = _read_loader_settings()
+        saved[key] = settings
+        tmp = f'{LOADER_SETTINGS_FILE}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(saved, f, indent=1)
+        os.replace(tmp, LOADER_SETTINGS_FILE)
+
+def load_loader_settings(key):
+    ''' Settings remembered by autotune_loader for key, else the single-worker default '''
+    saved = _read_loader_settings()
+    if key in saved:
+        return saved[key]
+
+    return dict(DEFAULT_LOADER_SETTINGS)
+
+def autotune_loader(dataset, batch_size, key, n_batches=20):
+    ''' Time n_batches for a grid of worker counts up to the core budget, prefetch depths and pinned memory; the
+    fastest setting is stored in LOADER_SETTINGS_FILE under key and reused by later runs. Batches are drawn in order
+    and the torch, numpy and random states are restored afterwards, so the random transforms applied while timing
+    leave the training run unchanged. '''
+    saved = _read_loader_settings()
+    if key in saved:
+        return saved[key]
+
+    max_workers = core_budget()
+    workers = sorted({0, 1} | {w for w in (2, 4, 8, 16) if w <= max_workers})
+    candidates = [{'num_workers': w, 'prefetch_factor': p, 'pin_memory': pin}
+                  for w in workers for p in ((2, 4) if w > 0 else (2,)) for pin in ((False, True) if torch.cuda.is_available() else (False,))]
+
+    print(f'Tuning data loader over {len(candidates)} settings...')
+    best, best_time = None, float('inf')
+    py_state, np_state = random.getstate(), np.random.get_state()
+    with torch.random.fork_rng():
+        for settings in candidates:
+            data_loader = make_dataloader(dataset, batch_size, SequentialSampler(dataset), settings)
+            iterator = iter(data_loader)
+            start = time.time()
+            try:
+                # the first batch pays for worker start-up, which persistent workers only pay once
+                next(iterator)
+                start = time.time()
+                for _ in range(n_batches):
+                    next(iterator)
+                elapsed = time.time() - start
+            except StopIteration:
+                elapsed = time.time() - start
+            del iterator, data_loader
+
+            print(f'  {settings}: {elapsed / n_batches * 1000:.1f} ms/batch')
+            if elapsed < best_time:
+                best, best_time = settings, elapsed
+    random.setstate(py_state)
+    np.random.set_state(np_state)
+
+    _save_loader_settings(key, best)
+    print(f'Using {best}')
+
+    return best
+
+def imagenet_paths():
+    ''' Return the train and test data paths for the configured image size (32, 64, 256) '''
     if IMG_SIZE == 32:
         train_data_path = '/home/trogdent/imagenet_data/train_32'
         test_data_path = '/home/trogdent/imagenet_data/val_32'
@@ -152,33 +374,82 @@ def loader(data, batch_size, verbose, iter=0, sampling=-1, subset=None, transfor
     else:
         train_data_path = '/home/trogdent/imagenet_data/train'
         test_data_path = '/home/trogdent/imagenet_data/val'
-    
+
+    return train_data_path, test_data_path
+
+def packed_path(data, train=False, iter=0):
+    ''' Directory of the packed shard of a dataset split, or None if the dataset cannot be packed '''
+    split = 'train' if train else 'test'
+    if data == 'imagenet':
+        return os.path.join(PACKED_DIR, f'imagenet{IMG_SIZE}_{split}_ss{iter}')
+    elif data == 'mnist':
+        return os.path.join(PACKED_DIR, f'mnist_{split}')
+
+    return None
+
+def source_hash(data, path=None, train=False, iter=0):
+    ''' Hash of the files a packed split is made of: the modification times of the ImageNet class directories of the
+    subset, or the names, sizes and modification times of the MNIST files. None if the source is not on this node. '''
+    if data == 'imagenet':
+        subset = SUBSETS_LIST[iter]
+        with open('data/map_clsloc.txt', 'r') as f:
+            keys = [line.split()[0] for line in f if int(line.split()[1]) in subset]
+        class_dirs = [os.path.join(path, key) for key in keys]
+        if not any(os.path.isdir(d) for d in class_dirs):
+            return None
+        return hash_parts(os.path.abspath(path), keys, [os.path.getmtime(d) if os.path.isdir(d) else 0. for d in class_dirs])
+    elif data == 'mnist':
+        files = sorted(os.path.join(dirpath, f) for dirpath, _, fs in os.walk(MNIST_DIR) for f in fs)
+        if not files:
+            return None
+        return hash_parts(train, [(os.path.relpath(f, MNIST_DIR), os.path.getsize(f), os.path.getmtime(f)) for f in files])
+
+    return None
+
+def loader(data, batch_size, verbose, iter=0, sampling=-1, subset=None, transform=None, batch_transform=False, loader_settings=None, autotune=False, shared_cache=False,
+           manifest=None, stratified=False):
+    ''' Interface to the dataloader function; with manifest, subset samples are read from or written to that sample manifest '''
+
+    # set data paths for different image sizes (32, 64, 256)
+    train_data_path, test_data_path = imagenet_paths()
+
     # return dataloader for different datasets and train/test splits
     if data == 'imagenet_train':
         transforms_tr_imagenet = get_transform(train=True, crop=True, hflip=True, vflip=False, blur=True)
-        return dataloader('imagenet', path=train_data_path, train=True, transform=transforms_tr_imagenet, batch_size=batch_size, iter=iter, verbose=verbose, subset=subset) 
+        return dataloader('imagenet', path=train_data_path, train=True, transform=transforms_tr_imagenet, batch_size=batch_size, iter=iter, verbose=verbose, subset=subset, batch_transform=batch_transform, loader_settings=loader_settings, autotune=autotune, shared_cache=shared_cache, manifest=manifest, stratified=stratified) 
     elif data == 'imagenet_test':
         transforms_te_imagenet = get_transform(train=False, crop=False, hflip=False, vflip=False, blur=False) if transform is None else transform
         
-        return dataloader('imagenet', test_data_path, transform=transforms_te_imagenet, batch_size=batch_size, iter=iter, verbose=verbose, subset=subset)
+        return dataloader('imagenet', test_data_path, transform=transforms_te_imagenet, batch_size=batch_size, iter=iter, verbose=verbose, subset=subset, batch_transform=batch_transform, loader_settings=loader_settings, autotune=autotune, shared_cache=shared_cache, manifest=manifest, stratified=stratified)
     elif data == 'mnist_train':
         transforms_tr_mnist = get_transform(train=True, crop=False, hflip=False, vflip=False, color_dis=False, blur=False, resize=28)
 
-        return dataloader('mnist', train=True, transform=transforms_tr_mnist, batch_size=batch_size, iter=iter, verbose=verbose, normalize=True, subset=subset)
+        return dataloader('mnist', train=True, transform=transforms_tr_mnist, batch_size=batch_size, iter=iter, verbose=verbose, normalize=True, subset=subset, batch_transform=batch_transform, loader_settings=loader_settings, autotune=autotune, shared_cache=shared_cache, manifest=manifest, stratified=stratified)
     elif data == 'mnist_test':
         transforms_te_mnist = get_transform(train=False, crop=False, hflip=False, vflip=False, color_dis=False, blur=False, resize=28) if transform is None else transform
 
-        return dataloader('mnist', train=False, transform=transforms_te_mnist, batch_size=batch_size, iter=iter, verbose=verbose, normalize=True, subset=subset)
+        return dataloader('mnist', train=False, transform=transforms_te_mnist, batch_size=batch_size, iter=iter, verbose=verbose, normalize=True, subset=subset, batch_transform=batch_transform, loader_settings=loader_settings, autotune=autotune, shared_cache=shared_cache, manifest=manifest, stratified=stratified)
     else:
         raise ValueError(f"Invalid dataset: {data}")
 
 
+def _image_mode(img_path):
+    ''' Decode an image to check that it is readable; return its mode or None. '''
+    try:
+        with Image.open(img_path) as img:
+            img.load()
+            return img.mode
+    except OSError:
+        return None
+
+
 class CustomImageNet(Dataset):
 
-    def __init__(self, data_path, labels_path, verbose, subset=[], transform=None, grayscale=False, iter=0, num_samples=20000):
+    def __init__(self, data_path, labels_path, verbose, subset=[], transform=None, grayscale=False, iter=0, num_samples=20000, cache=None):
         super(CustomImageNet, self).__init__()
         
         self.data_path = data_path
+        self.cache = cache
         self.data = []
         self.label_dict = {}
         self.name_dict = {}
@@ -203,32 +474,14 @@ class CustomImageNet(Dataset):
         lines = []
         lines.append(f'Subset number: {iter}\n')
         for i, key in enumerate(self.label_dict.keys()):
-            img_paths = glob.glob(os.path.join(data_path, key, img_format))
-
             if i in range(9) and self.verbose:
                 lines.append(f'Label mapping: {key} --> {i} {self.name_dict[key]}\n')
             elif self.verbose:
                 lines.append(f'Label mapping: {key} --> {i} {self.name_dict[key]}\n')
                 lines.append(f'Original subset labels: {subset}\n')
 
-            counter = 0
-            for img_path in img_paths:
-                try:
-                    img = Image.open(img_path)
-                    img.load()
-                except OSError:
-                    print("Cannot open: {}".format(img_path))
-                    continue
-
-                if counter > num_samples:
-                    break
-
-                if img.mode == 'RGB' and not grayscale:
-                    self.data.append((img, i))
-                elif img.mode == 'L' and grayscale:
-                    self.data.append((img, i))
-
-                counter += 1
+        # only (path, label) pairs are kept; images are decoded in __getitem__
+        self.data = self._build_index(img_format, grayscale, num_samples, iter)
 
         if not os.path.exists(CODES_TO_NAMES_FILE):
                 with open(CODES_TO_NAMES_FILE, 'w') as f:
@@ -240,13 +493,60 @@ class CustomImageNet(Dataset):
                 with open(CODES_TO_NAMES_FILE, 'a') as f:
                     f.writelines(lines)
 
+    def _build_index(self, img_format, grayscale, num_samples, iter):
+        ''' List the (path, label) pairs of the subset. Images are validated on a thread pool without keeping
+        them in memory, and the index is cached in INDEX_DIR keyed by the class directories' modification times. '''
+        class_dirs = [os.path.join(self.data_path, key) for key in self.label_dict.keys()]
+        signature = {'data_path': self.data_path, 'classes': list(self.label_dict.keys()), 'grayscale': grayscale, 'num_samples': num_samples,
+                     'mtimes': [os.path.getmtime(d) if os.path.isdir(d) else 0. for d in class_dirs]}
+
+        index_file = os.path.join(INDEX_DIR, f'{os.path.basename(os.path.normpath(self.data_path))}_ss{iter}{"_gray" if grayscale else ""}.json')
+        if os.path.exists(index_file):
+            with open(index_file, 'r') as f:
+                cached = json.load(f)
+            if cached['signature'] == signature:
+                return [tuple(item) for item in cached['data']]
+
+        wanted = 'L' if grayscale else 'RGB'
+        data = []
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) + 4)) as pool:
+            for i, class_dir in enumerate(class_dirs):
+                img_paths = sorted(glob.glob(os.path.join(class_dir, img_format)))
+                modes = pool.map(_image_mode, img_paths)
+
+                # as before: the first num_samples + 1 readable images are considered, of which those in the wanted mode are kept
+                counter = 0
+                for img_path, mode in zip(img_paths, modes):
+                    if mode is None:
+                        print("Cannot open: {}".format(img_path))
+                        continue
+                    if counter > num_samples:
+                        break
+                    if mode == wanted:
+                        data.append((img_path, i))
+                    counter += 1
+
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        tmp = f'{index_file}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'signature': signature, 'data': data}, f)
+        os.replace(tmp, index_file)
+
+        return data
+
     def __len__(self):
         return len(self.data)
     
     def __getitem__(self, idx):
-        img = self.data[idx][0]
+        img_path = self.data[idx][0]
         label = self.data[idx][1]
 
+        if self.cache is not None:
+            img = self.cache.load(img_path)
+        else:
+            with Image.open(img_path) as img:
+                img.load()
+
         img = self.transform(img) if self.transform else transforms.ToTensor()(img)
         label = torch.tensor(label, dtype=torch.long)
 
@@ -259,7 +559,7 @@ class CustomImageNet(Dataset):
         return self.transform    
 
 class CustomMNIST(Dataset):
-    def __init__(self, path='./data/mnist', train=True, transform=None):
+    def __init__(self, path=MNIST_DIR, train=True, transform=None):
         super(CustomMNIST, self).__init__()
 
         download = False if os.path.exists(path) else True
@@ -273,12 +573,49 @@ class CustomMNIST(Dataset):
     def __getitem__(self, idx):
         return self.data.__getitem__(idx)
 
+    def __settransform__(self, transform):
+        self.data.transform = transform
+
     def __gettransform__(self):
         if hasattr(self.data, 'transform'):
             return getattr(self.data, 'transform')
         else:
             raise AttributeError("CustomMNIST has no attribute 'transform'")
 
+class PackedDataset(Dataset):
+    ''' Dataset split packed by packing.py: a contiguous (N, H, W, C) uint8 array read through np.memmap,
+    a labels array and a manifest. Samples are served as PIL images without any decoding, so the usual
+    transforms apply unchanged. '''
+    def __init__(self, path, transform=None):
+        super(PackedDataset, self).__init__()
+
+        with open(os.path.join(path, 'manifest.json'), 'r') as f:
+            self.manifest = json.load(f)
+
+        self.path = path
+        self.transform = transform
+        self.mode = self.manifest['mode']
+        self.images = np.memmap(os.path.join(path, 'images.u8'), dtype=np.uint8, mode='r', shape=tuple(self.manifest['shape']))
+        self.targets = np.load(os.path.join(path, 'labels.npy'))
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, idx):
+        arr = self.images[idx]
+        img = Image.fromarray(arr[..., 0] if self.mode == 'L' else arr, mode=self.mode)
+        label = torch.tensor(self.targets[idx], dtype=torch.long)
+
+        img = self.transform(img) if self.transform else transforms.ToTensor()(img)
+
+        return (img, label)
+
+    def __settransform__(self, transform):
+        self.transform = transform
+
+    def __gettransform__(self):
+        return self.transform
+
 class CustomSubset(Subset):
     def __init__(self, dataset, indices):
         super(CustomSubset, self).__init__(dataset, indices)
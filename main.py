@@ -22,6 +22,14 @@ parser.add_argument('--resume', default=0, type=int)
 parser.add_argument('--resume_epoch', default=20, type=int)
 parser.add_argument('--verbose', default=0, type=int)
 parser.add_argument('--save_dir', default='./results', help='Directory to save results.')
+parser.add_argument('--background_ph', default=0, type=int, help='Compute persistence diagrams in the background during training; skips the graph building stage.')
+parser.add_argument('--ph_cores', default=None, type=int, help='Cores given to background PH.')
+parser.add_argument('--capture', default=None, type=str, help='Capture activations during training: features or pearson.')
+parser.add_argument('--stratified', default=0, type=int, help='Draw the graph subset with an equal share of every class.')
+parser.add_argument('--shared_cache', default=0, type=int, help='Decode ImageNet images once per node and share the decoded files between concurrent jobs.')
+parser.add_argument('--cores', default=None, type=int, help='Core budget of every stage; default: the cores this process may run on.')
+parser.add_argument('--memory_mode', default='auto', type=str, help='Execution mode of the graph stage: auto, dense, tiled, streaming or approximate.')
+parser.add_argument('--memory_limit', default=None, type=float, help='Memory budget of the graph stage in GB; default: the memory available.')
 
 args = parser.parse_args()
 
@@ -39,29 +47,44 @@ if not os.path.exists(args.save_dir):
 ONAME = f'{args.net}_{args.dataset}_ss{args.iter}' if args.dataset.__eq__('imagenet') else f'{args.net}_{args.dataset}'
 SAVE_DIR = os.path.join(args.save_dir, ONAME)
 
+''' Stages run in this process and are imported when they run; the trained network, the test transform and the diagrams are passed on in memory '''
+trained = {}
+diagrams = None
+
 if args.train:
     visible_print('Training network')
 
-    cmd = f'python ./train.py --net {args.net} --dataset {args.dataset} --epochs {args.n_epochs_train} --lr {args.lr} --iter {args.iter} --chkpt_epochs {args.epochs_test} --optimizer {args.optimizer} --resume {args.resume} --resume_epoch {args.resume_epoch}'
+    cmd = f'--net {args.net} --dataset {args.dataset} --epochs {args.n_epochs_train} --lr {args.lr} --iter {args.iter} --chkpt_epochs {args.epochs_test} --optimizer {args.optimizer} --resume {args.resume} --resume_epoch {args.resume_epoch} --shared_cache {args.shared_cache}'
     cmd += f' --reduction {args.reduction}' if args.reduction else ''
     cmd += f' --metric {args.metric}' if args.metric else ''
-    
-    os.system(cmd)
+    cmd += f' --cores {args.cores}' if args.cores else ''
+    cmd += f' --capture {args.capture} --subset {args.subset} --stratified {args.stratified}' if args.capture else ''
+    cmd += f' --background_ph 1 --subset {args.subset} --stratified {args.stratified}' if args.background_ph else ''
+    cmd += f' --ph_cores {args.ph_cores}' if args.ph_cores else ''
+
+    import train
+    trained = train.run(train.parse_args(cmd.split()))
 
-if args.build_graph:
+if args.build_graph and not args.background_ph:
     visible_print('Building graph')
-    
-    cmd = f'python ./build_graph_functional.py --net {args.net} --dataset {args.dataset} --chkpt_epochs {args.epochs_test} --iter {args.iter} --verbose {args.verbose} --subset {args.subset} --resume {0} --resume_epoch {args.resume_epoch}'
+
+    cmd = f'--net {args.net} --dataset {args.dataset} --chkpt_epochs {args.epochs_test} --iter {args.iter} --verbose {args.verbose} --subset {args.subset} --resume {0} --resume_epoch {args.resume_epoch} --shared_cache {args.shared_cache} --stratified {args.stratified}'
     cmd += f' --reduction {args.reduction}' if args.reduction else ''
     cmd += f' --metric {args.metric}' if args.metric else ''
+    cmd += f' --cores {args.cores}' if args.cores else ''
+    cmd += f' --memory_mode {args.memory_mode}'
+    cmd += f' --memory_limit {args.memory_limit}' if args.memory_limit else ''
 
-    os.system(cmd)
+    import build_graph_functional
+    diagrams = build_graph_functional.run(build_graph_functional.parse_args(cmd.split()), **trained)['diagrams']
 
 if args.post_process:
     visible_print('Post-processing')
 
-    cmd = f'python ./post_process.py --net {args.net} --dataset {args.dataset} --save_dir {SAVE_DIR} --chkpt_epochs {args.epochs_test} --iter {args.iter}'
+    cmd = f'--net {args.net} --dataset {args.dataset} --save_dir {SAVE_DIR} --chkpt_epochs {args.epochs_test} --iter {args.iter}'
     cmd += f' --reduction {args.reduction}' if args.reduction else ''
     cmd += f' --metric {args.metric}' if args.metric else ''
+    cmd += f' --cores {args.cores}' if args.cores else ''
 
-    os.system(cmd)
+    import post_process
+    post_process.run(post_process.parse_args(cmd.split()), diagrams=diagrams)
@@ -0,0 +1,250 @@
+''' Peak host memory of the build_graph stages, predicted before a run, and the execution mode that fits it.
+
+From the layer sizes of a dry forward pass, the subset size, the metric and the reduction, stage_bytes() estimates
+what each stage holds at its peak on top of the process (model, loaders, libraries) in the modes
+    dense:       all activations, then the whole adjacency with its dense mask and int64 indices (the default path)
+    tiled:       correlation and COO conversion tile rows at a time; only the adjacency and the COO arrays are whole
+    streaming:   Pearson correlation accumulated batch by batch (capture.RunningPearson); the activation matrix is
+                 never held, at the price of float64 (nodes, nodes) accumulators; Pearson without reduction only
+    approximate: tiled, with the filtration truncated at the distance that keeps the edges within the budget;
+                 diagrams lose the pairs born above that distance and pairs still alive there never die
+MemoryPlan picks the first mode in this order whose peak fits the budget: --memory_limit, else the memory the
+process may still use (MemAvailable, capped by the cgroup limit of SLURM jobs and containers). When none fits,
+the run stops before extraction with the estimate of every stage.
+
+Edge collapse and PH peaks are per-edge figures measured with giotto-ph on correlated activations; activations
+without correlation structure can need far more in PH. The peak_rss_mb of the telemetry records of a run shows
+how close the estimate was for an architecture.
+'''
+import os
+
+MODES = ('auto', 'dense', 'tiled', 'streaming', 'approximate')
+STAGES = ('extraction', 'reduction', 'adjacency', 'distance', 'coo', 'collapse', 'ph')
+
+# bytes per edge held by the edge collapse and by ripser_parallel (maxdim 1) beyond their COO input; measured 50 to
+# 125 and 20 to 110. The collapse removes a third of the edges of whole graphs but next to none of truncated
+# ones, so PH is planned for all of them.
+COLLAPSE_BYTES_PER_EDGE = 128
+PH_BYTES_PER_EDGE = 128
+# giotto-ph and giotto-tda, imported with the first diagram
+LIBRARY_BYTES = 96 << 20
+# random pairs topology.distance_threshold draws in the approximate mode, at about 40 bytes each
+THRESHOLD_PAIRS = 1 << 18
+# bound on the temporaries of one tile of the correlation and COO conversion
+TILE_BYTES = 1 << 28
+# fraction of the limit planned for; the rest absorbs allocator overhead and estimation error
+SAFETY = .9
+
+
+def add_memory_args(parser):
+    parser.add_argument('--memory_mode', default='auto', type=str, choices=MODES, help='Execution mode of the graph stages; auto picks the first of dense, tiled, streaming, approximate that fits.')
+    parser.add_argument('--memory_limit', default=None, type=float, help='Memory budget of this run in GB; default: the memory available to the process.')
+
+def _read_int(path):
+    try:
+        with open(path, 'r') as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+
+    return int(value) if value.isdigit() else None
+
+def process_rss():
+    ''' Resident memory of this process in bytes '''
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return 0
+
+def available_memory():
+    ''' Bytes this process may still allocate: MemAvailable, capped by the cgroup limit (v2, else v1) '''
+    available = None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if available is None:
+        available = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+    for limit_file, usage_file in (('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes')):
+        limit, usage = _read_int(limit_file), _read_int(usage_file)
+        if limit is not None and usage is not None:
+            available = min(available, max(limit - usage, 0))
+            break
+
+    return available
+
+def layer_sizes(net, inputs, execution=None):
+    ''' Features per sample of every layer of net.forward_features, from a dry forward pass of inputs '''
+    import torch
+
+    training = net.training
+    net.eval()
+    with torch.no_grad():
+        if execution is not None:
+            with execution.autocast():
+                outputs = net.forward_features(execution.inputs(inputs))
+        else:
+            outputs = net.forward_features(inputs)
+    net.train(training)
+
+    return [int(f[0].numel()) for f in outputs]
+
+
+def reduced_nodes(nodes, samples, reduction=None):
+    ''' Upper bound of the nodes left by Passer.reduce '''
+    if reduction is None:
+        return nodes
+    elif reduction == 'pca':
+        return min(nodes, samples)
+    elif reduction == 'kmeans':
+        return min(nodes, 1000)
+    elif reduction == 'umap':
+        return int(.4 * nodes)
+    else:
+        raise ValueError(f'Reduction {reduction} not supported!')
+
+def stage_bytes(nodes, samples, mode='dense', metric=None, reduction=None, tile=None, max_edges=None, batch_size=100):
+    ''' Predicted bytes held at the peak of every stage of build_graph_functional.py on top of the process.
+    nodes: features per sample of all layers; tile: rows per tile (tiled and approximate modes);
+    max_edges: edges kept by the approximate mode. '''
+    n, s = nodes, samples
+    k = reduced_nodes(n, s, reduction)
+    tile = k if tile is None else min(tile, k)
+    edges = k * (k + 1) // 2 if max_edges is None else min(max_edges + k, k * (k + 1) // 2) # upper triangle with the diagonal
+    spearman = metric == 'spearman'
+
+    est = {}
+    if mode == 'streaming':
+        # running co-moment in float64 with the co-moment of a batch and its update; then the co-moment with two of
+        # the corrcoef temporaries and the float32 result
+        est['extraction'] = 3 * 8 * n * n + 2 * 8 * batch_size * n
+        est['reduction'] = 0
+        est['adjacency'] = 3 * 8 * k * k + 4 * k * k
+    else:
+        # the batches, their per-layer concatenation and the concatenation of the layers, in float32
+        est['extraction'] = 3 * 4 * s * n
+        # reductions hold the features twice (numpy and torch) and return float64
+        est['reduction'] = {None: 0, 'pca': 8 * s * n + 3 * 4 * n * n + 8 * s * k, 'kmeans': 8 * s * n + 4 * n * k + 8 * s * k,
+                            'umap': 8 * s * n + 8 * s * k}[reduction]
+        activs = 8 * s * k if reduction is not None else 4 * s * k
+        if metric == 'dcorr':
+            # the differences and their centered versions: two (samples, samples) matrices per node
+            est['adjacency'] = activs + 4 * s * k + 2 * 4 * k * s * s + 4 * k * k
+        elif tile < k:
+            # the signals, their ranks, the standardized signals and the adjacency; one tile of products at a time
+            est['adjacency'] = activs + 4 * s * k + (16 * s * k if spearman else 0) + 4 * s * k + 4 * k * k
+        else:
+            # torch.corrcoef: centered signals, covariance, normalised copy and nan_to_num copy (float64 with spearman)
+            est['adjacency'] = activs + 4 * s * k + (16 * s * k + 3 * 8 * k * k if spearman else 4 * s * k + 3 * 4 * k * k)
+
+    # the distance is computed in place, and the adjacency is held by build_graph until PH is done
+    est['distance'] = 4 * k * k
+    # masks and int64 indices of one tile, and the int32 rows, int32 columns and float32 values
+    est['coo'] = 4 * k * k + 2 * tile * k + 16 * min(edges, tile * k) + 12 * edges + (40 * THRESHOLD_PAIRS if max_edges is not None else 0)
+    est['collapse'] = 4 * k * k + 12 * edges + COLLAPSE_BYTES_PER_EDGE * edges
+    est['ph'] = 4 * k * k + 12 * edges + PH_BYTES_PER_EDGE * edges
+
+    return est
+
+
+class MemoryPlan():
+    def __init__(self, nodes, samples, metric=None, reduction=None, mode='auto', limit=None, batch_size=100):
+        if mode not in MODES:
+            raise ValueError(f'Memory mode {mode} not supported! Use one of {MODES}')
+        if mode == 'streaming' and (metric is not None or reduction is not None):
+            raise ValueError('Streaming computes the Pearson correlation of the raw activations; it does not support a metric or reduction')
+
+        self.nodes = nodes
+        self.samples = samples
+        self.metric = metric
+        self.reduction = reduction
+        self.batch_size = batch_size
+
+        self.base = process_rss() + LIBRARY_BYTES
+        self.limit = int(limit * 1024**3) if limit is not None else self.base + available_memory()
+        self.budget = int(SAFETY * self.limit) - self.base
+
+        k = reduced_nodes(nodes, samples, reduction)
+        self.edges = k * (k - 1) // 2
+        # per tile row: masks, int64 indices and float32 products
+        self.tile_rows = max(1, min(k, TILE_BYTES // (22 * max(k, 1))))
+
+        self.mode, self.tile, self.max_edges, self.stages = self._choose(mode)
+
+    @classmethod
+    def from_args(cls, args, nodes, samples, batch_size=100):
+        return cls(nodes, samples, metric=args.metric, reduction=args.reduction, mode=args.memory_mode, limit=args.memory_limit, batch_size=batch_size)
+
+    def estimate(self, mode, max_edges=None):
+        tile = self.tile_rows if mode in ('tiled', 'approximate') else None
+        return stage_bytes(self.nodes, self.samples, mode=mode, metric=self.metric, reduction=self.reduction, tile=tile,
+                           max_edges=max_edges, batch_size=self.batch_size)
+
+    def fits(self, stages):
+        return max(stages.values()) <= self.budget
+
+    def _min_edges(self):
+        return min(reduced_nodes(self.nodes, self.samples, self.reduction), self.edges)
+
+    def _max_edges(self):
+        ''' Most edges the approximate mode can keep within the budget, or None when not even a spanning tree's worth fits '''
+        lo, hi = self._min_edges(), self.edges
+        if not self.fits(self.estimate('approximate', max_edges=lo)):
+            return None
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.fits(self.estimate('approximate', max_edges=mid)):
+                lo = mid
+            else:
+                hi = mid - 1
+
+        return lo
+
+    def _choose(self, mode):
+        ''' (mode, tile, max_edges, stage estimates) of the first candidate mode that fits; RuntimeError if none does '''
+        if mode == 'auto':
+            candidates = ['dense', 'tiled'] + (['streaming'] if self.metric is None and self.reduction is None else []) + ['approximate']
+        else:
+            candidates = [mode]
+
+        for candidate in candidates:
+            max_edges = None
+            if candidate == 'approximate':
+                max_edges = self._max_edges()
+                if max_edges is None:
+                    continue
+                # every edge fits: the same as tiled
+                max_edges = max_edges if max_edges < self.edges else None
+            stages = self.estimate(candidate, max_edges=max_edges)
+            if self.fits(stages):
+                return candidate, self.tile_rows if candidate in ('tiled', 'approximate') else None, max_edges, stages
+
+        # approximate with as few edges as it may keep
+        table = '\n'.join(f'    {c:<12}' + ' '.join(f'{s} {b / 1024**3:.2f}' for s, b in self.estimate(c, max_edges=self._min_edges() if c == 'approximate' else None).items())
+                          for c in candidates)
+        raise RuntimeError(f'{self.nodes} nodes x {self.samples} samples (metric {self.metric}, reduction {self.reduction}) do not fit in '
+                           f'{self.budget / 1024**3:.2f} GB, {100*SAFETY:.0f}% of the {self.limit / 1024**3:.2f} GB limit less the {self.base / 1024**3:.2f} GB '
+                           f'the process holds. Predicted peak GB by stage:\n'
+                           f'{table}\nLower --subset, use a --reduction, or raise --memory_limit if more memory is available.')
+
+    def summary(self):
+        return {'mode': self.mode, 'nodes': self.nodes, 'samples': self.samples, 'tile': self.tile, 'max_edges': self.max_edges,
+                'edges': self.edges, 'budget_mb': self.budget / 1024**2, 'base_mb': self.base / 1024**2,
+                'predicted_mb': {stage: b / 1024**2 for stage, b in self.stages.items()}}
+
+    def report(self):
+        peak = max(self.stages, key=self.stages.get)
+        print(f'\n Memory plan: {self.mode} for {self.nodes} nodes x {self.samples} samples; peak {self.stages[peak] / 1024**3:.2f} GB in {peak} '
+              f'of a {self.budget / 1024**3:.2f} GB budget' + (f'; edges capped at {self.max_edges} of {self.edges}' if self.max_edges is not None else '') + '\n')
+
+        return self
@@ -20,7 +20,7 @@ class Conv_2(nn.Module):
         x3 = self.conv2(x2)
         if mask: x3 = x3*mask[1]
         x4 = F.relu(F.max_pool2d(x3, 2))
-        x4 = x4.view(-1, self.feat_size)
+        x4 = x4.reshape(-1, self.feat_size)
         x5 = F.relu(self.fc1(x4))
         if mask: x5 = x5*mask[2]
         x6 = F.relu(self.fc2(x5))
@@ -31,7 +31,7 @@ class Conv_2(nn.Module):
     def forward_features(self, x):
         x1 = F.relu(F.max_pool2d(self.conv1(x), 1))
         x2 = F.relu(F.max_pool2d(self.conv2(x1), 2))        
-        x2 = x2.view(-1, self.feat_size)
+        x2 = x2.reshape(-1, self.feat_size)
         x3 = F.relu(self.fc1(x2))
         x4 = F.relu(self.fc2(x3))
         x5 = F.log_softmax(self.fc3(x4), dim=1)
@@ -42,7 +42,7 @@ class Conv_2(nn.Module):
         x2 = F.relu(F.max_pool2d(x1, 1))
         x3 = self.conv2(x2)
         x4 = F.relu(F.max_pool2d(x3, 2))
-        x4 = x4.view(-1, self.feat_size)
+        x4 = x4.reshape(-1, self.feat_size)
         x5 = F.relu(self.fc1(x4))
         x6 = F.relu(self.fc2(x5))
         x7 = F.log_softmax(self.fc3(x6), dim=1)
@@ -74,7 +74,7 @@ class Conv_4(nn.Module):
         x7 = self.conv4(x6)
         if mask: x7 = x7*mask[3]
         x8 = F.relu(F.max_pool2d(x7, 2))
-        x8 = x8.view(-1, self.feat_size)
+        x8 = x8.reshape(-1, self.feat_size)
         x9 = F.relu(self.fc1(x8))
         if mask: x9 = x9*mask[4]
         x10 = F.relu(self.fc2(x9))
@@ -87,7 +87,7 @@ class Conv_4(nn.Module):
         x2 = F.relu(F.max_pool2d(self.conv2(x1), 2))
         x3 = F.relu(F.max_pool2d(self.conv3(x2), 1))
         x4 = F.relu(F.max_pool2d(self.conv4(x3), 2))
-        x4 = x4.view(-1, self.feat_size)
+        x4 = x4.reshape(-1, self.feat_size)
         x5 = F.relu(self.fc1(x4))
         x6 = F.relu(self.fc2(x5))
         x7 = F.log_softmax(self.fc3(x6), dim=1)
@@ -102,7 +102,7 @@ class Conv_4(nn.Module):
         x6 = F.relu(F.max_pool2d(x5, 1))
         x7 = self.conv4(x6)
         x8 = F.relu(F.max_pool2d(x7, 2))
-        x8 = x8.view(-1, self.feat_size)
+        x8 = x8.reshape(-1, self.feat_size)
         x9 = F.relu(self.fc1(x8))
         x10 = F.relu(self.fc2(x9))
         x11 = F.log_softmax(self.fc3(x10), dim=1)
@@ -130,7 +130,7 @@ class Conv_6(nn.Module):
         x4 = F.relu(F.max_pool2d(self.conv4(x3), 2))
         x5 = F.relu(F.max_pool2d(self.conv5(x4), 1))
         x6 = F.relu(F.max_pool2d(self.conv6(x5), 2))
-        x6 = x6.view(-1, self.feat_size)
+        x6 = x6.reshape(-1, self.feat_size)
         x7 = F.relu(self.fc1(x6))
         x8 = F.relu(self.fc2(x7))
         x9 = F.log_softmax(self.fc3(x8), dim=1)
@@ -155,7 +155,7 @@ class Conv_6(nn.Module):
         x11 = self.conv6(x10)
         if mask: x11 = x11*mask[5]
         x12 = F.relu(F.max_pool2d(x11, 2))
-        x12 = x12.view(-1, self.feat_size)
+        x12 = x12.reshape(-1, self.feat_size)
         x13 = F.relu(self.fc1(x12))
         if mask: x13 = x13*mask[6] 
         x14 = F.relu(self.fc2(x13))
@@ -170,7 +170,7 @@ class Conv_6(nn.Module):
         x4 = F.relu(F.max_pool2d(self.conv4(x3), 2))
         x5 = F.relu(F.max_pool2d(self.conv5(x4), 1))
         x6 = F.relu(F.max_pool2d(self.conv6(x5), 2))
-        x6 = x6.view(-1, self.feat_size)
+        x6 = x6.reshape(-1, self.feat_size)
         x7 = F.relu(self.fc1(x6))
         x8 = F.relu(self.fc2(x7))
         x9 = F.log_softmax(self.fc3(x8), dim=1)
@@ -189,7 +189,7 @@ class Conv_6(nn.Module):
         x10 = F.relu(F.max_pool2d(x9, 1))
         x11 = self.conv6(x10)
         x12 = F.relu(F.max_pool2d(x11, 2))
-        x12 = x12.view(-1, self.feat_size)
+        x12 = x12.reshape(-1, self.feat_size)
         x13 = F.relu(self.fc1(x12))
         x14 = F.relu(self.fc2(x13))
         x15 = F.log_softmax(self.fc3(x14), dim=1)
@@ -79,7 +79,7 @@ class DenseNet(nn.Module):
         out = self.trans3(self.dense3(out))
         out = self.dense4(out)
         out = F.avg_pool2d(F.relu(self.bn(out)), 4)
-        out = out.view(out.size(0), -1)
+        out = out.reshape(out.size(0), -1)
         out = self.linear(out)
         
         return out
@@ -91,7 +91,7 @@ class DenseNet(nn.Module):
         x4 = self.trans3(self.dense3(x3))
         x5 = self.dense4(x4)
         x6 = F.avg_pool2d(F.relu(self.bn(x5)), 4)
-        x7 = x6.view(x6.size(0), -1)
+        x7 = x6.reshape(x6.size(0), -1)
         out = self.linear(x7)
         
         return [x1, x2, x3, x4, x5, x6, x7, out]
@@ -4,12 +4,12 @@ import numpy as np
 
 
 class FCNet(nn.Module):
-    def __init__(self, input_size, num_classes):
+    def __init__(self, input_size, num_classes, widths=(3, 4)):
         super(FCNet, self).__init__()
 
-        self.fc1 = nn.Linear(9, 3)
-        self.fc2 = nn.Linear(3, 4)
-        self.fc3 = nn.Linear(4, num_classes)
+        self.fc1 = nn.Linear(input_size**2, widths[0])
+        self.fc2 = nn.Linear(widths[0], widths[1])
+        self.fc3 = nn.Linear(widths[1], num_classes)
     
     def forward(self, x):
         x = x.view(x.size(0), -1)   
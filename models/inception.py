@@ -92,7 +92,7 @@ class GoogLeNet(nn.Module):
         out = self.a5(out)
         out = self.b5(out)
         out = self.avgpool(out)
-        out = out.view(out.size(0), -1)
+        out = out.reshape(out.size(0), -1)
         out = self.linear(out)
         return out
 
@@ -110,7 +110,7 @@ class GoogLeNet(nn.Module):
         x11 = self.a5(x10)
         x12 = self.b5(x11)
         x13 = self.avgpool(x12)
-        x14 = x13.view(x13.size(0), -1)
+        x14 = x13.reshape(x13.size(0), -1)
         out = self.linear(x14)
 
         return [x1, x2, x3, x4, x5, x6, x7, x8, x9, x10, x11, x12, x13, x14, out]
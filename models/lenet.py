@@ -20,7 +20,7 @@ class LeNet(nn.Module):
         x1 = F.relu(F.max_pool2d(self.conv1(x), 2))
         x2 = F.relu(F.max_pool2d(self.conv2_drop(self.conv2(x1)), 2))
         # print("F Size x2: ", x2.size())
-        x2 = x2.view(x2.size(0), -1)
+        x2 = x2.reshape(x2.size(0), -1)
         x3 = F.relu(self.fc1(x2))
         x4 = F.log_softmax(self.fc2(x3), dim=1)
         
@@ -29,7 +29,7 @@ class LeNet(nn.Module):
     def forward_features(self, x):
         x1 = F.relu(F.max_pool2d(self.conv1(x), 2))
         x2 = F.relu(F.max_pool2d(self.conv2_drop(self.conv2(x1)), 2))
-        x2 = x2.view(-1, self.feat_size)
+        x2 = x2.reshape(-1, self.feat_size)
         x3 = F.relu(self.fc1(x2))
         x4 = F.log_softmax(self.fc2(x3), dim=1)
 
@@ -57,7 +57,7 @@ class LeNetExt(nn.Module):
         out = F.relu(F.max_pool2d(self.conv1(x), 2))
         out = F.relu(F.max_pool2d(self.conv2_drop(self.conv2(out)), 2))
         # print("F Size out: ", out.size())
-        out = out.view(out.size(0), -1)
+        out = out.reshape(out.size(0), -1)
         out = F.relu(self.fc1(out))
         out = F.relu(self.fc2(out))
         out = F.relu(self.fc3(out))
@@ -70,7 +70,7 @@ class LeNetExt(nn.Module):
         x1 = F.relu(F.max_pool2d(self.conv1(x), 2))
         x2 = F.relu(F.max_pool2d(self.conv2_drop(self.conv2(x1)), 2))
         # print("FF Size x2: ", x2.size())
-        x2 = x2.view(x2.size(0), -1)
+        x2 = x2.reshape(x2.size(0), -1)
         x3 = F.relu(self.fc1(x2))
         x4 = F.relu(self.fc2(x3))
         x5 = F.relu(self.fc3(x4))
@@ -94,7 +94,7 @@ class ResNet(nn.Module):
         x = self.layer4(x)
         x = F.avg_pool2d(x, 4)
         # print("F Size x: ", x.size())
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         # print("F Size x: ", x.size())
         out = self.linear(x)
         
@@ -108,7 +108,7 @@ class ResNet(nn.Module):
         x5 = self.layer4(x4)
         x6 = F.avg_pool2d(x5, 4)
         # print("FF Size x6: ", x6.size())
-        x7 = x6.view(x6.size(0), -1)
+        x7 = x6.reshape(x6.size(0), -1)
         out = self.linear(x7)
         
         return [x1, x2, x3, x4, x5, x6, x7, out]  # return [x4, x5, x6, x7, out] 
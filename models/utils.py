@@ -1,86 +1,42 @@
+import importlib
 import os
 
 from config import IMG_SIZE
 from numpy import inf
+from savers import load_checkpoint
 
-from .alexnet import *
-from .conv_x import *
-from .densenet import *
-from .fcnet import *
-from .inception import *
-from .lenet import *
-from .resnet import *
-from .vgg import *
+# (name, dataset) -> (module, constructor, display name, input size, keyword arguments); dataset None matches any dataset.
+# Architectures are imported on demand, so only the module of the requested one is loaded.
+MODELS = {
+    ('conv_2', None): ('conv_x', 'Conv_2', 'Conv_2', IMG_SIZE, {'num_classes': 10}),
+    ('conv_4', None): ('conv_x', 'Conv_4', 'Conv_4', IMG_SIZE, {'num_classes': 10}),
+    ('conv_6', None): ('conv_x', 'Conv_6', 'Conv_6', IMG_SIZE, {'num_classes': 10}),
+    ('fcnet', None): ('fcnet', 'FCNet', 'FCNet', 3, {'input_size': 3, 'num_classes': 3}),
+    ('lenet', 'mnist'): ('lenet', 'LeNet', 'LeNet', 28, {'num_channels': 1, 'num_classes': 10, 'input_size': 28}),
+    ('lenet', 'imagenet'): ('lenet', 'LeNet', 'LeNet', IMG_SIZE, {'num_channels': 3, 'num_classes': 10, 'input_size': IMG_SIZE}),
+    ('lenetext', 'imagenet'): ('lenet', 'LeNetExt', 'LeNetExt', IMG_SIZE, {'n_channels': 3, 'num_classes': 10, 'input_size': IMG_SIZE}),
+    ('lenetext', 'mnist'): ('lenet', 'LeNetExt', 'LeNetExt', 32, {'n_channels': 1, 'num_classes': 10}),
+    ('vgg', 'mnist'): ('vgg', 'VGG', 'VGG9', 28, {'vgg_name': 'VGG9', 'img_size': 28, 'num_classes': 10}),
+    ('vgg', 'imagenet'): ('vgg', 'VGG', 'VGG16', IMG_SIZE, {'vgg_name': 'VGG16', 'img_size': IMG_SIZE, 'num_classes': 10}),
+    ('resnet', 'imagenet'): ('resnet', 'ResNet18', 'ResNet', IMG_SIZE, {'num_classes': 10, 'input_size': IMG_SIZE}),
+    ('densenet', 'imagenet'): ('densenet', 'DenseNet121', 'DenseNet121', IMG_SIZE, {'num_classes': 10}),
+    ('inception', 'imagenet'): ('inception', 'GoogLeNet', 'InceptionV3', IMG_SIZE, {'num_classes': 10}),
+    ('alexnet', 'imagenet'): ('alexnet', 'AlexNet', 'AlexNet', IMG_SIZE, {'num_classes': 10, 'input_size': IMG_SIZE}),
+}
 
 
-def get_model(name, dataset):
-    if name == 'conv_2':
-        print("\n Fetching Conv_2")
-        print("Input size:", IMG_SIZE)
-        net = Conv_2(num_classes=10)
-    elif name == 'conv_4':
-        print("\n Fetching Conv_4")
-        print("Input size:", IMG_SIZE)
-        net = Conv_4(num_classes=10)
-    elif name == 'conv_6':
-        print("\n Fetching Conv_6")
-        print("Input size:", IMG_SIZE)
-        net = Conv_6(num_classes=10)
-
-    elif name == 'fcnet':
-        print("\n Fetching FCNet")
-        print("Input size: ", 3, '\n')
-        net = FCNet(input_size=3, num_classes=3)
-    
-    elif name=='lenet' and dataset == 'mnist':
-        print("\n Fetching LeNet")
-        print("Input size: ", 28, '\n')
-        net = LeNet(num_channels=1, num_classes=10, input_size=28)
-    elif name=='lenet' and dataset == 'imagenet':
-        print("\n Fetching LeNet")
-        print("Input size:", IMG_SIZE)
-        net = LeNet(num_channels=3, num_classes=10, input_size=IMG_SIZE)
-    
-    elif name=='lenetext' and dataset=='imagenet':
-        print("\n Fetching LeNetExt")
-        print("Input size:", IMG_SIZE)
-        net = LeNetExt(n_channels=3, num_classes=10, input_size=IMG_SIZE)
-    elif name=='lenetext' and dataset=='mnist':
-        print("\n Fetching LeNetExt")
-        print("Input size: ", 32, '\n')
-        net = LeNetExt(n_channels=1, num_classes=10)
-
-    elif name=='vgg' and dataset=='mnist':
-        print("\n Fetching VGG9")
-        print("Input size:", 28, '\n')
-        net = VGG('VGG9', img_size=28, num_classes=10)
-    elif name=='vgg' and dataset=='imagenet':
-        print("\n Fetching VGG16")
-        print("Input size:", IMG_SIZE)
-        net = VGG('VGG16', img_size=IMG_SIZE, num_classes=10)
-    
-    elif name=='resnet' and dataset=='imagenet':
-        print("\n Fetching ResNet")
-        print("Input size:", IMG_SIZE)
-        net = ResNet18(num_classes=10, input_size=IMG_SIZE)
+def model_names():
+    return sorted(set(name for name, _ in MODELS))
 
-    elif name=='densenet' and dataset=='imagenet':
-        print("\n Fetching DenseNet121")
-        print("Input size:", IMG_SIZE)
-        net = DenseNet121(num_classes=10)
-    
-    elif name=='inception' and dataset=='imagenet':
-        print("\n Fetching InceptionV3")
-        print("Input size:", IMG_SIZE)
-        net = GoogLeNet(num_classes=10)
-    
-    elif name=='alexnet' and dataset=='imagenet':
-        print("\n Fetching AlexNet")
-        print("Input size:", IMG_SIZE)
-        net = AlexNet(num_classes=10, input_size=IMG_SIZE)
-    
-    else:
+def get_model(name, dataset):
+    entry = MODELS.get((name, dataset), MODELS.get((name, None)))
+    if entry is None:
         raise ValueError(f"{name} and {dataset} combination not valid")
+    module, constructor, display_name, input_size, kwargs = entry
+
+    print(f"\n Fetching {display_name}")
+    print("Input size:", input_size, '\n')
+    net = getattr(importlib.import_module(f'.{module}', __package__), constructor)(**kwargs)
 
     print("Trainable Params:", sum(p.numel() for p in net.parameters() if p.requires_grad), '\n')
     return net
@@ -93,11 +49,11 @@ def init_from_checkpoint(net, optimizer, args, start=False):
     if args.dataset == 'imagenet':
         if start:
             print('==> Starting from original weight init..')
-            checkpoint = torch.load(f'./checkpoint/{args.net}/{args.net}_{args.dataset}_ss0/ckpt_epoch_0.pt')
+            checkpoint = load_checkpoint(f'./checkpoint/{args.net}/{args.net}_{args.dataset}_ss0/ckpt_epoch_0.pt')
         else:
-            checkpoint = torch.load(f'./checkpoint/{args.net}/{args.net}_{args.dataset}_ss{args.iter}/ckpt_epoch_{args.resume_epoch}.pt')
+            checkpoint = load_checkpoint(f'./checkpoint/{args.net}/{args.net}_{args.dataset}_ss{args.iter}/ckpt_epoch_{args.resume_epoch}.pt')
     else:
-        checkpoint = torch.load(f'./checkpoint/{args.net}/{args.net}_{args.dataset}/ckpt_epoch_{args.resume_epoch}.pt')
+        checkpoint = load_checkpoint(f'./checkpoint/{args.net}/{args.net}_{args.dataset}/ckpt_epoch_{args.resume_epoch}.pt')
     
     keys = checkpoint.keys()
     if 'net' in keys:
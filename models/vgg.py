@@ -38,7 +38,7 @@ class VGG(nn.Module):
             x = self.features(x)
 
         # print(f'Size of x:', x.size())
-        out = x.view(x.size(0), -1)
+        out = x.reshape(x.size(0), -1)
         # print(f'Size of out:', out.size())
         out = self.classifier(out)
         
@@ -0,0 +1,218 @@
+''' Train K replicas of one architecture in a single process, e.g. for a sweep over ImageNet subsets or seeds.
+
+The replicas' parameters are stacked with torch.func.stack_module_state and every step runs all of them at
+once through vmap over a stacked (K, batch, ...) input, one batch from each replica's own loader. The losses
+are summed, so each replica receives exactly the gradient of its own loss. The optimizers used here update
+elementwise, so one optimizer over the stacked parameters is K independent optimizers; its state is split
+per replica when checkpointing. Checkpoints, losses and test transforms are written per replica where
+train.py would write them, so build_graph_functional.py and post_process.py run on them unchanged. Seed replicas
+live in <name>_seed<seed> folders, which those scripts read with --seed; main.py and scripts/scheduler.py only
+chain unseeded runs, so with --seeds run both scripts per seed:
+
+    python build_graph_functional.py --net lenet --dataset mnist --seed 2 --chkpt_epochs 0 10 20
+    python post_process.py --net lenet --dataset mnist --seed 2 --chkpt_epochs 0 10 20 --save_dir ./results/lenet_mnist_seed2
+
+Models with BatchNorm are not supported: their running statistics are updated in place, which vmap does not allow.
+
+    python multi_train.py --net lenet --dataset imagenet --iters 0 1 2 3 --chkpt_epochs 0 4 8 20 30 40 50
+    python multi_train.py --net lenet --dataset mnist --seeds 1 2 3 --chkpt_epochs 0 10 20
+'''
+import argparse
+import copy
+import os
+import pickle
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.func import functional_call, stack_module_state, vmap
+
+from config import SEED
+from loaders import eval_transform, loader
+from models.utils import get_model
+from savers import AsyncCheckpointWriter, load_checkpoint, save_checkpoint, save_losses
+from utils import progress_bar
+
+
+class ReplicaStack():
+    ''' K copies of an architecture evaluated together; parameters are (K, ...) leaf tensors. '''
+    def __init__(self, nets):
+        for net in nets:
+            if any(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in net.modules()):
+                raise ValueError(f'{type(net).__name__} has BatchNorm layers, which cannot be trained as stacked replicas')
+
+        self.k = len(nets)
+        self.base = copy.deepcopy(nets[0]).to('meta')
+        self.params, self.buffers = stack_module_state(nets)
+
+    def parameters(self):
+        return list(self.params.values())
+
+    def train(self, mode=True):
+        self.base.train(mode)
+
+    def eval(self):
+        self.base.train(False)
+
+    def __call__(self, inputs):
+        ''' inputs: (K, batch, ...) -> (K, batch, classes) '''
+        def call(params, buffers, x):
+            return functional_call(self.base, (params, buffers), (x,))
+
+        return vmap(call, randomness='different')(self.params, self.buffers, inputs)
+
+    def state_dict(self, r):
+        ''' state dict of replica r, as net.state_dict() of a single model '''
+        state = {name: p[r].detach().clone() for name, p in self.params.items()}
+        state.update({name: b[r].detach().clone() for name, b in self.buffers.items()})
+
+        return state
+
+def replica_optimizer_state(optimizer, stack, r):
+    ''' Slice the state of an optimizer over stacked parameters into the state dict of a single-model optimizer '''
+    full = optimizer.state_dict()
+    shapes = [p.shape for p in stack.parameters()]
+
+    state = {}
+    for idx, param_state in full['state'].items():
+        state[idx] = {key: value[r].clone() if torch.is_tensor(value) and value.shape == shapes[idx] else copy.deepcopy(value)
+                      for key, value in param_state.items()}
+
+    return {'state': state, 'param_groups': copy.deepcopy(full['param_groups'])}
+
+def replica_names(args):
+    ''' (ONAME, subset iter, seed) of every replica '''
+    if args.seeds:
+        base = f'{args.net}_{args.dataset}_ss{args.iters[0]}' if args.dataset == 'imagenet' else f'{args.net}_{args.dataset}'
+        return [(f'{base}_seed{seed}', args.iters[0], seed) for seed in args.seeds]
+
+    return [(f'{args.net}_{args.dataset}_ss{i}' if args.dataset == 'imagenet' else f'{args.net}_{args.dataset}', i, SEED) for i in args.iters]
+
+def stacked_pass(stack, loaders, device, optimizer=None):
+    ''' One pass over zip(loaders); returns per-replica per-batch losses (n_batches, K) and accuracies (K,) in %. '''
+    n_batches = min(len(dl) for dl in loaders)
+    losses = torch.zeros(n_batches, stack.k, device=device)
+    correct = torch.zeros(stack.k, dtype=torch.long, device=device)
+    total = 0
+
+    for batch_idx, batches in enumerate(zip(*loaders)):
+        inputs = torch.stack([x for x, _ in batches]).to(device, non_blocking=True)
+        targets = torch.stack([y for _, y in batches]).to(device, non_blocking=True)
+
+        outputs = stack(inputs)
+        loss = F.cross_entropy(outputs.flatten(0, 1), targets.flatten(), reduction='none').view(stack.k, -1).mean(dim=1)
+
+        if optimizer is not None:
+            optimizer.zero_grad()
+            loss.sum().backward()
+            optimizer.step()
+
+        losses[batch_idx] = loss.detach()
+        correct += outputs.detach().argmax(-1).eq(targets).sum(dim=1)
+        total += targets.size(1)
+        progress_bar(batch_idx, n_batches)
+
+    return losses.double().cpu().numpy(), (100. * correct.double() / max(total, 1)).cpu().numpy()
+
+def run_pass(stack, loaders, device, optimizer=None):
+    if optimizer is not None:
+        stack.train()
+        return stacked_pass(stack, loaders, device, optimizer)
+
+    stack.eval()
+    with torch.no_grad():
+        return stacked_pass(stack, loaders, device)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train replicas of a network on several subsets or seeds in one process')
+    parser.add_argument('--net')
+    parser.add_argument('--dataset')
+    parser.add_argument('--iters', nargs='+', type=int, default=[0], help='Subsets, one replica each (ImageNet).')
+    parser.add_argument('--seeds', nargs='+', type=int, default=[], help='Seeds, one replica each on the first subset.')
+    parser.add_argument('--lr', default=0.001, type=float)
+    parser.add_argument('--optimizer', default='adabelief', type=str)
+    parser.add_argument('--epochs', default=50, type=int)
+    parser.add_argument('--train_batch_size', default=32, type=int)
+    parser.add_argument('--test_batch_size', default=32, type=int)
+    parser.add_argument('--chkpt_epochs', nargs='+', action='extend', type=int, default=[])
+    parser.add_argument('--async_checkpoints', default=1, type=int, help='Write checkpoints from a background thread.')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    replicas = replica_names(args)
+    if len(set(name for name, _, _ in replicas)) < len(replicas):
+        raise ValueError('Replicas would share checkpoint folders; use --seeds for datasets without subsets')
+    print(f'Training {len(replicas)} replicas of {args.net}: {", ".join(name for name, _, _ in replicas)}\n')
+
+    ''' Per-replica loaders; the replicas step together, so an epoch is as long as the shortest loader '''
+    train_loaders, test_loaders = [], []
+    for oname, i, seed in replicas:
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        train_loader, train_transform = loader(f'{args.dataset}_train', batch_size=args.train_batch_size, iter=i, verbose=False)
+        test_transform = eval_transform(train_transform, args.dataset)
+        test_loader, _ = loader(f'{args.dataset}_test', batch_size=args.test_batch_size, iter=i, verbose=False, transform=test_transform)
+        train_loaders.append(train_loader)
+        test_loaders.append(test_loader)
+
+        trans_dir = f'./train_processing/{args.net}/{oname}'
+        os.makedirs(trans_dir, exist_ok=True)
+        with open(os.path.join(trans_dir, 'test_transform.pkl'), 'wb') as f:
+            pickle.dump(test_transform, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    ''' Build replicas; as in train.py, later subsets start from the initial weights of subset 0 '''
+    nets = []
+    for oname, i, seed in replicas:
+        torch.manual_seed(seed)
+        net = get_model(args.net, args.dataset)
+        init_file = f'./checkpoint/{args.net}/{args.net}_{args.dataset}_ss0/ckpt_epoch_0.pt'
+        if args.dataset == 'imagenet' and i != 0 and not args.seeds and os.path.exists(init_file):
+            net.load_state_dict(load_checkpoint(init_file)['net'])
+        nets.append(net.to(device))
+    stack = ReplicaStack(nets)
+    del nets
+
+    if args.optimizer == 'adabelief':
+        from adabelief_pytorch import AdaBelief
+        optimizer = AdaBelief(stack.parameters(), lr=args.lr, eps=1e-8, betas=(0.9, 0.999), weight_decay=1e-2, weight_decouple=True, rectify=False, fixed_decay=False, amsgrad=False)
+    elif args.optimizer == 'adam':
+        optimizer = optim.Adam(stack.parameters(), lr=args.lr, weight_decay=5e-4)
+    else:
+        optimizer = optim.SGD(stack.parameters(), lr=args.lr, momentum=0.9, weight_decay=5e-4)
+
+    writer = AsyncCheckpointWriter() if args.async_checkpoints else None
+
+    def checkpoint(epoch, **metrics):
+        for r, (oname, _, _) in enumerate(replicas):
+            state = {'net': stack.state_dict(r), 'optimizer': replica_optimizer_state(optimizer, stack, r)}
+            state.update({key: value[r] for key, value in metrics.items()})
+            if epoch > 0:
+                state['epoch'] = epoch
+            save_checkpoint(state, path=f'./checkpoint/{args.net}/{oname}/', fname=f'ckpt_epoch_{epoch}.pt', writer=writer)
+
+    ''' Initial pass before any training '''
+    loss_te, acc_te = run_pass(stack, test_loaders, device)
+    checkpoint(0, loss_te=loss_te.T, acc_te=acc_te)
+
+    losses = [[] for _ in replicas]
+    for epoch in range(1, args.epochs + 1):
+        print(f'Epoch {epoch}')
+
+        loss_tr, acc_tr = run_pass(stack, train_loaders, device, optimizer)
+        loss_te, acc_te = run_pass(stack, test_loaders, device)
+
+        for r in range(len(replicas)):
+            losses[r].append({'loss_tr': loss_tr[:, r], 'loss_te': loss_te[:, r], 'acc_tr': acc_tr[r], 'acc_te': acc_te[r], 'epoch': int(epoch)})
+        print(' | '.join(f'{oname}: {acc_te[r]:.2f}%' for r, (oname, _, _) in enumerate(replicas)))
+
+        if epoch in args.chkpt_epochs:
+            checkpoint(epoch, loss_tr=loss_tr.T, loss_te=loss_te.T, acc_tr=acc_tr, acc_te=acc_te)
+
+    for r, (oname, _, _) in enumerate(replicas):
+        save_losses(losses[r], path=f'./losses/{args.net}/{oname}', fname='/stats.pkl')
+
+    if writer is not None:
+        writer.flush()
@@ -0,0 +1,97 @@
+''' One-time packer for ImageNet subsets and MNIST.
+
+Each split is written to PACKED_DIR as
+    images.u8      contiguous (N, H, W, C) uint8 array, read back through np.memmap
+    labels.npy     (N,) int64 labels
+    manifest.json  shape, image mode, source of the shard and the loaders.source_hash of the source
+loaders.get_dataset picks packed shards up automatically, and falls back to the source once it changes.
+
+    python packing.py --dataset imagenet --start 0 --stop 29
+    python packing.py --dataset mnist
+'''
+import argparse
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torchvision.transforms as transforms
+from PIL import Image
+
+from config import IMG_SIZE, SUBSETS_LIST
+from loaders import CustomImageNet, CustomMNIST, imagenet_paths, packed_path, source_hash
+
+
+def write_pack(out_dir, images, labels, mode, source, signature=None, n_workers=None):
+    ''' Write a shard from a sequence of image loaders; signature is the loaders.source_hash of the source.
+    images: list of callables returning (H, W, C) uint8 arrays of identical shape, evaluated on a thread pool. '''
+    n = len(labels)
+    first = images[0]()
+    shape = (n,) + first.shape
+
+    tmp_dir = f'{out_dir}.tmp'
+    os.makedirs(tmp_dir, exist_ok=True)
+    packed = np.memmap(os.path.join(tmp_dir, 'images.u8'), dtype=np.uint8, mode='w+', shape=shape)
+
+    def fill(k):
+        packed[k] = images[k]() if k > 0 else first
+
+    n_workers = n_workers if n_workers is not None else min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        list(pool.map(fill, range(n)))
+    packed.flush()
+
+    np.save(os.path.join(tmp_dir, 'labels.npy'), np.asarray(labels, dtype=np.int64))
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump({'shape': list(shape), 'mode': mode, 'source': source, 'source_hash': signature, 'n': n}, f, indent=1)
+
+    # publish the finished shard in one step so readers never see a partial pack
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+    print(f'Packed {n} images of shape {shape[1:]} to {out_dir}')
+
+def pack_imagenet(iter, train, n_workers=None):
+    ''' Pack one ImageNet subset; images are stored as CenterCrop(IMG_SIZE) of the source, which leaves
+    the pre-resized 32 and 64 pixel sets unchanged. '''
+    path = imagenet_paths()[0 if train else 1]
+    signature = source_hash('imagenet', path, train=train, iter=iter)
+    dataset = CustomImageNet(path, 'data/map_clsloc.txt', subset=SUBSETS_LIST[iter], verbose=False, iter=iter)
+    crop = transforms.CenterCrop((IMG_SIZE, IMG_SIZE))
+
+    def load(img_path):
+        def _load():
+            with Image.open(img_path) as img:
+                return np.asarray(crop(img.convert('RGB')), dtype=np.uint8)
+        return _load
+
+    write_pack(packed_path('imagenet', train=train, iter=iter), [load(img_path) for img_path, _ in dataset.data],
+               [label for _, label in dataset.data], mode='RGB', source=path, signature=signature, n_workers=n_workers)
+
+def pack_mnist(train):
+    ''' Pack an MNIST split straight from the torchvision tensors. '''
+    mnist = CustomMNIST(train=train).data
+    images = mnist.data.numpy()[..., None]
+
+    write_pack(packed_path('mnist', train=train), [lambda k=k: images[k] for k in range(len(images))],
+               mnist.targets.numpy(), mode='L', source=mnist.root, signature=source_hash('mnist', train=train), n_workers=1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack datasets into memory-mapped uint8 shards')
+    parser.add_argument('--dataset', required=True, help='imagenet or mnist')
+    parser.add_argument('--start', default=0, type=int, help='First ImageNet subset to pack.')
+    parser.add_argument('--stop', default=len(SUBSETS_LIST)-1, type=int, help='Last ImageNet subset to pack.')
+    parser.add_argument('--splits', nargs='+', default=['train', 'test'])
+    parser.add_argument('--workers', default=None, type=int, help='Decoding threads.')
+    args = parser.parse_args()
+
+    for split in args.splits:
+        if args.dataset == 'imagenet':
+            for i in range(args.start, args.stop+1):
+                pack_imagenet(i, train=(split == 'train'), n_workers=args.workers)
+        elif args.dataset == 'mnist':
+            pack_mnist(train=(split == 'train'))
+        else:
+            raise ValueError(f'Invalid dataset: {args.dataset}')
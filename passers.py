@@ -1,9 +1,9 @@
-import os
-
 import numpy as np
 import torch
 
+from capture import RunningPearson
 from config import SEED
+from execution import ExecutionMode
 from graph import signal_concat
 from utils import progress_bar
 
@@ -17,42 +17,81 @@ def get_accuracy(predictions, targets):
     return 100. * (correct / total)
 
 
+class MetricsAccumulator():
+    ''' Running loss and accuracy kept on the device. Per-batch losses go to a preallocated tensor and correct
+    predictions to a device counter, so a training step does not wait for the device; values reach the host
+    only every sync_every batches and at the end of the pass. '''
+    def __init__(self, n_batches, device, sync_every=50):
+        self.losses = torch.zeros(n_batches, device=device)
+        self.correct = torch.zeros((), dtype=torch.long, device=device)
+        self.total = 0
+        self.n = 0
+        self.sync_every = sync_every
+
+    def update(self, loss, outputs, targets):
+        self.losses[self.n] = loss.detach()
+        self.correct += outputs.detach().argmax(1).eq(targets).sum()
+        self.total += targets.size(0)
+        self.n += 1
+
+    def due(self):
+        return self.n % self.sync_every == 0 or self.n == len(self.losses)
+
+    def summary(self):
+        ''' (mean loss, last loss, accuracy in %) with a single device to host transfer; nan losses without batches '''
+        if self.n == 0:
+            return float('nan'), float('nan'), 0.
+        losses = self.losses[:self.n]
+        mean, last, correct = torch.stack([losses.mean(), losses[-1], self.correct.to(losses.dtype)]).tolist()
+
+        return mean, last, 100. * correct / max(self.total, 1)
+
+    def result(self):
+        ''' Per-batch losses and accuracy in %, as returned by Passer.run '''
+        _, _, acc = self.summary()
+
+        return self.losses[:self.n].double().cpu().numpy(), acc
+
+
 class Passer():
-    def __init__(self, net, loader, criterion, device, repeat=1):
+    def __init__(self, net, loader, criterion, device, repeat=1, execution=None):
         self.network = net
         self.criterion = criterion
         self.device = device
         self.loader = loader
         self.repeat = repeat
+        self.execution = execution if execution is not None else ExecutionMode(device=device)
 
-    def _pass(self, optimizer=None, mask=None):
+    def _pass(self, optimizer=None, mask=None, sync_every=50):
         ''' Main data passing routing '''
-        losses, features, total, correct = [], [], 0, 0
-        accuracies = []
-        
+        metrics = MetricsAccumulator(self.repeat * len(self.loader), self.device, sync_every=sync_every)
+        msg = None
+
         for r in range(1, self.repeat + 1):
             for batch_idx, (inputs, targets) in enumerate(self.loader):
-                inputs, targets = inputs.to(self.device), targets.to(self.device)
+                inputs, targets = self.execution.inputs(inputs.to(self.device, non_blocking=True)), targets.to(self.device, non_blocking=True)
             
                 if optimizer: 
                     optimizer.zero_grad()
 
-                if mask:
-                    outputs = self.network(inputs, mask)
-                else:
-                    outputs = self.network(inputs)
+                with self.execution.autocast():
+                    if mask:
+                        outputs = self.network(inputs, mask)
+                    else:
+                        outputs = self.network(inputs)
 
-                loss = self.criterion(outputs, targets)
-                losses.append(loss.item())
+                    loss = self.criterion(outputs, targets)
 
                 if optimizer is not None:
                     loss.backward()
                     optimizer.step()
 
-                accuracies.append(get_accuracy(outputs, targets))
-                progress_bar((r-1)*len(self.loader)+batch_idx, r*len(self.loader), 'repeat %d -- Mean Loss: %.3f | Last Loss: %.3f | Acc: %.3f%%' % (r, np.mean(losses), losses[-1], np.mean(accuracies)))
+                metrics.update(loss, outputs, targets)
+                if metrics.due():
+                    msg = 'repeat %d -- Mean Loss: %.3f | Last Loss: %.3f | Acc: %.3f%%' % ((r,) + metrics.summary())
+                progress_bar((r-1)*len(self.loader)+batch_idx, self.repeat*len(self.loader), msg)
 
-        return np.asarray(losses), np.mean(accuracies)
+        return metrics.result()
 
     def get_sample(self):
         iterator = iter(self.loader)
@@ -101,10 +140,14 @@ class Passer():
             # 3 layer FCNet, are of size 100x3 and 100x4, respectively, where 100 is the
             # batch size and the second dimension is the number of neurons in the layer.
             
-            for f in self.network.forward_features(inputs):
+            with self.execution.autocast():
+                outputs = self.network.forward_features(self.execution.inputs(inputs))
+
+            for f in outputs:
                 assert not torch.isnan(f).any(), 'NaN in forward_features at passers.py:get_function()'
 
-            features.append([f.cpu().data.numpy().astype(np.float32) for f in self.network.forward_features(inputs)])
+            # cast before leaving torch: numpy has no bfloat16
+            features.append([f.float().cpu().data.numpy() for f in outputs])
                 
             progress_bar(batch_idx, len(self.loader))
 
@@ -127,8 +170,34 @@ class Passer():
         features = [np.concatenate(list(zip(*features))[i]) for i in range(len(features[0]))]
         features = signal_concat(features).T # put in data x features format; samples are rows, features are columns
         
+        print(f"\nFeatures size: {features.shape}")
+
+        return self.reduce(features, reduction=reduction, device_list=device_list, corr=corr, exp=exp)
+
+    @torch.no_grad()
+    def get_correlation(self):
+        ''' Pearson correlation of the forward_features() of the loader, as graph.adjacency(self.get_function()),
+        accumulated batch by batch so that the (samples, features) activations are never held at once '''
+        stats = RunningPearson()
+
+        for batch_idx, (inputs, targets) in enumerate(self.loader):
+            inputs = inputs.to(self.device)
+
+            with self.execution.autocast():
+                outputs = self.network.forward_features(self.execution.inputs(inputs))
+
+            # layers in the order of graph.signal_concat
+            stats.update(torch.cat([f.float().reshape(f.shape[0], -1) for f in outputs], dim=1))
+
+            progress_bar(batch_idx, len(self.loader))
+
+        return stats.corrcoef().float()
+
+    @torch.no_grad()
+    def reduce(self, features, reduction=None, device_list=None, corr='pearson', exp=1):
+        ''' Apply a reduction to (samples, features) activations, e.g. collected by get_function or captured
+        during training; returns them in features x data format. '''
         m, n = features.shape
-        print(f"\nFeatures size: {(m, n)}")
 
         if reduction is not None:
             torch.cuda.empty_cache()
@@ -233,7 +302,7 @@ class Passer():
             lr=1e-3,
             epochs=num_epochs,
             batch_size=64,
-            num_workers=os.cpu_count() // 2 if os.cpu_count() > 1 else 1,
+            num_workers=max(1, torch.get_num_threads() // 2), # half of the torch share of the core budget
             num_gpus=len(device_list) if device_list is not None else 0,
             match_nonparametric_umap=False # Train network to match embeddings from non parametric umap
         )
@@ -0,0 +1,143 @@
+''' Queued rendering of plotly figures to image files.
+
+Figures are submitted as JSON specs and rendered by a pool of worker processes. Each worker keeps its
+kaleido session alive for the lifetime of the pool, so the chromium start-up is paid once per worker
+rather than once per image. Rendering modes:
+    sync:  render in the calling process (previous behaviour)
+    async: render on a worker pool; submit() returns immediately
+    defer: write the figure specs next to their targets and a manifest, by default render_manifest.json in
+           the run's save_dir; render later with
+           python render.py <manifest>
+    off:   data-only; no figures are written
+'''
+import argparse
+import json
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+RENDER_MODES = ('sync', 'async', 'defer', 'off')
+
+
+def _render_spec(spec, path, format):
+    ''' Worker entry point; plotly keeps one kaleido scope per process so it is reused across calls. '''
+    import plotly.io as pio
+
+    fig = pio.from_json(spec)
+    fig.write_image(path, format=format)
+
+    return path
+
+
+def _make_pool(n_workers):
+    ''' Fork where available: the plotting scripts do their work at import time, so spawned
+    workers would re-run them when re-importing __main__. '''
+    method = 'fork' if 'fork' in mp.get_all_start_methods() else 'spawn'
+
+    return ProcessPoolExecutor(max_workers=n_workers, mp_context=mp.get_context(method))
+
+
+class FigureRenderer():
+    def __init__(self, mode='async', n_workers=None, manifest=None, save_dir=None):
+        if mode not in RENDER_MODES:
+            raise ValueError(f'Render mode {mode} not supported! Use one of {RENDER_MODES}')
+
+        self.mode = mode
+        self.n_workers = n_workers if n_workers is not None else max(1, min(4, (os.cpu_count() or 1) // 2))
+        self.manifest = manifest if manifest is not None else os.path.join(save_dir if save_dir is not None else '.', 'render_manifest.json')
+        self.futures = []
+        self.deferred = []
+        self.pool = None
+
+    def submit(self, fig, path, format='png'):
+        ''' Queue fig for rendering to path. '''
+        if self.mode == 'off':
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        if self.mode == 'sync':
+            fig.write_image(path, format=format)
+        elif self.mode == 'async':
+            if self.pool is None:
+                self.pool = _make_pool(self.n_workers)
+            self.futures.append(self.pool.submit(_render_spec, fig.to_json(), path, format))
+        else:
+            spec_path = f'{os.path.splitext(path)[0]}.json'
+            with open(spec_path, 'w') as f:
+                f.write(fig.to_json())
+            self.deferred.append({'spec': spec_path, 'path': path, 'format': format})
+
+    def close(self):
+        ''' Wait for queued figures and write the manifest of deferred ones. '''
+        failed = 0
+        for future in as_completed(self.futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                print(f'Rendering failed: {e}')
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if len(self.futures) > 0:
+            print(f'Rendered {len(self.futures) - failed}/{len(self.futures)} figures')
+        self.futures = []
+
+        if self.mode == 'defer' and len(self.deferred) > 0:
+            _update_manifest(self.manifest, self.deferred)
+            print(f'Deferred {len(self.deferred)} figures to {self.manifest}')
+            self.deferred = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _update_manifest(manifest, entries):
+    ''' Merge entries into the manifest, one per target path with the latest entry winning. Runs sharing a manifest
+    serialise on a lock file, and the manifest is replaced in one step. '''
+    os.makedirs(os.path.dirname(os.path.abspath(manifest)), exist_ok=True)
+    with open(f'{manifest}.lock', 'w') as lock:
+        if os.name == 'posix':
+            import fcntl
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        existing = []
+        if os.path.exists(manifest):
+            with open(manifest, 'r') as f:
+                existing = json.load(f)
+        merged = {entry['path']: entry for entry in existing + entries}
+        tmp = f'{manifest}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(list(merged.values()), f, indent=1)
+        os.replace(tmp, manifest)
+
+def render_manifest(manifest, n_workers=None):
+    ''' Render all figure specs listed in a manifest written in defer mode. '''
+    with open(manifest, 'r') as f:
+        entries = json.load(f)
+
+    with FigureRenderer('async', n_workers=n_workers) as renderer:
+        for entry in entries:
+            with open(entry['spec'], 'r') as f:
+                spec = f.read()
+            if renderer.pool is None:
+                renderer.pool = _make_pool(renderer.n_workers)
+            renderer.futures.append(renderer.pool.submit(_render_spec, spec, entry['path'], entry['format']))
+
+def add_render_args(parser):
+    ''' Command-line options shared by the plotting scripts '''
+    parser.add_argument('--render', default='async', type=str, help=f'Figure rendering mode: {", ".join(RENDER_MODES)}.')
+    parser.add_argument('--render_workers', default=None, type=int, help='Number of rendering processes.')
+    parser.add_argument('--render_manifest', default=None, type=str, help='Manifest file for deferred figures; default: render_manifest.json in the save directory.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render deferred figures')
+    parser.add_argument('manifest', help='Manifest written by a run with --render defer.')
+    parser.add_argument('--workers', default=None, type=int)
+    args = parser.parse_args()
+
+    render_manifest(args.manifest, n_workers=args.workers)
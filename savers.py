@@ -1,19 +1,97 @@
+import atexit
+import gzip
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import torch
 import pickle as pkl 
 import h5py 
 
+GZIP_MAGIC = b'\x1f\x8b'
 
-def save_checkpoint(checkpoint, path, fname):
-    """ Save checkpoint to path with fname """
+
+def save_checkpoint(checkpoint, path, fname, writer=None):
+    """ Save checkpoint to path with fname; with an AsyncCheckpointWriter the write happens in the background """
 
     print(f'Saving checkpoint...\n')
 
     if not os.path.isdir(path):
-        os.makedirs(path)
-        
-    torch.save(checkpoint, path+fname)
+        os.makedirs(path, exist_ok=True)
+
+    if writer is not None:
+        writer.save(checkpoint, path+fname)
+    else:
+        torch.save(checkpoint, path+fname)
+
+def load_checkpoint(fl, map_location=None):
+    """ torch.load that also reads checkpoints compressed by AsyncCheckpointWriter """
+    with open(fl, 'rb') as f:
+        compressed = f.read(2) == GZIP_MAGIC
+
+    if compressed:
+        with gzip.open(fl, 'rb') as f:
+            return torch.load(f, map_location=map_location)
+
+    return torch.load(fl, map_location=map_location)
+
+def _snapshot(obj):
+    """ Copy every tensor of a (nested) state dict to host memory; pinned for device tensors so the copy is a fast DMA """
+    if isinstance(obj, torch.Tensor):
+        if obj.device.type == 'cpu':
+            return obj.detach().clone()
+        host = torch.empty(obj.shape, dtype=obj.dtype, device='cpu', pin_memory=torch.cuda.is_available())
+        return host.copy_(obj.detach(), non_blocking=True)
+    elif isinstance(obj, dict):
+        return {k: _snapshot(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+
+    return obj
+
+
+class AsyncCheckpointWriter():
+    """ Writes checkpoints from a background thread. save() snapshots the state into host buffers and returns,
+    so training continues with the next step while the file is written; at most max_in_flight snapshots are held,
+    further saves block until a write finishes. Files are written under a temporary name and renamed, optionally
+    gzip-compressed (read back with load_checkpoint). Pending writes are flushed at interpreter exit. """
+    def __init__(self, max_in_flight=2, compress=False):
+        self.compress = compress
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+        atexit.register(self.flush)
+
+    def _write(self, checkpoint, fl):
+        try:
+            tmp = f'{fl}.{os.getpid()}.tmp'
+            if self.compress:
+                with gzip.open(tmp, 'wb', compresslevel=1) as f:
+                    torch.save(checkpoint, f)
+            else:
+                torch.save(checkpoint, tmp)
+            os.replace(tmp, fl)
+        finally:
+            self.slots.release()
+
+    def save(self, checkpoint, fl):
+        self.slots.acquire()
+        try:
+            snapshot = _snapshot(checkpoint)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+        except Exception:
+            self.slots.release()
+            raise
+
+        self.futures = [future for future in self.futures if not future.done() or future.exception() is not None]
+        self.futures.append(self.pool.submit(self._write, snapshot, fl))
+
+    def flush(self):
+        """ Wait for all pending writes; re-raises the first failed write """
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
 
 def save_activations(activs, path, fname, internal_path):
     """
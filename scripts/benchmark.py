@@ -0,0 +1,215 @@
+''' Benchmark of the hot paths of build_graph_functional.py and post_process.py without a training run.
+
+Cases are seeded activation matrices (nodes x samples) over a size grid: synthetic ones with a chosen correlation
+structure and sparsity, and the hidden layers of randomly initialised ReLU networks (models/fcnet.py) at chosen
+widths. Every case times the stages
+    adjacency_pearson, adjacency_spearman, adjacency_dcorr:  graph.adjacency; dcorr up to --dcorr_max nodes
+    distance, coo:                        topology.correlation_distance and topology.distance_coo
+    collapse:                             edge collapse of the COO distance matrix
+    ripser_collapse, ripser_full:         ripser_parallel with and without edge collapse; the latter up to --full_max nodes
+    diagram:                              topology.correlation_diagram, the whole PH step of build_graph_functional.py
+    betti:                                bettis.betti_nums of the diagram
+and the median seconds of --repeat runs are written to a JSON file. Given a baseline written by an earlier run,
+stages slower than the baseline by more than --tolerance are listed and the script exits with 1:
+
+    python scripts/benchmark.py --nodes 100 200 400 --widths 50 100 --out bench_baseline.json
+    python scripts/benchmark.py --nodes 100 200 400 --widths 50 100 --baseline bench_baseline.json
+'''
+import argparse
+import json
+import os
+import platform
+import socket
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+STRUCTURES = ('independent', 'block', 'lowrank')
+
+
+def synthetic_activations(nodes, samples, structure='block', sparsity=0., strength=.5, blocks=4, rank=8, seed=0):
+    ''' Seeded (nodes, samples) activations. structure sets which nodes share signal: none (independent), one of
+    blocks latent factors per node (block) or a rank-rank factor model (lowrank); strength is the fraction of
+    variance that is shared and sparsity the fraction of zeros left per node by a ReLU at that quantile. '''
+    if structure not in STRUCTURES:
+        raise ValueError(f'Structure {structure} not supported! Use one of {STRUCTURES}')
+    if not 0. <= sparsity < 1.:
+        raise ValueError(f'Sparsity must be in [0, 1), got {sparsity}')
+
+    rng = np.random.default_rng(seed)
+    noise = rng.standard_normal((nodes, samples))
+    if structure == 'block':
+        signal = rng.standard_normal((blocks, samples))[np.arange(nodes) % blocks]
+    elif structure == 'lowrank':
+        signal = rng.standard_normal((nodes, rank)) @ rng.standard_normal((rank, samples)) / np.sqrt(rank)
+    else:
+        signal = np.zeros_like(noise)
+
+    activs = np.sqrt(strength) * signal + np.sqrt(1. - strength) * noise
+    if sparsity > 0.:
+        activs = np.maximum(activs - np.quantile(activs, sparsity, axis=1, keepdims=True), 0.)
+
+    return activs.astype(np.float32)
+
+def network_activations(width, samples, input_size=8, seed=0):
+    ''' Seeded activations of the two hidden layers of a randomly initialised FCNet of the given width on
+    gaussian inputs; (2*width, samples), in the features x data format of Passer.get_function '''
+    import torch
+    from graph import signal_concat
+    from models.fcnet import FCNet
+
+    torch.manual_seed(seed)
+    net = FCNet(input_size=input_size, num_classes=10, widths=(width, width)).eval()
+    with torch.no_grad():
+        features = net.forward_features(torch.randn(samples, input_size**2))
+
+    return signal_concat([f.numpy() for f in features])
+
+def cases(args):
+    ''' (name, activations) of the grid; activations are generated when the case is reached '''
+    for nodes in args.nodes:
+        for structure in args.structures:
+            for sparsity in args.sparsity:
+                yield f'{structure}_n{nodes}_sp{sparsity:g}', lambda nodes=nodes, structure=structure, sparsity=sparsity: \
+                    synthetic_activations(nodes, args.samples, structure=structure, sparsity=sparsity, seed=args.seed)
+    for width in args.widths:
+        yield f'fcnet_w{width}', lambda width=width: network_activations(width, args.samples, seed=args.seed)
+
+
+def timed(fn, repeat):
+    ''' (median seconds of repeat calls, result of the last call) '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - start)
+
+    return float(np.median(times)), out
+
+def benchmark_case(activs, args, n_threads):
+    ''' [(stage, seconds, counts)] of one activation matrix '''
+    import torch
+    from gph import ripser_parallel
+    from gph.python.ripser_interface import _collapse_coo
+    from scipy.sparse import coo_matrix
+
+    from bettis import betti_nums
+    from graph import adjacency
+    from topology import correlation_diagram, correlation_distance, distance_coo
+
+    device = torch.device('cpu')
+    nodes = activs.shape[0]
+    results = []
+
+    seconds, adj = timed(lambda: adjacency(activs, device=device), args.repeat)
+    results.append(('adjacency_pearson', seconds, {}))
+    seconds, _ = timed(lambda: adjacency(activs, device=device, metric='spearman'), args.repeat)
+    results.append(('adjacency_spearman', seconds, {}))
+    if nodes <= args.dcorr_max:
+        seconds, _ = timed(lambda: adjacency(activs, device=device, metric='dcorr'), 1)
+        results.append(('adjacency_dcorr', seconds, {}))
+
+    seconds, dist = timed(lambda: correlation_distance(adj.clone()), args.repeat)
+    results.append(('distance', seconds, {}))
+    seconds, (row, col, vals) = timed(lambda: distance_coo(dist), args.repeat)
+    results.append(('coo', seconds, {'edges': int(np.sum(row != col))}))
+    seconds, collapsed = timed(lambda: _collapse_coo(row, col, vals, np.inf), args.repeat)
+    results.append(('collapse', seconds, {'collapsed_edges': int(np.sum(collapsed[0] != collapsed[1]))}))
+
+    coo = coo_matrix((vals, (row, col)), shape=(nodes, nodes))
+    seconds, _ = timed(lambda: ripser_parallel(coo, metric='precomputed', maxdim=args.maxdim, n_threads=n_threads, collapse_edges=True), args.repeat)
+    results.append(('ripser_collapse', seconds, {}))
+    if nodes <= args.full_max:
+        seconds, _ = timed(lambda: ripser_parallel(coo, metric='precomputed', maxdim=args.maxdim, n_threads=n_threads, collapse_edges=False), 1)
+        results.append(('ripser_full', seconds, {}))
+
+    seconds, (dgm, _) = timed(lambda: correlation_diagram(adj.clone(), maxdim=args.maxdim, n_threads=n_threads), args.repeat)
+    results.append(('diagram', seconds, {'points': int(len(dgm))}))
+    seconds, _ = timed(lambda: betti_nums(dgm), args.repeat)
+    results.append(('betti', seconds, {}))
+
+    return results
+
+
+def compare(results, baseline, tolerance=.25, min_seconds=.01):
+    ''' Annotate results with the baseline seconds of the same case and stage; returns the results slower than
+    the baseline by more than the fraction tolerance and by more than min_seconds, which absorbs timer noise. '''
+    base = {(r['case'], r['stage']): r['seconds'] for r in baseline['results']}
+
+    regressions = []
+    for r in results:
+        seconds = base.get((r['case'], r['stage']))
+        if seconds is None:
+            continue
+        r['baseline'] = seconds
+        r['ratio'] = r['seconds'] / max(seconds, 1e-9)
+        if r['seconds'] > seconds * (1. + tolerance) and r['seconds'] - seconds > min_seconds:
+            regressions.append(r)
+
+    return regressions
+
+def environment(cores):
+    ''' Versions and machine the timings depend on '''
+    import gph
+    import torch
+
+    return {'host': socket.gethostname(), 'platform': platform.platform(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'torch': torch.__version__, 'giotto-ph': getattr(gph, '__version__', None), 'cores': cores}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on seeded synthetic activations')
+    parser.add_argument('--nodes', nargs='+', default=[50, 100, 200, 400], type=int, help='Sizes of the synthetic activation matrices.')
+    parser.add_argument('--samples', default=500, type=int, help='Samples (columns) of every activation matrix.')
+    parser.add_argument('--structures', nargs='+', default=['independent', 'block'], choices=STRUCTURES)
+    parser.add_argument('--sparsity', nargs='+', default=[0., .5], type=float, help='Fractions of zero activations.')
+    parser.add_argument('--widths', nargs='*', default=[25, 50, 100], type=int, help='Hidden widths of the random ReLU networks; pass none for synthetic cases only.')
+    parser.add_argument('--maxdim', default=1, type=int, help='Maximum homology dimension.')
+    parser.add_argument('--dcorr_max', default=100, type=int, help='Largest case timed with distance correlation.')
+    parser.add_argument('--full_max', default=200, type=int, help='Largest case timed with ripser without edge collapse.')
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--cores', default=None, type=int, help='Threads of torch, BLAS and ripser; default: the core budget of concurrency.py.')
+    parser.add_argument('--out', default='benchmark.json', type=str, help='Results file; a results file of an earlier run serves as baseline.')
+    parser.add_argument('--baseline', default=None, type=str, help='Results file to compare against.')
+    parser.add_argument('--tolerance', default=.25, type=float, help='Allowed slowdown against the baseline, as a fraction.')
+    args = parser.parse_args()
+
+    import torch
+    from threadpoolctl import threadpool_limits
+
+    from concurrency import core_budget
+
+    cores = core_budget(args.cores)
+    torch.set_num_threads(cores)
+    threadpool_limits(cores)
+
+    results = []
+    for name, make in cases(args):
+        activs = make()
+        for stage, seconds, counts in benchmark_case(activs, args, n_threads=cores):
+            results.append(dict({'case': name, 'stage': stage, 'nodes': int(activs.shape[0]), 'seconds': seconds}, **counts))
+            print(f'{name:<28} {stage:<20} {seconds:9.4f} s')
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline['environment'].get('cores') != cores or baseline['environment'].get('host') != socket.gethostname():
+            print(f'\nWarning: baseline measured on {baseline["environment"].get("host")} with {baseline["environment"].get("cores")} cores')
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+
+    settings = {k: v for k, v in vars(args).items() if k not in ('out', 'baseline', 'tolerance')}
+    with open(args.out, 'w') as f:
+        json.dump({'environment': environment(cores), 'settings': settings, 'results': results}, f, indent=1)
+    print(f'\nResults written to {args.out}')
+
+    if regressions:
+        print(f'\nSlower than {args.baseline} by more than {100*args.tolerance:.0f}%:')
+        for r in regressions:
+            print(f'  {r["case"]:<28} {r["stage"]:<20} {r["baseline"]:9.4f} s -> {r["seconds"]:9.4f} s ({r["ratio"]:.2f}x)')
+        sys.exit(1)
@@ -0,0 +1,62 @@
+''' Startup-time benchmark of the repo's modules and scripts.
+
+Every target runs in a fresh interpreter with python -X importtime, so nothing is shared between measurements:
+modules are imported, scripts (targets ending in .py) are run with --help, which returns once their imports
+and argument parsing are done. The median wall time of --repeat runs is reported together with the slowest
+top-level imports of the last run. Targets slower than --max seconds make the script exit with 1:
+
+    python scripts/import_time.py comparison.py post_process.py topology --max 1
+'''
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGETS = ('bettis', 'cache', 'concurrency', 'distances', 'topology', 'render', 'utils', 'models.utils', 'savers', 'graph', 'loaders',
+           'comparison.py', 'post_process.py', 'build_graph_functional.py', 'main.py')
+
+
+def import_time(target, repeat=3, top=5):
+    ''' (median seconds to start target in a fresh interpreter, [(cumulative seconds, module)] of the slowest imports) '''
+    cmd = [sys.executable, '-X', 'importtime'] + ([target, '--help'] if target.endswith('.py') else ['-c', f'import {target}'])
+
+    times, deps = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = subprocess.run(cmd, cwd=ROOT, capture_output=True, text=True)
+        times.append(time.perf_counter() - start)
+        if out.returncode != 0:
+            errors = [line for line in out.stderr.splitlines() if not line.startswith('import time:')]
+            raise RuntimeError(f'Starting {target} failed:\n{errors[-1] if errors else ""}')
+
+        # lines of -X importtime: "import time: self [us] | cumulative | imported package"
+        deps = []
+        for line in out.stderr.splitlines():
+            match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+            if match and len(match.group(3)) <= 3:
+                deps.append((int(match.group(2)) / 1e6, match.group(4)))
+
+    return sorted(times)[len(times) // 2], sorted(deps, reverse=True)[:top]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of modules and scripts')
+    parser.add_argument('targets', nargs='*', default=TARGETS, help='Modules to import or scripts (.py) to run with --help.')
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--top', default=3, type=int, help='Slowest top-level dependencies to show.')
+    parser.add_argument('--max', default=None, type=float, help='Fail when a target takes longer (seconds).')
+    args = parser.parse_args()
+
+    slow = []
+    for target in args.targets:
+        seconds, deps = import_time(target, repeat=args.repeat, top=args.top)
+        print(f'{target:<28} {seconds:6.2f} s   ' + ', '.join(f'{name} {t:.2f} s' for t, name in deps))
+        if args.max is not None and seconds > args.max:
+            slow.append(target)
+
+    if slow:
+        print(f'\nSlower than {args.max} s: {", ".join(slow)}')
+        sys.exit(1)
@@ -0,0 +1,265 @@
+''' Local scheduler for the (net, dataset, subset, stage) task graph of a node.
+
+Every subset contributes a train -> build_graph -> post_process chain, and an optional comparison waits for all
+of them. Each task reserves CPU cores and memory, and a task is started as soon as its dependencies are done and
+its reservation fits, so the training of one subset overlaps with the persistent homology of another instead of
+running the subsets one after the other. Training is core-heavy and PH is memory-heavy, which their default
+reservations reflect. Tasks are pinned to their cores and their thread pools are sized to match.
+
+Failed tasks are retried, and the state of every task is kept in a JSON file. A rerun with the same state file
+skips the tasks that are already done, so an interrupted sweep picks up where it stopped. Inside a SLURM
+allocation this replaces the serial subset loops of the scripts generated by scriptor.py:
+
+    python scripts/scheduler.py --net lenet --dataset imagenet --subsets 0 29 --mem 750
+'''
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Task():
+    def __init__(self, name, cmd, cores, mem, deps=(), priority=0):
+        self.name = name
+        self.cmd = cmd
+        self.cores = cores
+        self.mem = mem
+        self.deps = list(deps)
+        self.priority = priority
+
+    def __repr__(self):
+        return f'Task({self.name}, cores={self.cores}, mem={self.mem}G, deps={self.deps})'
+
+
+def available_cores():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+
+def total_memory():
+    ''' Physical memory of the node in GB '''
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024**3
+
+def build_tasks(args):
+    ''' Task graph of the sweep; later stages get higher priority, so started subsets are finished first. '''
+    subsets = list(range(args.subsets[0], args.subsets[1] + 1)) if args.dataset == 'imagenet' else [0]
+    common = f' --net {args.net} --dataset {args.dataset}'
+    common += f' --reduction {args.reduction}' if args.reduction else ''
+    common += f' --metric {args.metric}' if args.metric else ''
+
+    tasks = []
+    for i in subsets:
+        oname = f'{args.net}_{args.dataset}_ss{i}' if args.dataset == 'imagenet' else f'{args.net}_{args.dataset}'
+        deps = []
+
+        if args.train:
+            # subsets other than 0 start from the initial weights written by subset 0
+            init = [f'train/{args.net}_{args.dataset}_ss0'] if args.dataset == 'imagenet' and i != 0 and args.subsets[0] == 0 else []
+            cmd = f'python train.py{common} --iter {i} --epochs {args.n_epochs_train} --lr {args.lr} --optimizer {args.optimizer} --chkpt_epochs {args.epochs_test}'
+            tasks.append(Task(f'train/{oname}', cmd, args.train_cores, args.train_mem, deps=init, priority=0))
+            deps = [f'train/{oname}']
+
+        if args.build_graph:
+            # the graph stage plans its memory within its reservation
+            cmd = f'python build_graph_functional.py{common} --iter {i} --chkpt_epochs {args.epochs_test} --subset {args.subset} --resume 0 --memory_limit {args.ph_mem}'
+            tasks.append(Task(f'build_graph/{oname}', cmd, args.ph_cores, args.ph_mem, deps=deps, priority=1))
+            deps = [f'build_graph/{oname}']
+
+        if args.post_process:
+            cmd = f'python post_process.py{common} --iter {i} --chkpt_epochs {args.epochs_test} --save_dir {shlex.quote(os.path.join(args.save_dir, oname))}'
+            tasks.append(Task(f'post_process/{oname}', cmd, args.post_cores, args.post_mem, deps=deps, priority=2))
+
+    if args.compare:
+        cmd = f'python comparison.py{common} --save_dir {shlex.quote(args.save_dir)} --chkpt_epochs {args.epochs_test}'
+        cmd += f' --start_iter {subsets[0]} --stop_iter {subsets[-1]}' if args.dataset == 'imagenet' else ''
+        deps = [task.name for task in tasks if task.name.startswith('post_process/')]
+        tasks.append(Task(f'compare/{args.net}_{args.dataset}', cmd, args.post_cores, args.post_mem, deps=deps, priority=3))
+
+    names = set(task.name for task in tasks)
+    for task in tasks:
+        task.deps = [dep for dep in task.deps if dep in names]
+
+    return tasks
+
+
+class Scheduler():
+    ''' Run tasks on the cores and memory of this node, respecting dependencies and reservations. '''
+    def __init__(self, tasks, cores, mem, state_file, log_dir, retries=1, poll=1.):
+        for task in tasks:
+            if task.cores > len(cores) or task.mem > mem:
+                raise ValueError(f'{task} does not fit on {len(cores)} cores and {mem:.0f}G of memory')
+
+        self.tasks = {task.name: task for task in tasks}
+        self.free_cores = list(cores)
+        self.free_mem = mem
+        self.state_file = state_file
+        self.log_dir = log_dir
+        self.retries = retries
+        self.poll = poll
+        self.running = {}
+
+        self.state = {}
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                self.state = json.load(f)
+        for name in self.tasks:
+            if self.state.get(name, {}).get('status') != 'done':
+                self.state[name] = {'status': 'pending', 'attempts': 0}
+        self._save_state()
+
+    def _save_state(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_file)), exist_ok=True)
+        tmp = f'{self.state_file}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp, self.state_file)
+
+    def _status(self, name):
+        return self.state[name]['status']
+
+    def _ready(self):
+        ''' Pending tasks whose dependencies are done, highest priority first '''
+        ready = [task for name, task in self.tasks.items() if self._status(name) == 'pending' and all(self._status(dep) == 'done' for dep in task.deps)]
+        return sorted(ready, key=lambda task: -task.priority)
+
+    def _skip_dependents(self):
+        ''' Tasks depending on a failed or skipped task can never run '''
+        changed = True
+        while changed:
+            changed = False
+            for name, task in self.tasks.items():
+                if self._status(name) == 'pending' and any(self._status(dep) in ('failed', 'skipped') for dep in task.deps):
+                    self.state[name]['status'] = 'skipped'
+                    changed = True
+
+    def _start(self, task):
+        cores, self.free_cores = self.free_cores[:task.cores], self.free_cores[task.cores:]
+        self.free_mem -= task.mem
+
+        threads = str(task.cores)
+        env = dict(os.environ, OMP_NUM_THREADS=threads, MKL_NUM_THREADS=threads, OPENBLAS_NUM_THREADS=threads)
+        pin = (lambda: os.sched_setaffinity(0, cores)) if hasattr(os, 'sched_setaffinity') else None
+
+        self.state[task.name]['attempts'] += 1
+        self.state[task.name]['status'] = 'running'
+        log_file = os.path.join(self.log_dir, f'{task.name.replace("/", "_")}.log')
+        os.makedirs(self.log_dir, exist_ok=True)
+        log = open(log_file, 'a')
+        log.write(f'\n==> Attempt {self.state[task.name]["attempts"]}: {task.cmd}\n')
+        log.flush()
+
+        process = subprocess.Popen(shlex.split(task.cmd), cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT, preexec_fn=pin)
+        self.running[task.name] = (process, cores, log, time.time())
+        print(f'Started {task.name} on {len(cores)} cores, {task.mem}G (attempt {self.state[task.name]["attempts"]})')
+
+    def _finish(self, name, returncode):
+        process, cores, log, start = self.running.pop(name)
+        log.close()
+        self.free_cores = sorted(self.free_cores + cores)
+        self.free_mem += self.tasks[name].mem
+
+        elapsed = time.time() - start
+        self.state[name]['returncode'] = returncode
+        self.state[name]['time'] = elapsed
+        if returncode == 0:
+            self.state[name]['status'] = 'done'
+            print(f'Finished {name} in {elapsed/60:.1f} minutes')
+        elif self.state[name]['attempts'] <= self.retries:
+            self.state[name]['status'] = 'pending'
+            print(f'{name} failed with code {returncode}, retrying')
+        else:
+            self.state[name]['status'] = 'failed'
+            print(f'{name} failed with code {returncode} after {self.state[name]["attempts"]} attempts')
+
+    def run(self):
+        ''' Run until no task can make progress; returns the number of failed tasks. '''
+        try:
+            while True:
+                for name, (process, _, _, _) in list(self.running.items()):
+                    if process.poll() is not None:
+                        self._finish(name, process.returncode)
+                self._skip_dependents()
+
+                # start every ready task that fits, so small tasks fill the gaps left by large ones
+                for task in self._ready():
+                    if task.cores <= len(self.free_cores) and task.mem <= self.free_mem:
+                        self._start(task)
+                self._save_state()
+
+                if len(self.running) == 0 and len(self._ready()) == 0:
+                    break
+                time.sleep(self.poll)
+        except KeyboardInterrupt:
+            for name, (process, _, _, _) in self.running.items():
+                process.terminate()
+                process.wait()
+                self.state[name]['status'] = 'pending'
+            self._save_state()
+            raise
+
+        counts = {}
+        for name in self.tasks:
+            counts[self._status(name)] = counts.get(self._status(name), 0) + 1
+        print(f'\nTasks: {", ".join(f"{n} {status}" for status, n in sorted(counts.items()))}')
+
+        return sum(self._status(name) == 'failed' for name in self.tasks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the pipeline of a sweep on the cores and memory of this node')
+    required = parser.add_argument_group('required arguments')
+
+    required.add_argument('--net', help='Specify deep network architecture.', required=True)
+    required.add_argument('--dataset', help='Specify dataset (e.g. mnist, cifar10, imagenet)', required=True)
+    parser.add_argument('--subsets', nargs=2, type=int, default=[0, 29], help='First and last ImageNet subset.')
+    parser.add_argument('--train', default=1, type=int)
+    parser.add_argument('--build_graph', default=1, type=int)
+    parser.add_argument('--post_process', default=1, type=int)
+    parser.add_argument('--compare', default=0, type=int)
+    parser.add_argument('--n_epochs_train', default='50', help='Number of epochs to train.')
+    parser.add_argument('--lr', default='0.001', help='Specify learning rate for training.')
+    parser.add_argument('--optimizer', default='adabelief', help='Define training optimizer: "adabelief" or "adam")')
+    parser.add_argument('--epochs_test', default='0 4 8 20 30 40 50', help='Epochs for which you want to build graph.')
+    parser.add_argument('--subset', default=500, type=int, help='Subset size for building graph.')
+    parser.add_argument('--metric', default=None, type=str, help='Distance metric: none, spearman, dcorr, or callable.')
+    parser.add_argument('--reduction', default=None, type=str, help='Reductions: pca, umap, kmeans, or none.')
+    parser.add_argument('--save_dir', default='./results', help='Directory to save results.')
+
+    # Node resources and reservations
+    parser.add_argument('--cores', default=None, type=int, help='Cores to use; default: all available.')
+    parser.add_argument('--mem', default=None, type=float, help='Memory to use in GB; default: all of the node.')
+    parser.add_argument('--train_cores', default=8, type=int)
+    parser.add_argument('--train_mem', default=16, type=float, help='GB')
+    parser.add_argument('--ph_cores', default=4, type=int)
+    parser.add_argument('--ph_mem', default=64, type=float, help='GB')
+    parser.add_argument('--post_cores', default=1, type=int)
+    parser.add_argument('--post_mem', default=4, type=float, help='GB')
+
+    parser.add_argument('--retries', default=1, type=int, help='Times a failed task is restarted.')
+    parser.add_argument('--state', default=None, type=str, help='State file; default: ./scheduler/<net>_<dataset>.json')
+    parser.add_argument('--log_dir', default='./scheduler/logs', help='Directory of the task logs.')
+    parser.add_argument('--restart', default=0, type=int, help='Ignore the state of a previous run.')
+    parser.add_argument('--dry_run', default=0, type=int, help='Print the task graph and exit.')
+    args = parser.parse_args()
+
+    cores = available_cores()
+    cores = cores[:args.cores] if args.cores is not None else cores
+    mem = args.mem if args.mem is not None else total_memory()
+
+    state_file = args.state if args.state is not None else f'./scheduler/{args.net}_{args.dataset}.json'
+    if args.restart and os.path.exists(state_file):
+        os.remove(state_file)
+
+    tasks = build_tasks(args)
+    print(f'{len(tasks)} tasks on {len(cores)} cores and {mem:.0f}G of memory\n')
+    if args.dry_run:
+        for task in tasks:
+            print(f'{task}\n    {task.cmd}')
+        sys.exit(0)
+
+    scheduler = Scheduler(tasks, cores, mem, os.path.abspath(state_file), os.path.abspath(args.log_dir), retries=args.retries)
+    sys.exit(1 if scheduler.run() > 0 else 0)
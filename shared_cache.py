@@ -0,0 +1,123 @@
+''' Node-local cache of decoded images shared by concurrent jobs.
+
+Each image is decoded once into an .npy file under SHARED_CACHE_DIR (a tmpfs such as /dev/shm by default),
+keyed by the image path and its modification time, so concurrent CustomImageNet instances on the node decode
+every image once instead of once per job and epoch. What is saved is the decode only: the transforms take PIL
+images, and PIL copies the mapped pixels into a buffer of its own, so every read still holds a private copy of
+the image for the duration of its transforms.
+
+The cache holds at most DNN_TOPOLOGY_SHM_GB, by default half the size of its filesystem: once the cache
+(as measured when the dataset was opened, plus what this process published since) would exceed it, or the
+filesystem runs short, images are decoded as usual without being published. Files stay until cleared, as
+tmpfs pages count against the memory of the node:
+
+    python shared_cache.py --stats
+    python shared_cache.py --clear
+'''
+import argparse
+import hashlib
+import os
+import shutil
+
+import numpy as np
+from PIL import Image
+
+SHARED_CACHE_DIR = os.environ.get('DNN_TOPOLOGY_SHM', '/dev/shm/dnn_topology')
+
+# modes that round-trip through a uint8 array without losing information
+CACHEABLE_MODES = ('RGB', 'L')
+# free space left on the filesystem of the cache for everything else
+RESERVE_BYTES = 1 << 30
+
+
+def _default_max_bytes(root):
+    if 'DNN_TOPOLOGY_SHM_GB' in os.environ:
+        return int(float(os.environ['DNN_TOPOLOGY_SHM_GB']) * 1024**3)
+
+    return shutil.disk_usage(root).total // 2
+
+
+class SharedImageCache():
+    def __init__(self, root=SHARED_CACHE_DIR, max_bytes=None):
+        self.root = root
+        try:
+            os.makedirs(root, exist_ok=True)
+            self.max_bytes = max_bytes if max_bytes is not None else _default_max_bytes(root)
+            self.used = cache_stats(root)[1]
+        except OSError as e:
+            print(f'Shared image cache disabled: {e}')
+            self.max_bytes, self.used = 0, 0
+
+    def _path(self, img_path):
+        img_path = os.path.abspath(img_path)
+        key = hashlib.sha1(f'{img_path}|{os.path.getmtime(img_path)}'.encode()).hexdigest()
+
+        return os.path.join(self.root, key[:2], f'{key}.npy')
+
+    def _publish(self, cache_fl, arr):
+        ''' Write arr to cache_fl unless that exceeds the budget; the image stays usable when the write fails. '''
+        if self.used + arr.nbytes > self.max_bytes:
+            return
+        tmp = f'{cache_fl}.{os.getpid()}.tmp'
+        try:
+            if shutil.disk_usage(self.root).free < arr.nbytes + RESERVE_BYTES:
+                return
+            # concurrent writers produce identical files, so the last rename simply wins
+            os.makedirs(os.path.dirname(cache_fl), exist_ok=True)
+            with open(tmp, 'wb') as f:
+                np.save(f, arr)
+            os.replace(tmp, cache_fl)
+            self.used += arr.nbytes
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def load(self, img_path):
+        ''' Return the decoded image as PIL, decoding and publishing it on a miss. '''
+        cache_fl = self._path(img_path)
+        try:
+            # mapped to skip a read buffer; fromarray copies the pixels
+            return Image.fromarray(np.load(cache_fl, mmap_mode='r'))
+        except FileNotFoundError:
+            pass
+
+        with Image.open(img_path) as img:
+            img.load()
+        if img.mode in CACHEABLE_MODES:
+            self._publish(cache_fl, np.asarray(img))
+
+        return img
+
+    def clear(self):
+        clear_cache(self.root)
+        self.used = 0
+
+def cache_stats(root=SHARED_CACHE_DIR):
+    n_files, n_bytes = 0, 0
+    for dirpath, _, files in os.walk(root):
+        for f in files:
+            if f.endswith('.npy'):
+                n_files += 1
+                n_bytes += os.path.getsize(os.path.join(dirpath, f))
+
+    return n_files, n_bytes
+
+def clear_cache(root=SHARED_CACHE_DIR):
+    ''' Remove every cached image; readers that still map a file keep it until they close it. '''
+    if os.path.exists(root):
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect or clear the shared image cache')
+    parser.add_argument('--root', default=SHARED_CACHE_DIR)
+    parser.add_argument('--stats', action='store_true')
+    parser.add_argument('--clear', action='store_true')
+    args = parser.parse_args()
+
+    if args.clear:
+        clear_cache(args.root)
+        print(f'Cleared {args.root}')
+    if args.stats:
+        n_files, n_bytes = cache_stats(args.root)
+        print(f'{args.root}: {n_files} images, {n_bytes / 1024**2:.1f} MB')
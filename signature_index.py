@@ -0,0 +1,250 @@
+''' Nearest-neighbour index over fixed-length topological signatures of runs.
+
+Each (net, subset, epoch) diagram is vectorised on a fixed grid, so signatures inserted at different
+times are comparable:
+    betti:     Betti curves normalised by the number of nodes
+    landscape: first n_layers persistence landscapes
+    image:     persistence images in (birth, persistence) coordinates
+
+Usage:
+    python signature_index.py build --losses ./losses --signature betti
+    python signature_index.py query --run lenet/lenet_mnist:50 -k 5
+'''
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+
+from bettis import betti_curves
+from config import UPPER_DIM
+from topology import filter_diagrams, load_diagrams
+
+SIGNATURES = ('betti', 'landscape', 'image')
+INDEX_METRICS = {'linf': 'chebyshev', 'l2': 'euclidean'}
+
+
+def landscapes(dgms, samplings, homology_dimensions, n_layers=5):
+    ''' Persistence landscapes lambda_1..lambda_n_layers of every diagram on a fixed grid; (n_dgms, n_dims, n_layers, n_thresh). '''
+    out = np.zeros((len(dgms), len(homology_dimensions), n_layers, len(samplings)))
+    for k, dgm in enumerate(dgms):
+        for j, dim in enumerate(homology_dimensions):
+            pairs = dgm[(dgm[:, 2] == dim) & np.isfinite(dgm[:, 1])]
+            if len(pairs) == 0:
+                continue
+            tents = np.maximum(0., np.minimum(samplings[None, :] - pairs[:, :1], pairs[:, 1:2] - samplings[None, :]))
+            tents = -np.sort(-tents, axis=0)[:n_layers]
+            out[k, j, :len(tents)] = tents
+
+    return out
+
+def persistence_images(dgms, homology_dimensions, n_pixels=20, sigma=0.05, extent=(0., 1.)):
+    ''' Persistence images with a Gaussian kernel and linear persistence weighting on a fixed
+    [extent] x [extent] (birth, persistence) grid; (n_dgms, n_dims, n_pixels, n_pixels). '''
+    centres = np.linspace(extent[0], extent[1], n_pixels)
+    out = np.zeros((len(dgms), len(homology_dimensions), n_pixels, n_pixels))
+    for k, dgm in enumerate(dgms):
+        for j, dim in enumerate(homology_dimensions):
+            pairs = dgm[(dgm[:, 2] == dim) & np.isfinite(dgm[:, 1])]
+            if len(pairs) == 0:
+                continue
+            birth, pers = pairs[:, 0], pairs[:, 1] - pairs[:, 0]
+            # the kernel is separable, so the image is a product of two (points x pixels) matrices
+            gx = np.exp(-(centres[None, :] - birth[:, None])**2 / (2 * sigma**2))
+            gy = np.exp(-(centres[None, :] - pers[:, None])**2 / (2 * sigma**2))
+            out[k, j] = (gx * pers[:, None]).T @ gy / (2 * np.pi * sigma**2)
+
+    return out
+
+def compute_signatures(dgms, signature, homology_dimensions, n_bins=100, epsilon=0.02125):
+    ''' Flattened signature vectors of a batch of raw diagrams; (n_dgms, n_features). '''
+    homology_dimensions = list(homology_dimensions)
+    dgms = filter_diagrams(dgms, epsilon)
+    samplings = np.linspace(0, 1, n_bins)
+
+    if signature == 'betti':
+        nodes = np.array([max(int(np.sum(dgm[:, 2] == 0)), 1) for dgm in dgms])
+        vecs = betti_curves(dgms, samplings, homology_dimensions=homology_dimensions) / nodes[:, None, None]
+    elif signature == 'landscape':
+        vecs = landscapes(dgms, samplings, homology_dimensions)
+    elif signature == 'image':
+        vecs = persistence_images(dgms, homology_dimensions)
+    else:
+        raise ValueError(f'Signature {signature} not supported! Use one of {SIGNATURES}')
+
+    return vecs.reshape(len(dgms), -1)
+
+
+def signature_settings(signature, max_dim, n_bins=100, epsilon=0.02125):
+    ''' Settings of compute_signatures that make two signature vectors comparable '''
+    if signature not in SIGNATURES:
+        raise ValueError(f'Signature {signature} not supported! Use one of {SIGNATURES}')
+
+    return {'signature': signature, 'max_dim': int(max_dim), 'n_bins': int(n_bins), 'epsilon': float(epsilon)}
+
+
+class SignatureIndex():
+    ''' k-NN index with incremental inserts. New vectors are kept in a small buffer that is searched
+    by brute force; the ball tree is rebuilt once the buffer grows past rebuild_fraction of the index.
+    settings (signature_settings) are stored with the index, and check() refuses vectors computed otherwise. '''
+    def __init__(self, metric='linf', settings=None, rebuild_fraction=0.1, leaf_size=40):
+        if metric not in INDEX_METRICS:
+            raise ValueError(f'Index metric {metric} not supported! Use one of {tuple(INDEX_METRICS)}')
+
+        self.metric = metric
+        self.settings = settings
+        self.rebuild_fraction = rebuild_fraction
+        self.leaf_size = leaf_size
+        self.keys = []
+        self.key_set = set()
+        self.vectors = None
+        self.tree = None
+        self.n_indexed = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.key_set
+
+    def check(self, settings):
+        ''' Raise ValueError unless signatures computed with settings are comparable with the indexed ones. '''
+        if self.settings != settings:
+            raise ValueError(f'Index holds signatures computed with {self.settings}, not {settings}; '
+                             f'query with the same settings or build a new index')
+
+    def add(self, keys, vectors):
+        ''' Insert vectors under keys; existing keys are skipped. '''
+        vectors = np.asarray(vectors, dtype=np.float64).reshape(len(keys), -1)
+        new = list({key: k for k, key in enumerate(keys) if key not in self}.values())
+        if len(new) == 0:
+            return
+        if self.vectors is not None and vectors.shape[1] != self.vectors.shape[1]:
+            raise ValueError(f'Signature length {vectors.shape[1]} does not match index ({self.vectors.shape[1]})')
+
+        self.keys += [keys[k] for k in new]
+        self.key_set.update(keys[k] for k in new)
+        self.vectors = vectors[new] if self.vectors is None else np.concatenate([self.vectors, vectors[new]])
+
+        if len(self.keys) - self.n_indexed > self.rebuild_fraction * max(self.n_indexed, 1):
+            self._rebuild()
+
+    def _rebuild(self):
+        from sklearn.neighbors import BallTree
+
+        self.tree = BallTree(self.vectors, leaf_size=self.leaf_size, metric=INDEX_METRICS[self.metric])
+        self.n_indexed = len(self.keys)
+
+    def query(self, vectors, k=5):
+        ''' Return the keys and distances of the k nearest signatures of every query vector. '''
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float64))
+        k = min(k, len(self))
+        if k == 0:
+            return [[] for _ in vectors], np.zeros((len(vectors), 0))
+
+        dists, idxs = [], []
+        if self.tree is not None:
+            dist, idx = self.tree.query(vectors, k=min(k, self.n_indexed))
+            dists.append(dist)
+            idxs.append(idx)
+        if self.n_indexed < len(self.keys):
+            pending = self.vectors[self.n_indexed:]
+            diff = np.abs(vectors[:, None, :] - pending[None, :, :])
+            dist = diff.max(axis=-1) if self.metric == 'linf' else np.sqrt(np.sum(diff**2, axis=-1))
+            dists.append(dist)
+            idxs.append(np.arange(self.n_indexed, len(self.keys))[None, :].repeat(len(vectors), axis=0))
+
+        dists, idxs = np.concatenate(dists, axis=1), np.concatenate(idxs, axis=1)
+        order = np.argsort(dists, axis=1, kind='stable')[:, :k]
+        dists, idxs = np.take_along_axis(dists, order, axis=1), np.take_along_axis(idxs, order, axis=1)
+
+        return [[self.keys[i] for i in row] for row in idxs], dists
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, keys=json.dumps(self.keys), vectors=self.vectors if self.vectors is not None else np.zeros((0, 0)), metric=self.metric,
+                     settings=json.dumps(self.settings))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with np.load(path) as data:
+            # indexes saved before settings were recorded load with settings None and match no query
+            settings = json.loads(str(data['settings'])) if 'settings' in data.files else None
+            index = cls(metric=str(data['metric']), settings=settings, **kwargs)
+            keys, vectors = json.loads(str(data['keys'])), data['vectors']
+        if len(keys) > 0:
+            index.add(keys, vectors)
+
+        return index
+
+def find_runs(losses_dir):
+    ''' Map run keys '<relative folder>:<epoch>' to diagram pickles under losses_dir. '''
+    runs = {}
+    for pkl_fl in sorted(glob.glob(os.path.join(losses_dir, '**', 'dgm_epoch_*.pkl'), recursive=True)):
+        folder = os.path.relpath(os.path.dirname(pkl_fl), losses_dir)
+        epoch = os.path.basename(pkl_fl)[len('dgm_epoch_'):-len('.pkl')]
+        runs[f'{folder}:{epoch}'] = pkl_fl
+
+    return runs
+
+def build(args):
+    ''' Insert every diagram under args.losses that is not yet in the index. '''
+    settings = signature_settings(args.signature, args.max_dim, n_bins=args.n_bins)
+    index = SignatureIndex.load(args.index) if os.path.exists(args.index) else SignatureIndex(metric=args.index_metric, settings=settings)
+    index.check(settings)
+
+    runs = find_runs(args.losses)
+    new = [key for key in runs if key not in index]
+    print(f'Found {len(runs)} runs, {len(new)} not yet indexed')
+
+    for start in range(0, len(new), args.batch_size):
+        keys = new[start:start+args.batch_size]
+        dgms = load_diagrams([runs[key] for key in keys])
+        index.add(keys, compute_signatures(dgms, args.signature, range(args.max_dim+1), n_bins=args.n_bins, epsilon=settings['epsilon']))
+
+    index.save(args.index)
+    print(f'Index {args.index} holds {len(index)} runs')
+
+def query(args):
+    settings = signature_settings(args.signature, args.max_dim, n_bins=args.n_bins)
+    index = SignatureIndex.load(args.index)
+    index.check(settings)
+    if len(index) == 0:
+        raise ValueError(f'Index {args.index} is empty; run signature_index.py build first')
+
+    if args.run is not None:
+        pkl_fl = find_runs(args.losses)[args.run]
+    else:
+        pkl_fl = args.dgm
+    vec = compute_signatures(load_diagrams([pkl_fl]), args.signature, range(args.max_dim+1), n_bins=args.n_bins, epsilon=settings['epsilon'])
+
+    keys, dists = index.query(vec, k=args.k)
+    for key, dist in zip(keys[0], dists[0]):
+        print(f'{dist:.4f}  {key}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Nearest-neighbour search over topological signatures of runs')
+    parser.add_argument('command', choices=['build', 'query'])
+    parser.add_argument('--losses', default='./losses', help='Directory searched for dgm_epoch_*.pkl files.')
+    parser.add_argument('--index', default=None, help='Index file; defaults to ./cache/index_<signature>_<metric>.npz')
+    parser.add_argument('--signature', default='betti', help=f'Signature: {", ".join(SIGNATURES)}.')
+    parser.add_argument('--index_metric', default='linf', help=f'Distance: {", ".join(INDEX_METRICS)}.')
+    parser.add_argument('--max_dim', default=UPPER_DIM, type=int, help='Highest homology dimension in the signature.')
+    parser.add_argument('--n_bins', default=100, type=int, help='Filtration values of the betti and landscape signatures.')
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--run', default=None, help='Query by run key <relative folder>:<epoch>.')
+    parser.add_argument('--dgm', default=None, help='Query by diagram pickle.')
+    parser.add_argument('-k', default=5, type=int)
+    args = parser.parse_args()
+
+    args.index = args.index if args.index is not None else f'./cache/index_{args.signature}_{args.index_metric}.npz'
+
+    if args.command == 'build':
+        build(args)
+    else:
+        query(args)
@@ -1,11 +1,11 @@
 import os
 import pickle
-import plotly.graph_objects as go
-from plotly.io import write_image
 
+import numpy as np
+import plotly.graph_objects as go
 from PIL import Image
 
-from loaders import *
+from render import FigureRenderer
 
 NET = 'resnet'
 DATASET = 'imagenet'
@@ -15,6 +15,7 @@ SUBSETS = 30 # 1 for none, 30 for all
 SAVE_DIR = './results/stats'
 RED = 'kmeans' # 'pca' or 'umap' or None
 METRIC = 'spearman' # 'euclidean' or 'cosine' or None
+RENDER = 'async' # 'sync', 'async', 'defer' or 'off'
 
 SAVE_DIR += f'/{RED}' if RED is not None else ''
 SAVE_DIR += f'/{METRIC}' if METRIC is not None else ''
@@ -35,6 +36,8 @@ def get_concat_v_multi_blank(im_list):
 
 time_only = False
 
+renderer = FigureRenderer(RENDER)
+
 # ''' Make plots of losses and accuracies '''
 Xs = None
 test_accs = []
@@ -93,7 +96,7 @@ for iter in range(START, SUBSETS):
         fig.add_trace(go.Scatter(x=X, y=[loss['acc_te']/100. for loss in losses], mode='lines', line_color='red', name='Test'))
         fig.add_trace(go.Scatter(x=X, y=[loss['acc_tr']/100. for loss in losses], mode='lines', line_color='blue', name='Train'))
 
-        write_image(fig, acc_save_file, format='png')
+        renderer.submit(fig, acc_save_file)
 
         '''Create plots of losses'''
         test_loss = np.array([np.mean(loss['loss_te']) for loss in losses])
@@ -116,7 +119,7 @@ for iter in range(START, SUBSETS):
         fig.add_trace(go.Scatter(x=X, y=train_loss - train_std, fill='tonexty', mode='lines', showlegend=False, line=dict(color='blue', width=.1, dash='dash')))
         
         # fig.update_layout(title=f'Average loss on subset {iter}', xaxis_title='Epoch', yaxis_title='Loss')
-        write_image(fig, loss_save_file, format='png')
+        renderer.submit(fig, loss_save_file)
 
 ''' Plot averages over all subsets '''
 if not time_only:
@@ -151,7 +154,9 @@ if not time_only:
     fig.add_trace(go.Scatter(x=Xs, y=train_mean - train_std, fill='tonexty', mode='lines', showlegend=False, line=dict(color='blue', width=.1, dash='dash')))
 
     # fig.update_layout(title=f'Average accuracy over subsets {START}-{SUBSETS-1}', xaxis_title='Epoch', yaxis_title='Accuracy', yaxis=dict(tickfont=dict(size=20)), xaxis=dict(tickfont=dict(size=20)))
-    write_image(fig, avg_acc_save_file, format='png')
+    renderer.submit(fig, avg_acc_save_file)
+
+renderer.close()
 
 times = np.array(times)
 print(f'Average time per subset: {times.mean()/60.:.3f} minutes')
@@ -0,0 +1,147 @@
+''' Per-stage telemetry written as JSON lines next to the results.
+
+Every record holds the stage, the epoch, the run settings (net, dataset, subset, metric, reduction) and
+    wall, cpu:      seconds of wall-clock and CPU time (user + system, all threads) of the stage
+    peak_rss_mb:    peak resident memory of the process during the stage (since the process started where the
+                    kernel does not allow resetting the peak)
+    torch_peak_mb:  peak of the CUDA caching allocator during the stage; null on CPU
+plus whatever the stage adds, e.g. node, edge and collapsed edge counts of the graph and the collapse ratio.
+Stages of build_graph_functional.py: extraction, adjacency, distance, coo, collapse, ph; its plan record holds
+the memory plan of the run (memory.py) with the predicted peak of every stage.
+
+Aggregate over any tree of results:
+    python telemetry.py ./losses --by net stage
+'''
+import argparse
+import contextlib
+import json
+import os
+import resource
+import socket
+import sys
+import time
+
+TELEMETRY_FILE = 'telemetry.jsonl'
+
+
+def _reset_peak_rss():
+    ''' Reset the kernel's peak RSS of this process (Linux); returns whether it was reset '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024**2 if sys.platform == 'darwin' else maxrss / 1024
+
+def _cuda():
+    ''' torch if it is loaded and has a CUDA device; telemetry never imports torch itself '''
+    torch = sys.modules.get('torch')
+    return torch if torch is not None and torch.cuda.is_available() else None
+
+
+class Telemetry():
+    def __init__(self, out_dir, **run):
+        self.path = os.path.join(out_dir, TELEMETRY_FILE)
+        self.run = dict(run, host=socket.gethostname(), pid=os.getpid())
+        os.makedirs(out_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def stage(self, name, epoch=None, **fields):
+        ''' Measure the block as stage name; the yielded dict takes extra fields, e.g. counts known only at the end. '''
+        record = dict(fields)
+        torch = _cuda()
+        if torch is not None:
+            torch.cuda.reset_peak_memory_stats()
+        _reset_peak_rss()
+
+        usage = os.times()
+        cpu = usage.user + usage.system
+        wall = time.perf_counter()
+
+        yield record
+
+        usage = os.times()
+        record.update({'wall': time.perf_counter() - wall,
+                       'cpu': usage.user + usage.system - cpu,
+                       'peak_rss_mb': _peak_rss_mb(),
+                       'torch_peak_mb': torch.cuda.max_memory_allocated() / 1024**2 if torch is not None else None})
+        self.write(name, epoch, **record)
+
+    def write(self, name, epoch=None, **fields):
+        record = dict(self.run, stage=name, epoch=epoch, time=time.time(), **fields)
+        # one write per line on a file opened for appending, so concurrent writers do not interleave lines
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+def stage(telemetry, name, epoch=None, **fields):
+    ''' telemetry.stage(...), or a block that records nothing when telemetry is None '''
+    if telemetry is None:
+        return contextlib.nullcontext({})
+
+    return telemetry.stage(name, epoch, **fields)
+
+
+def load_telemetry(root):
+    ''' Records of every telemetry file under root (a directory or a single file) '''
+    if os.path.isfile(root):
+        paths = [root]
+    else:
+        paths = [os.path.join(d, TELEMETRY_FILE) for d, _, files in os.walk(root) if TELEMETRY_FILE in files]
+
+    records = []
+    for path in sorted(paths):
+        with open(path, 'r') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+
+    return records
+
+def aggregate(records, by=('net', 'stage')):
+    ''' Table of stage costs grouped by the fields in by; share is the fraction of the wall time within the
+    group without its last field, e.g. the share of each stage in the time of a net. '''
+    import pandas as pd
+
+    df = pd.DataFrame(records)
+    by = [field for field in by if field in df.columns]
+    for column in ('wall', 'cpu', 'peak_rss_mb', 'torch_peak_mb', 'nodes', 'edges', 'collapse_ratio'):
+        if column not in df.columns:
+            df[column] = float('nan')
+
+    table = df.groupby(by, dropna=False).agg(n=('wall', 'size'), wall=('wall', 'sum'), wall_mean=('wall', 'mean'), cpu=('cpu', 'sum'),
+                                             peak_rss_mb=('peak_rss_mb', 'max'), torch_peak_mb=('torch_peak_mb', 'max'),
+                                             nodes=('nodes', 'mean'), edges=('edges', 'mean'), collapse_ratio=('collapse_ratio', 'mean'))
+    table['cores'] = table['cpu'] / table['wall']
+    table['share'] = table['wall'] / (table.groupby(level=list(range(len(by) - 1)))['wall'].transform('sum') if len(by) > 1 else table['wall'].sum())
+
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Aggregate per-stage telemetry')
+    parser.add_argument('root', nargs='?', default='./losses', help='Results directory or telemetry file.')
+    parser.add_argument('--by', nargs='+', default=['net', 'stage'], help='Fields to group by, e.g. net stage, or net epoch stage.')
+    parser.add_argument('--csv', default=None, type=str, help='Also write the table to this file.')
+    args = parser.parse_args()
+
+    records = load_telemetry(args.root)
+    if len(records) == 0:
+        raise FileNotFoundError(f'No {TELEMETRY_FILE} under {args.root}')
+
+    import pandas as pd
+
+    table = aggregate(records, by=args.by)
+    with pd.option_context('display.max_rows', None, 'display.width', 200, 'display.float_format', '{:.3f}'.format):
+        print(table)
+    if args.csv is not None:
+        table.to_csv(args.csv)
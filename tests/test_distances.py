@@ -0,0 +1,55 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from distances import cross_diagram_distances, diagram_distance, pairwise_diagram_distances
+
+pytest.importorskip('gtda')
+
+# (0, 3) is matched to (0, 2) at cost 1 and (0, 1) to the diagonal at cost 0.5, both in the L-infinity norm
+DGM_A = np.array([[0., 1.], [0., 3.]])
+DGM_B = np.array([[0., 2.]])
+EMPTY = np.zeros((0, 2))
+
+
+@pytest.mark.parametrize('metric, order, expected', [
+    ('bottleneck', 1., 1.),
+    ('wasserstein', 1., 1.5),
+    ('wasserstein', 2., np.sqrt(1.25)),
+])
+def test_hera_distances(metric, order, expected):
+    assert diagram_distance(DGM_A, DGM_B, metric=metric, order=order, delta=1e-6) == pytest.approx(expected, rel=1e-4)
+
+@pytest.mark.parametrize('metric', ['bottleneck', 'wasserstein'])
+def test_hera_empty_diagrams(metric):
+    assert diagram_distance(EMPTY, DGM_B, metric=metric, order=1.) == pytest.approx(1., rel=1e-4)
+    assert diagram_distance(EMPTY, EMPTY, metric=metric, order=1.) == 0.
+
+@pytest.mark.parametrize('metric', ['bottleneck', 'wasserstein', 'sliced_wasserstein'])
+def test_pairwise_matches_diagram_distance(metric):
+    dgms = [np.c_[DGM_A, np.zeros(2)], np.c_[DGM_B, np.zeros(1)], np.c_[DGM_A, np.ones(2)]]
+    dist = pairwise_diagram_distances(dgms, [0, 1], metric=metric, n_jobs=1)
+
+    assert dist.shape == (2, 3, 3)
+    assert np.allclose(dist, np.transpose(dist, (0, 2, 1)))
+    assert dist[0, 0, 1] == pytest.approx(diagram_distance(DGM_A, DGM_B, metric=metric), rel=1e-4)
+    assert dist[1, 0, 2] == pytest.approx(diagram_distance(EMPTY, DGM_A, metric=metric), rel=1e-4)
+
+def test_cross_distances_and_cache(tmp_path):
+    rng = np.random.default_rng(0)
+    dgms = []
+    for _ in range(5):
+        birth = rng.random(6)
+        dgms.append(np.c_[birth, birth + rng.random(6), rng.integers(0, 2, 6)])
+
+    full = pairwise_diagram_distances(dgms, [0, 1], n_jobs=1)
+    cross = cross_diagram_distances(dgms[:2], dgms[2:], [0, 1], n_jobs=1, cache_dir=str(tmp_path))
+    assert np.allclose(cross, full[:, :2, 2:])
+
+    # every pair of the cross block is read back from the cache, in either order
+    assert np.allclose(pairwise_diagram_distances(dgms, [0, 1], n_jobs=1, cache_dir=str(tmp_path)), full)
+    assert np.allclose(cross_diagram_distances(dgms[2:], dgms[:2], [0, 1], n_jobs=1, cache_dir=str(tmp_path)), full[:, 2:, :2])
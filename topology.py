@@ -0,0 +1,218 @@
+import json
+import os
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from bettis import betti_summaries
+from cache import ArtifactCache, hash_parts
+from config import SEED, UPPER_DIM
+from telemetry import stage
+
+
+def _load_pickle(pkl_fl):
+    try:
+        with open(pkl_fl, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        raise FileNotFoundError(f'Error loading {pkl_fl}')
+
+def load_diagrams(pkl_files, n_jobs=None):
+    ''' Load persistence diagram pickles concurrently; order follows pkl_files. '''
+    n_jobs = n_jobs if n_jobs is not None else min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        return list(pool.map(_load_pickle, pkl_files))
+
+def filter_diagrams(dgms, epsilon):
+    ''' Drop the points of each diagram whose lifetime is at most epsilon (as gtda's Filtering). '''
+    filtered = []
+    for dgm in dgms:
+        dgm = np.asarray(dgm, dtype=np.float64).reshape(-1, 3)
+        filtered.append(dgm[(dgm[:, 1] - dgm[:, 0]) > epsilon])
+
+    return filtered
+
+def persistence_entropy(dgms, homology_dimensions, nan_fill_value=-1.):
+    ''' Base-2 persistence entropy of every diagram and dimension in one pass over the finite pairs. '''
+    homology_dimensions = np.asarray(list(homology_dimensions), dtype=np.int64)
+    n_dgms, n_dims = len(dgms), len(homology_dimensions)
+
+    sizes = [len(dgm) for dgm in dgms]
+    points = np.concatenate([np.asarray(dgm, dtype=np.float64).reshape(-1, 3) for dgm in dgms]) if n_dgms > 0 else np.zeros((0, 3))
+    dgm_idx = np.repeat(np.arange(n_dgms), sizes)
+    dim_idx = np.searchsorted(homology_dimensions, points[:, 2].astype(np.int64))
+
+    life = points[:, 1] - points[:, 0]
+    keep = np.isfinite(life) & (life > 0) & (dim_idx < n_dims)
+    keep[keep] &= homology_dimensions[dim_idx[keep]] == points[keep, 2]
+    group, life = (dgm_idx * n_dims + dim_idx)[keep], life[keep]
+
+    total = np.bincount(group, weights=life, minlength=n_dgms * n_dims)
+    plogp = np.bincount(group, weights=life * np.log2(life), minlength=n_dgms * n_dims)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        entropy = np.log2(total) - plogp / total
+    entropy[total == 0] = nan_fill_value
+
+    return entropy.reshape(n_dgms, n_dims)
+
+def process_diagrams(dgms, samplings, homology_dimensions, epsilon=0.02125, cache_dir=None):
+    ''' Filter a batch of diagrams and compute Betti curves, summaries and entropy in one batched call.
+    Results are cached per diagram, keyed by the hash of the raw diagram and the processing parameters,
+    so that only diagrams not seen before are processed.
+    return: dict of arrays stacked over diagrams and the list of filtered diagrams. '''
+    homology_dimensions = list(homology_dimensions)
+    samplings = np.asarray(samplings, dtype=np.float64)
+    cache = ArtifactCache(cache_dir) if cache_dir is not None else None
+
+    keys = [hash_parts(np.asarray(dgm), epsilon, samplings, homology_dimensions) for dgm in dgms]
+    filtered = filter_diagrams(dgms, epsilon)
+
+    results = [cache.load(key) if cache is not None else None for key in keys]
+    missing = [k for k, res in enumerate(results) if res is None]
+
+    if len(missing) > 0:
+        batch = [filtered[k] for k in missing]
+        summary = betti_summaries(batch, samplings, homology_dimensions=homology_dimensions)
+        entropy = persistence_entropy(batch, homology_dimensions)
+        nodes = np.array([max(int(np.sum(dgm[:, 2] == 0)), 1) for dgm in batch])
+
+        for j, k in enumerate(missing):
+            results[k] = {'curves': summary['curves'][j],
+                          'life': summary['life'][j],
+                          'midlife': summary['midlife'][j],
+                          'integral': summary['integral'][j],
+                          'entropy': entropy[j],
+                          'nodes': np.array(nodes[j])}
+            if cache is not None:
+                cache.save(keys[k], **results[k])
+
+    print(f'Processed {len(missing)} diagrams, {len(dgms) - len(missing)} loaded from cache')
+
+    out = {name: np.stack([res[name] for res in results]) for name in ('curves', 'life', 'midlife', 'integral', 'entropy', 'nodes')} if len(results) > 0 else {}
+    out['filtered'] = filtered
+
+    return out
+
+def correlation_distance(adj):
+    ''' Distance (.5*(1 - adj))^.5 of a correlation adjacency (torch tensor, modified in place) for the V-R filtration '''
+    import torch
+
+    with torch.no_grad():
+        # metrics: (.5*(1 - adj))^.5 or (1 - |adj|)^.5
+        return adj.neg_().add_(1.).clamp_(0., 1.).mul_(.5).sqrt_()
+
+def distance_coo(dist, tile=None, thresh=1.):
+    ''' COO form (row, col, vals) of the entries of a symmetric distance matrix (torch tensor) up to thresh; only the
+    upper triangle with the diagonal, which is all ripser keeps of a symmetric matrix. The matrix is read tile rows
+    at a time, counted first so the COO arrays are allocated once; without tile it is a single tile. '''
+    import torch
+
+    n = dist.shape[0]
+    tile = n if tile is None else max(1, tile)
+    with torch.no_grad():
+        counts = [int(torch.triu(dist[i:i + tile] <= thresh, diagonal=i).sum()) for i in range(0, n, tile)]
+
+        row, col = np.empty(sum(counts), dtype=np.int32), np.empty(sum(counts), dtype=np.int32)
+        vals = np.empty(sum(counts), dtype=np.float32)
+        k = 0
+        for i, count in zip(range(0, n, tile), counts):
+            block = dist[i:i + tile]
+            indices = torch.triu(block <= thresh, diagonal=i).nonzero()
+            row[k:k + count] = indices[:, 0].numpy(force=True) + i
+            col[k:k + count] = indices[:, 1].numpy(force=True)
+            vals[k:k + count] = block[indices[:, 0], indices[:, 1]].numpy(force=True)
+            k += count
+
+    return row, col, vals
+
+def distance_threshold(dist, max_edges, n_pairs=1 << 18):
+    ''' Distance below which about max_edges of the off-diagonal pairs of dist lie, estimated from n_pairs random
+    pairs; truncating the filtration there is the approximate mode of memory.MemoryPlan. '''
+    import torch
+
+    n = dist.shape[0]
+    fraction = max_edges / max(n * (n - 1) // 2, 1)
+    if fraction >= 1.:
+        return 1.
+
+    generator = torch.Generator().manual_seed(SEED)
+    i, j = torch.randint(n, (2, n_pairs), generator=generator)
+    i, j = i[i != j], j[i != j]
+    with torch.no_grad():
+        sample = dist[i.to(dist.device), j.to(dist.device)].float()
+
+    thresh = torch.quantile(sample, fraction)
+    # a quantile on a tie, e.g. the pairs without positive correlation all at .5^.5, would keep all of them; keep none
+    if (sample == thresh).float().mean() > .01:
+        thresh = torch.nextafter(thresh, torch.zeros_like(thresh))
+
+    return float(thresh)
+
+def correlation_diagram(adj, maxdim=UPPER_DIM, n_threads=-1, verbose=False, telemetry=None, epoch=None, tile=None, max_edges=None):
+    ''' Vietoris-Rips persistence diagram of a correlation adjacency (torch tensor, modified in place) under the
+    distance (.5*(1 - adj))^.5, computed from its sparse COO form with collapsed edges.
+    With telemetry, the distance, coo, collapse and ph steps are recorded as stages of epoch. tile converts to COO
+    tile rows at a time; max_edges truncates the filtration at the distance that keeps about that many edges.
+    return: gtda-format diagram and the PH computation time (collapse and ph) in seconds. '''
+    from gph import ripser_parallel
+    from gph.python.ripser_interface import _collapse_coo
+    from gtda.homology._utils import _postprocess_diagrams
+    from scipy.sparse import coo_matrix
+
+    n = adj.shape[0]
+    with stage(telemetry, 'distance', epoch, nodes=n):
+        # convert to distance matrix for V-R filtration
+        adj = correlation_distance(adj)
+
+    with stage(telemetry, 'coo', epoch, nodes=n) as record:
+        # convert to COO format for faster computation of persistence diagram
+        thresh = distance_threshold(adj, max_edges) if max_edges is not None else 1.
+        row, col, vals = distance_coo(adj, tile=tile, thresh=thresh)
+        edges = int(np.sum(row != col))
+        record.update({'edges': edges, 'thresh': thresh})
+
+    del adj
+
+    if verbose:
+        print(f'\n The dimension of the COO distance matrix is {(2*len(vals) - n,)}\n')
+        if vals.shape[0] != 0:
+            print(f'adj mean {np.nanmean(vals):.4f}, min {np.nanmin(vals):.4f}, max {np.nanmax(vals):.4f}')
+        else:
+            print(f'adj empty! \n')
+
+    # Collapse edges (as ripser_parallel(..., collapse_edges=True) does) and compute persistence diagram
+    comp_time = time.time()
+    with stage(telemetry, 'collapse', epoch, nodes=n) as record:
+        row, col, vals = _collapse_coo(row, col, vals, np.inf)
+        collapsed = int(np.sum(row != col))
+        record.update({'edges': edges, 'collapsed_edges': collapsed, 'collapse_ratio': collapsed / max(edges, 1)})
+
+    with stage(telemetry, 'ph', epoch, nodes=n, edges=collapsed) as record:
+        dgm = ripser_parallel(coo_matrix((vals, (row, col)), shape=(n, n)), metric="precomputed", maxdim=maxdim, n_threads=n_threads, collapse_edges=False)
+        record['points'] = [int(len(d)) for d in dgm['dgms']]
+    comp_time = time.time() - comp_time
+
+    dgm_gtda = _postprocess_diagrams([dgm["dgms"]], format="ripser", homology_dimensions=range(maxdim + 1), infinity_values=np.inf, reduced=True)[0]
+
+    return dgm_gtda, comp_time
+
+def save_diagram(dgm, pkl_folder, epoch):
+    dgm_pkl_file = os.path.join(pkl_folder, f'dgm_epoch_{epoch}.pkl')
+    os.makedirs(pkl_folder, exist_ok=True)
+    with open(dgm_pkl_file, 'wb') as f:
+        pickle.dump(dgm, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def save_time(total_time, pkl_folder):
+    os.makedirs(pkl_folder, exist_ok=True)
+    with open(os.path.join(pkl_folder, 'time.pkl'), 'ab') as f:
+        pickle.dump(total_time, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def record_samples(pkl_folder, manifest_file, sample_manifest, metric=None, reduction=None):
+    ''' Record which sample manifest the diagrams in pkl_folder were built from '''
+    os.makedirs(pkl_folder, exist_ok=True)
+    with open(os.path.join(pkl_folder, 'samples.json'), 'w') as f:
+        json.dump({'manifest': manifest_file, 'hash': sample_manifest['hash'], 'size': sample_manifest['size'],
+                   'stratified': sample_manifest['stratified'], 'metric': metric, 'reduction': reduction}, f, indent=1)
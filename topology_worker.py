@@ -0,0 +1,92 @@
+''' Persistent homology of checkpoint epochs in a background process while training continues.
+
+train.py --background_ph captures activations at each checkpoint epoch (see capture.py) and submits the
+capture to a TopologyWorker. The worker builds the adjacency and the persistence diagram on its own share
+of the cores and writes dgm_epoch_<epoch>.pkl as build_graph_functional.py does, so post-processing of
+early epochs can start while later epochs are still training. The queue is bounded: when the worker falls
+behind, training blocks at the next checkpoint instead of piling up captures.
+'''
+import multiprocessing as mp
+import os
+
+import numpy as np
+import torch
+
+from concurrency import available_cores
+from config import UPPER_DIM
+from graph import adjacency
+from topology import correlation_diagram, save_diagram, save_time
+
+
+def split_cores(ph_cores):
+    ''' Split the available cores into (training cores, PH cores); PH gets the last ph_cores.
+    On a single core both share it. '''
+    cores = available_cores()
+    if len(cores) == 1:
+        return cores, cores
+    if not 0 < ph_cores < len(cores):
+        raise ValueError(f'ph_cores must be between 1 and {len(cores) - 1}, got {ph_cores}')
+
+    return cores[:-ph_cores], cores[-ph_cores:]
+
+def _pin(cores, threads=None):
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads if threads is not None else len(cores))
+
+def _worker_loop(queue, pkl_folder, metric, cores, maxdim):
+    _pin(cores)
+
+    total_time = 0.
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        epoch, mode, capture_file = item
+
+        captured = np.load(capture_file)
+        if mode == 'pearson':
+            adj = torch.tensor(captured)
+        else:
+            adj = adjacency(captured.T, metric=metric, device=torch.device('cpu'))
+        del captured
+
+        dgm, comp_time = correlation_diagram(adj, maxdim=maxdim, n_threads=len(cores))
+        total_time += comp_time
+        save_diagram(dgm, pkl_folder, epoch)
+        print(f'\n Background PH for epoch {epoch}: {comp_time/60:.2f} minutes \n')
+
+        del adj, dgm
+
+    save_time(total_time, pkl_folder)
+
+
+class TopologyWorker():
+    ''' Start before any torch computation in the parent: the worker is forked when the platform allows, and
+    OpenMP thread pools do not survive a fork. The parent is pinned to the training cores until close(), which
+    restores its affinity and torch threads. '''
+    def __init__(self, pkl_folder, metric=None, ph_cores=1, max_queue=2, maxdim=UPPER_DIM):
+        train_cores, ph_cores = split_cores(ph_cores)
+        ctx = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+
+        self.queue = ctx.Queue(maxsize=max_queue)
+        self.process = ctx.Process(target=_worker_loop, args=(self.queue, pkl_folder, metric, ph_cores, maxdim), daemon=True)
+        self.process.start()
+
+        self.cores, self.threads = available_cores(), torch.get_num_threads()
+        _pin(train_cores)
+        print(f'Training on {len(train_cores)} cores, background PH on {len(ph_cores)} cores')
+
+    def submit(self, epoch, mode, capture_file):
+        ''' Queue a capture of mode (features or pearson); blocks while the queue is full. '''
+        if not self.process.is_alive():
+            raise RuntimeError(f'Topology worker exited with code {self.process.exitcode}')
+        self.queue.put((epoch, mode, capture_file))
+
+    def close(self):
+        ''' Wait for the queued epochs to finish and give the parent its cores back. '''
+        self.queue.put(None)
+        self.process.join()
+        _pin(self.cores, self.threads)
+        if self.process.exitcode != 0:
+            raise RuntimeError(f'Topology worker exited with code {self.process.exitcode}')
@@ -2,21 +2,28 @@ from __future__ import print_function
 
 import argparse
 import gc
+import os
 import pickle
+import random
 
+import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
 import torch.nn as nn
 import torch.optim as optim
 from adabelief_pytorch import AdaBelief
 
-from loaders import *
+from loaders import eval_transform, loader, manifest_file
+from execution import ExecutionMode, add_execution_args
+from capture import CAPTURE_MODES, ActivationCapture, capture_dir
+from concurrency import Concurrency, add_concurrency_args, available_cores
 from models.utils import get_model, init_from_checkpoint
 from passers import Passer
-from savers import save_checkpoint, save_losses
-from PIL import Image
+from savers import AsyncCheckpointWriter, save_checkpoint, save_losses
+from topology import record_samples
+from topology_worker import TopologyWorker
 
-from config import SEED, IMG_SIZE
+from config import SEED
 
 parser = argparse.ArgumentParser(description='PyTorch Training')
 
@@ -34,119 +41,188 @@ parser.add_argument('--test_batch_size', default=32, type=int)
 parser.add_argument('--input_size', default=32, type=int)
 parser.add_argument('--iter', default=0, type=int)
 parser.add_argument('--chkpt_epochs', nargs='+', action='extend', type=int, default=[])
-
-args = parser.parse_args()
-
-''' Set seed and other cudnn settings '''
-torch.manual_seed(SEED)
-np.random.seed(SEED)
-random.seed(SEED)
-cudnn.benchmark = False
-# torch.use_deterministic_algorithms(True, warn_only=True)
-
-''' Directory to save training transformers '''
-TRANS_DIR = f'./train_processing/{args.net}/{args.net}_{args.dataset}_ss{args.iter}' if args.dataset == 'imagenet' else f'./train_processing/{args.net}/{args.net}_{args.dataset}'
-os.makedirs(TRANS_DIR, exist_ok=True)
-
-ONAME = f'{args.net}_{args.dataset}_ss{args.iter}' if args.dataset == 'imagenet' else f'{args.net}_{args.dataset}'
-
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-print("Device: ", device, "\n")
-
-''' Prepare loaders '''
-print(f'==> Preparing data..\n')
-print(f'Preparing train loader')
-train_loader, train_transform = loader(f'{args.dataset}_train', batch_size=args.train_batch_size, iter=args.iter, verbose=True)
-
-test_transform = []
-size = (IMG_SIZE, IMG_SIZE) if args.dataset == 'imagenet' else (28, 28)
-test_transform.append(transforms.CenterCrop(size))
-for item in train_transform.transforms:
-    if isinstance(item, torchvision.transforms.transforms.ToTensor):
-        test_transform.append(item)
-    elif isinstance(item, torchvision.transforms.transforms.Normalize):
-        test_transform.append(item)
-
-# test_transform.append(transforms.CenterCrop(size))
-test_transform = transforms.Compose(test_transform)
-
-print(f'train transform: {train_transform}')
-print(f'test transform before: {test_transform}')
-
-print(f'Preparing test loader\n')
-test_loader, _ = loader(f'{args.dataset}_test', batch_size=args.test_batch_size, iter=args.iter, verbose=False, transform=test_transform)
-print(f'test transform after: {test_transform}')
-
-trans_pkl_file = os.path.join(TRANS_DIR, f'test_transform.pkl')
-if not os.path.exists(os.path.dirname(trans_pkl_file)):
-    os.makedirs(os.path.dirname(trans_pkl_file))
-with open(trans_pkl_file, 'wb') as f:
-    pickle.dump(test_transform, f, protocol=pickle.HIGHEST_PROTOCOL)
-
-n_samples = len(train_loader) * args.train_batch_size
-
-criterion = nn.CrossEntropyLoss()
-
-''' Build models '''
-print(f'==> Building model..\n')
-net = get_model(args.net, args.dataset)
-net = net.to(device)
-
-''' Optimization '''
-if args.optimizer == 'adabelief':
-    optimizer = AdaBelief(net.parameters(), lr=args.lr, eps=1e-8, betas=(0.9, 0.999), weight_decay=1e-2, weight_decouple=True, rectify=False, fixed_decay=False, amsgrad=False)
-elif args.optimizer == 'adam':
-    optimizer = optim.Adam(net.parameters(), lr=args.lr, weight_decay=5e-4)
-else:
-    optimizer = optim.SGD(net.parameters(), lr=args.lr, momentum=0.9, weight_decay=5e-4)
-
-best_acc = 0  # best test accuracy
-start_epoch = 1  # start from epoch 1 or last checkpoint epoch
-
-''' Initialize from checkpoint '''
-if args.resume:
-    net, optimizer, loss_tr, loss_te, acc_tr, acc_te, start_epoch = init_from_checkpoint(net, optimizer, args)
-    start_epoch += 1
-    print(f'==> Resuming from checkpoint.. Epoch: {start_epoch}\n')
-elif args.iter != 0:
-    net, optimizer, loss_tr, loss_te, acc_tr, acc_te, start_epoch = init_from_checkpoint(net, optimizer, args, start=True)
-    start_epoch += 1
-
-''' Define passer '''
-passer_train = Passer(net, train_loader, criterion, device)
-passer_test = Passer(net, test_loader, criterion, device)
-
-''' Make intial pass before any training '''
-if not args.resume and args.iter == 0:
-    loss_te, acc_te = passer_test.run()
-    save_checkpoint(checkpoint = {'net':net.state_dict(),
-                                  'loss_te': loss_te,
-                                  'acc_te': acc_te,
-                                  'optimizer': optimizer.state_dict()},
-                                  path=f'./checkpoint/{args.net}/{ONAME}/', fname=f"ckpt_epoch_0.pt")
-
-losses = []
-for epoch in range(start_epoch, args.epochs + 1):
-    print(f'Epoch {epoch}')
-
-    loss_tr, acc_tr = passer_train.run(optimizer)
-    loss_te, acc_te = passer_test.run()
-
-    losses.append({'loss_tr': loss_tr, 'loss_te': loss_te, 'acc_tr': acc_tr, 'acc_te': acc_te, 'epoch': int(epoch)})
-    if epoch in vars(args)['chkpt_epochs']:
+parser.add_argument('--batch_transforms', default=0, type=int, help='Apply augmentations as tensor ops on whole batches.')
+parser.add_argument('--num_workers', default=None, type=int, help='Data loader workers; default: tuned or remembered setting.')
+parser.add_argument('--autotune_loader', default=0, type=int, help='Benchmark data loader settings for this host and remember the fastest.')
+parser.add_argument('--shared_cache', default=0, type=int, help='Decode ImageNet images once per node and share the decoded files between concurrent jobs.')
+parser.add_argument('--capture', default=None, type=str, help=f'Capture activations of the graph subset at checkpoint epochs: {", ".join(CAPTURE_MODES)}.')
+parser.add_argument('--subset', default=500, type=int, help='Subset size for building graph; used by --capture.')
+parser.add_argument('--stratified', default=0, type=int, help='Draw the graph subset with an equal share of every class.')
+parser.add_argument('--async_checkpoints', default=0, type=int, help='Write checkpoints from a background thread.')
+parser.add_argument('--compress_checkpoints', default=0, type=int, help='gzip checkpoints written with --async_checkpoints.')
+parser.add_argument('--background_ph', default=0, type=int, help='Compute persistence diagrams of checkpoint epochs in a background process.')
+parser.add_argument('--ph_cores', default=None, type=int, help='Cores given to background PH; default: half of the available cores.')
+parser.add_argument('--ph_queue', default=2, type=int, help='Checkpoint epochs that may wait for background PH before training blocks.')
+add_execution_args(parser)
+add_concurrency_args(parser)
+
+
+def parse_args(argv=None):
+    return parser.parse_args(argv)
+
+def run(args):
+    ''' Train args.net on args.dataset; returns the trained network and the test transform for the next stages '''
+
+    ''' Set seed and other cudnn settings '''
+    torch.manual_seed(SEED)
+    np.random.seed(SEED)
+    random.seed(SEED)
+    cudnn.benchmark = False
+    # torch.use_deterministic_algorithms(True, warn_only=True)
+
+    ''' Directory to save training transformers '''
+    TRANS_DIR = f'./train_processing/{args.net}/{args.net}_{args.dataset}_ss{args.iter}' if args.dataset == 'imagenet' else f'./train_processing/{args.net}/{args.net}_{args.dataset}'
+    os.makedirs(TRANS_DIR, exist_ok=True)
+
+    ONAME = f'{args.net}_{args.dataset}_ss{args.iter}' if args.dataset == 'imagenet' else f'{args.net}_{args.dataset}'
+
+    ''' Directory to save losses and persistence diagrams '''
+    path = f'./losses/{args.net}/{ONAME}'
+    path += f'/{args.reduction}' if args.reduction else ''
+    path += f'/{args.metric}' if args.metric else ''
+
+    ''' Background PH worker; started before any torch computation, see TopologyWorker '''
+    topology_worker = None
+    if args.background_ph:
+        if args.reduction is not None:
+            raise ValueError('Background PH does not support reductions; run build_graph_functional.py instead')
+        args.capture = args.capture if args.capture is not None else ('pearson' if args.metric is None else 'features')
+        if args.capture == 'pearson' and args.metric is not None:
+            raise ValueError(f'Captured correlations only support the default metric, not {args.metric}; use --capture features')
+        ph_cores = args.ph_cores if args.ph_cores is not None else max(1, len(available_cores()) // 2)
+        topology_worker = TopologyWorker(path, metric=args.metric, ph_cores=ph_cores, max_queue=args.ph_queue)
+
+    ''' Core budget; with background PH it covers the training cores only '''
+    concurrency = Concurrency.from_args('train', args).apply()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print("Device: ", device, "\n")
+    execution = ExecutionMode.from_args(args, device=device)
+
+    ''' Prepare loaders '''
+    num_workers = args.num_workers if args.num_workers is not None else (concurrency.loader if args.cores is not None else None)
+    loader_settings = {'num_workers': num_workers, 'prefetch_factor': 2, 'pin_memory': torch.cuda.is_available()} if num_workers is not None else None
+    print(f'==> Preparing data..\n')
+    print(f'Preparing train loader')
+    train_loader, train_transform = loader(f'{args.dataset}_train', batch_size=args.train_batch_size, iter=args.iter, verbose=True, batch_transform=args.batch_transforms, loader_settings=loader_settings, autotune=args.autotune_loader, shared_cache=args.shared_cache)
+
+    test_transform = eval_transform(train_transform, args.dataset)
+
+    print(f'train transform: {train_transform}')
+    print(f'test transform before: {test_transform}')
+
+    print(f'Preparing test loader\n')
+    test_loader, _ = loader(f'{args.dataset}_test', batch_size=args.test_batch_size, iter=args.iter, verbose=False, transform=test_transform, batch_transform=args.batch_transforms, loader_settings=loader_settings, autotune=args.autotune_loader, shared_cache=args.shared_cache)
+    print(f'test transform after: {test_transform}')
+
+    trans_pkl_file = os.path.join(TRANS_DIR, f'test_transform.pkl')
+    if not os.path.exists(os.path.dirname(trans_pkl_file)):
+        os.makedirs(os.path.dirname(trans_pkl_file))
+    with open(trans_pkl_file, 'wb') as f:
+        pickle.dump(test_transform, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    ''' Functional subset for activation capture, drawn from the same sample manifest as build_graph_functional.py '''
+    capturer = None
+    if args.capture is not None:
+        functloader, _ = loader(f'{args.dataset}_test', batch_size=100, iter=args.iter, subset=args.subset, verbose=False, transform=test_transform,
+                                shared_cache=args.shared_cache, manifest=manifest_file(TRANS_DIR, args.subset, args.stratified), stratified=args.stratified)
+        capturer = ActivationCapture(functloader, capture_dir(args.net, args.dataset, args.iter), mode=args.capture,
+                                     manifest_hash=functloader.dataset.sample_manifest['hash'], device=device, execution=execution)
+        if topology_worker is not None:
+            record_samples(path, manifest_file(TRANS_DIR, args.subset, args.stratified), functloader.dataset.sample_manifest, metric=args.metric)
+
+    n_samples = len(train_loader) * args.train_batch_size
+
+    criterion = nn.CrossEntropyLoss()
+
+    ''' Build models '''
+    print(f'==> Building model..\n')
+    net = get_model(args.net, args.dataset)
+    net = net.to(device)
+    net = execution.apply(net)
+    print(f'Execution: {execution}\n')
+
+    ''' Optimization '''
+    if args.optimizer == 'adabelief':
+        optimizer = AdaBelief(net.parameters(), lr=args.lr, eps=1e-8, betas=(0.9, 0.999), weight_decay=1e-2, weight_decouple=True, rectify=False, fixed_decay=False, amsgrad=False)
+    elif args.optimizer == 'adam':
+        optimizer = optim.Adam(net.parameters(), lr=args.lr, weight_decay=5e-4)
+    else:
+        optimizer = optim.SGD(net.parameters(), lr=args.lr, momentum=0.9, weight_decay=5e-4)
+
+    best_acc = 0  # best test accuracy
+    start_epoch = 1  # start from epoch 1 or last checkpoint epoch
+
+    ''' Initialize from checkpoint '''
+    if args.resume:
+        net, optimizer, loss_tr, loss_te, acc_tr, acc_te, start_epoch = init_from_checkpoint(net, optimizer, args)
+        start_epoch += 1
+        print(f'==> Resuming from checkpoint.. Epoch: {start_epoch}\n')
+    elif args.iter != 0:
+        net, optimizer, loss_tr, loss_te, acc_tr, acc_te, start_epoch = init_from_checkpoint(net, optimizer, args, start=True)
+        start_epoch += 1
+
+    ''' Checkpoint writer; None saves synchronously '''
+    checkpoint_writer = AsyncCheckpointWriter(max_in_flight=2, compress=args.compress_checkpoints) if args.async_checkpoints else None
+
+    ''' Define passer '''
+    passer_train = Passer(net, train_loader, criterion, device, execution=execution)
+    passer_test = Passer(net, test_loader, criterion, device, execution=execution)
+
+    ''' Make intial pass before any training '''
+    if not args.resume and args.iter == 0:
+        loss_te, acc_te = passer_test.run()
         save_checkpoint(checkpoint = {'net':net.state_dict(),
-                                      'loss_tr': loss_tr,
                                       'loss_te': loss_te,
-                                      'acc_tr': acc_tr,
                                       'acc_te': acc_te,
-                                      'epoch': epoch,
                                       'optimizer': optimizer.state_dict()},
-                                       path=f'./checkpoint/{args.net}/{ONAME}/', fname=f"ckpt_epoch_{epoch}.pt")
-
-    gc.collect()
-
-'''Save losses'''
-path = f'./losses/{args.net}/{ONAME}'
-path += f'/{args.reduction}' if args.reduction else ''
-path += f'/{args.metric}' if args.metric else ''
-save_losses(losses, path=path, fname='/stats.pkl')
+                                      path=f'./checkpoint/{args.net}/{ONAME}/', fname=f"ckpt_epoch_0.pt", writer=checkpoint_writer)
+        if capturer is not None:
+            capture_file = capturer.capture(net, 0, checkpoint=f'./checkpoint/{args.net}/{ONAME}/ckpt_epoch_0.pt', deferred=checkpoint_writer is not None)
+            if topology_worker is not None:
+                topology_worker.submit(0, args.capture, capture_file)
+
+    losses = []
+    for epoch in range(start_epoch, args.epochs + 1):
+        print(f'Epoch {epoch}')
+
+        loss_tr, acc_tr = passer_train.run(optimizer)
+        loss_te, acc_te = passer_test.run()
+
+        losses.append({'loss_tr': loss_tr, 'loss_te': loss_te, 'acc_tr': acc_tr, 'acc_te': acc_te, 'epoch': int(epoch)})
+        if epoch in vars(args)['chkpt_epochs']:
+            save_checkpoint(checkpoint = {'net':net.state_dict(),
+                                          'loss_tr': loss_tr,
+                                          'loss_te': loss_te,
+                                          'acc_tr': acc_tr,
+                                          'acc_te': acc_te,
+                                          'epoch': epoch,
+                                          'optimizer': optimizer.state_dict()},
+                                           path=f'./checkpoint/{args.net}/{ONAME}/', fname=f"ckpt_epoch_{epoch}.pt", writer=checkpoint_writer)
+            if capturer is not None:
+                capture_file = capturer.capture(net, epoch, checkpoint=f'./checkpoint/{args.net}/{ONAME}/ckpt_epoch_{epoch}.pt', deferred=checkpoint_writer is not None)
+                if topology_worker is not None:
+                    topology_worker.submit(epoch, args.capture, capture_file)
+
+        gc.collect()
+
+    '''Save losses'''
+    save_losses(losses, path=path, fname='/stats.pkl')
+
+    if checkpoint_writer is not None:
+        checkpoint_writer.flush()
+    # captures record the hash of their checkpoint, which the asynchronous writer has now written
+    if capturer is not None:
+        capturer.finalize()
+
+    concurrency.report()
+
+    if topology_worker is not None:
+        print('Waiting for background PH..')
+        topology_worker.close()
+
+    return {'net': net, 'test_transform': test_transform, 'execution': execution}
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -5,17 +5,16 @@ import sys
 import time
 import pickle
 
-import matplotlib.pyplot as plt
 import numpy as np
-import torch.nn as nn
-import torch.nn.init as init
-from matplotlib import cm
 
 from config import UPPER_DIM
 
 
 def init_params(net):
     '''Init layer parameters.'''
+    import torch.nn as nn
+    import torch.nn.init as init
+
     for m in net.modules():
         if isinstance(m, nn.Conv2d):
             init.kaiming_normal(m.weight, mode='fan_out')
@@ -29,58 +28,55 @@ def init_params(net):
             if m.bias:
                 init.constant(m.bias, 0)
 
-try:
-    _, term_width = os.popen('stty size', 'r').read().split()
-except ValueError:
-    term_width = 0
-    
-term_width = int(term_width)
+term_width = None # read on the first draw; 0 when stdout is not a terminal
+
+def _term_width():
+    try:
+        return os.get_terminal_size(sys.stdout.fileno()).columns
+    except (AttributeError, OSError, ValueError):
+        return 0
 
 TOTAL_BAR_LENGTH = 65.
+PROGRESS_INTERVAL = 0.2 # minimum seconds between redraws of the progress bar
 last_time = time.time()
 begin_time = last_time
+last_draw = 0.
 
 def progress_bar(current, total, msg=None):
-    global last_time, begin_time
+    ''' Draw a progress bar; redraws are throttled to one per PROGRESS_INTERVAL, the first and last step are always drawn '''
+    global last_time, begin_time, last_draw, term_width
+    if term_width is None:
+        term_width = _term_width()
+    cur_time = time.time()
     if current == 0:
-        begin_time = time.time()  # Reset for new bar.
-
-    cur_len = int(TOTAL_BAR_LENGTH * (current/total))
-    rest_len = int(TOTAL_BAR_LENGTH - cur_len) - 1
+        begin_time = cur_time  # Reset for new bar.
 
-    sys.stdout.write(' [')
-    for i in range(cur_len):
-        sys.stdout.write('=')
-    sys.stdout.write('>')
-    for i in range(rest_len):
-        sys.stdout.write('.')
-    sys.stdout.write(']')
-
-    cur_time = time.time()
     step_time = cur_time - last_time
     last_time = cur_time
+    if 0 < current < total-1 and cur_time - last_draw < PROGRESS_INTERVAL:
+        return
+    last_draw = cur_time
     tot_time = cur_time - begin_time
 
-    L = []
+    cur_len = int(TOTAL_BAR_LENGTH * (current/total))
+    rest_len = int(TOTAL_BAR_LENGTH - cur_len) - 1
+
+    L = [' [', '=' * cur_len, '>', '.' * rest_len, ']']
     L.append('  Step: %s' % format_time(step_time))
     L.append(' | Tot: %s' % format_time(tot_time))
     if msg:
         L.append(' | ' + msg)
 
-    msg = ''.join(L)
-    sys.stdout.write(msg)
-    for i in range(term_width-int(TOTAL_BAR_LENGTH)-len(msg)-3):
-        sys.stdout.write(' ')
+    line = ''.join(L)
+    msg = ''.join(L[5:])
+    line += ' ' * (term_width-int(TOTAL_BAR_LENGTH)-len(msg)-3)
 
     # Go back to the center of the bar.
-    for i in range(term_width-int(TOTAL_BAR_LENGTH/2)+2):
-        sys.stdout.write('\b')
-    sys.stdout.write(' %d/%d ' % (current+1, total))
+    line += '\b' * (term_width-int(TOTAL_BAR_LENGTH/2)+2)
+    line += ' %d/%d ' % (current+1, total)
+    line += '\r' if current < total-1 else '\n'
 
-    if current < total-1:
-        sys.stdout.write('\r')
-    else:
-        sys.stdout.write('\n')
+    sys.stdout.write(line)
     sys.stdout.flush()
 
 def format_time(seconds):
@@ -116,6 +112,9 @@ def format_time(seconds):
     return f
 
 def make_plots(betti_nums, betti_nums_3d, epoch, num_nodes, orig_nodes, thresholds, eps_thresh, curves_dir, threeD_img_dir, start, stop, net, dataset, subset):
+    import matplotlib.pyplot as plt
+    from matplotlib import cm
+
     # pickle betti numbers along with epoch and thresholds in a dictionary
     betti_nums_dict = {'epoch': epoch, 'thresholds': thresholds, 'betti_nums': betti_nums, 'num_nodes': num_nodes, 'orig_nodes': orig_nodes}
     